@@ -1,16 +1,22 @@
 import csv
-from collections import defaultdict
+import io
+import itertools
+from collections import defaultdict, OrderedDict
 import json
 import logging
 import math
 import os
+import threading
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import ctk
 import numpy as np
 import qt
 import scipy.spatial
 import vtk
+from vtk.util import numpy_support
 
 import slicer
 from slicer.ScriptedLoadableModule import *
@@ -69,6 +75,12 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         self.actor2 = None
         self.renderer3 = None
         self.actor3 = None
+        # UpdateInterface only marks the interface as dirty, it is refreshed
+        # once per event loop iteration by flushInterfaceUpdate.
+        self.interfaceUpdatePending = False
+        # inputs of the line overlays and of the lock state last drawn
+        self.lineOverlayKeys = [None, None, None]
+        self.threeDViewKey = None
 
         # Load widget from .ui file (created by Qt Designer)
         uiWidget = slicer.util.loadUI(self.resourcePath('UI/Q3DC.ui'))
@@ -77,6 +89,7 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
 
         self.logic = Q3DCLogic(self.ui)
         self.logic.UpdateInterface = self.UpdateInterface
+        self.logic.InvalidateLines = self.invalidateLineOverlays
 
         #--------------------------- Scene --------------------------#
         self.SceneCollapsibleButton = self.ui.SceneCollapsibleButton # this attribute is usefull for Longitudinal quantification extension
@@ -91,6 +104,14 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         self.ui.inputModelSelector.setMRMLScene(slicer.mrmlScene)
         self.ui.inputModelSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onModelChanged)
         self.ui.addLandmarkButton.connect('clicked()', self.onAddLandmarkButtonClicked)
+        self.importLandmarksButton = qt.QPushButton('Import Landmarks from File')
+        self.ui.landmarkModifLayout.insertWidget(
+            self.ui.landmarkModifLayout.indexOf(self.ui.addLandmarkButton) + 1, self.importLandmarksButton)
+        self.importLandmarksButton.connect('clicked()', self.onImportLandmarksButtonClicked)
+        self.subVertexProjectionCheckBox = qt.QCheckBox('Project landmarks between mesh vertices')
+        self.ui.landmarkModifLayout.insertWidget(
+            self.ui.landmarkModifLayout.indexOf(self.importLandmarksButton) + 1, self.subVertexProjectionCheckBox)
+        self.subVertexProjectionCheckBox.connect('toggled(bool)', self.onSubVertexProjectionToggled)
         self.ui.inputLandmarksSelector.setMRMLScene(slicer.mrmlScene)
         self.ui.inputLandmarksSelector.setEnabled(False) # The "enable" property seems to not be imported from the .ui
         self.ui.inputLandmarksSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onLandmarksChanged)
@@ -213,37 +234,144 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         self.tableAndExportLinePointLayout = qt.QVBoxLayout()
         self.tableAndExportLinePointLayout.addWidget(self.linePointTable)
         self.tableAndExportLinePointLayout.addLayout(self.exportLinePointLayout)
+#       ------------------- Landmark placement uncertainty -------------------
+        self.uncertaintyCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.uncertaintyCollapsibleButton.text = 'Landmark placement uncertainty:'
+        self.uncertaintyCollapsibleButton.collapsed = True
+        self.uncertaintyLayout = qt.QFormLayout(self.uncertaintyCollapsibleButton)
+        self.uncertaintySigmaSpinBox = qt.QDoubleSpinBox()
+        self.uncertaintySigmaSpinBox.setRange(0, 10)
+        self.uncertaintySigmaSpinBox.setSingleStep(0.1)
+        self.uncertaintySigmaSpinBox.setSuffix(' mm')
+        self.uncertaintySigmaSpinBox.setSpecialValueText('Disabled')
+        self.uncertaintySigmaSpinBox.setToolTip('Standard deviation of the placement of the landmarks')
+        self.uncertaintyLayout.addRow('Standard deviation:', self.uncertaintySigmaSpinBox)
+        self.uncertaintySamplesSpinBox = qt.QSpinBox()
+        self.uncertaintySamplesSpinBox.setRange(100, 100000)
+        self.uncertaintySamplesSpinBox.setSingleStep(500)
+        self.uncertaintySamplesSpinBox.value = self.logic.uncertaintySamples
+        self.uncertaintyLayout.addRow('Samples:', self.uncertaintySamplesSpinBox)
+        self.uncertaintyConfidenceSpinBox = qt.QDoubleSpinBox()
+        self.uncertaintyConfidenceSpinBox.setRange(50, 99.9)
+        self.uncertaintyConfidenceSpinBox.setSuffix(' %')
+        self.uncertaintyConfidenceSpinBox.value = 100 * self.logic.uncertaintyConfidence
+        self.uncertaintyLayout.addRow('Confidence:', self.uncertaintyConfidenceSpinBox)
+        self.uncertaintyOnSurfaceCheckBox = qt.QCheckBox('Keep the projected landmarks on the surface')
+        self.uncertaintyOnSurfaceCheckBox.checked = self.logic.uncertaintyOnSurface
+        self.uncertaintyLayout.addRow(self.uncertaintyOnSurfaceCheckBox)
+        self.layout.addWidget(self.uncertaintyCollapsibleButton)
+        self.uncertaintySigmaSpinBox.connect('valueChanged(double)', self.onUncertaintyChanged)
+        self.uncertaintySamplesSpinBox.connect('valueChanged(int)', self.onUncertaintyChanged)
+        self.uncertaintyConfidenceSpinBox.connect('valueChanged(double)', self.onUncertaintyChanged)
+        self.uncertaintyOnSurfaceCheckBox.connect('toggled(bool)', self.onUncertaintyChanged)
+#       ------------------- Surface displacement -------------------
+        self.displacementCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.displacementCollapsibleButton.text = 'Surface displacement:'
+        self.displacementCollapsibleButton.collapsed = True
+        self.displacementLayout = qt.QFormLayout(self.displacementCollapsibleButton)
+        self.displacementModelSelectors = []
+        for modelLabel in ('From model:', 'To model:'):
+            selector = slicer.qMRMLNodeComboBox()
+            selector.nodeTypes = ['vtkMRMLModelNode']
+            selector.noneEnabled = True
+            selector.addEnabled = False
+            selector.removeEnabled = False
+            selector.setMRMLScene(slicer.mrmlScene)
+            self.displacementLayout.addRow(modelLabel, selector)
+            self.displacementModelSelectors.append(selector)
+        self.computeDisplacementButton = qt.QPushButton('Compute Surface Displacement')
+        self.displacementLayout.addRow(self.computeDisplacementButton)
+        self.layout.addWidget(self.displacementCollapsibleButton)
+        self.computeDisplacementButton.connect('clicked()', self.onComputeDisplacementClicked)
+#       ------------------- Measurement protocol -------------------
+        self.protocolCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.protocolCollapsibleButton.text = 'Run a measurement protocol:'
+        self.protocolCollapsibleButton.collapsed = True
+        self.protocolLayout = qt.QVBoxLayout(self.protocolCollapsibleButton)
+        self.runProtocolButton = qt.QPushButton('Run Measurement Protocol from File')
+        self.protocolLayout.addWidget(self.runProtocolButton)
+        self.asymmetryCohortCheckBox = qt.QCheckBox('Whole cohort (all the fiducial lists)')
+        self.protocolLayout.addWidget(self.asymmetryCohortCheckBox)
+        self.computeAsymmetryButton = qt.QPushButton('Compute Bilateral Asymmetry')
+        self.protocolLayout.addWidget(self.computeAsymmetryButton)
+        self.computeAsymmetryButton.connect('clicked()', self.onComputeAsymmetryClicked)
+        self.edmaGroupSelectors = []
+        edmaGroupsLayout = qt.QFormLayout()
+        for group in ('Group 1:', 'Group 2:'):
+            selector = slicer.qMRMLCheckableNodeComboBox()
+            selector.nodeTypes = ['vtkMRMLMarkupsFiducialNode']
+            selector.setMRMLScene(slicer.mrmlScene)
+            edmaGroupsLayout.addRow(group, selector)
+            self.edmaGroupSelectors.append(selector)
+        self.protocolLayout.addLayout(edmaGroupsLayout)
+        self.computeEDMAButton = qt.QPushButton('Compare Groups (EDMA)')
+        self.protocolLayout.addWidget(self.computeEDMAButton)
+        self.computeEDMAButton.connect('clicked()', self.onComputeEDMAClicked)
+        self.alignGroupsButton = qt.QPushButton('Align Both Groups (Generalized Procrustes)')
+        self.protocolLayout.addWidget(self.alignGroupsButton)
+        self.alignGroupsButton.connect('clicked()', self.onAlignGroupsClicked)
+        trackingLayout = qt.QFormLayout()
+        self.timepointsSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.timepointsSelector.nodeTypes = ['vtkMRMLMarkupsFiducialNode']
+        self.timepointsSelector.setMRMLScene(slicer.mrmlScene)
+        self.timepointsSelector.setToolTip('Fiducial lists of the timepoints, in the order of the scene')
+        trackingLayout.addRow('Timepoints:', self.timepointsSelector)
+        self.timepointsSequenceSelector = slicer.qMRMLNodeComboBox()
+        self.timepointsSequenceSelector.nodeTypes = ['vtkMRMLSequenceNode']
+        self.timepointsSequenceSelector.noneEnabled = True
+        self.timepointsSequenceSelector.addEnabled = False
+        self.timepointsSequenceSelector.removeEnabled = False
+        self.timepointsSequenceSelector.setMRMLScene(slicer.mrmlScene)
+        self.timepointsSequenceSelector.setToolTip('Sequence of fiducial lists, used instead of the timepoints')
+        trackingLayout.addRow('or sequence:', self.timepointsSequenceSelector)
+        self.protocolLayout.addLayout(trackingLayout)
+        self.trackLandmarksButton = qt.QPushButton('Track Landmarks Over Time')
+        self.protocolLayout.addWidget(self.trackLandmarksButton)
+        self.trackLandmarksButton.connect('clicked()', self.onTrackLandmarksClicked)
+        self.layout.addWidget(self.protocolCollapsibleButton)
+        self.runProtocolButton.connect('clicked()', self.onRunProtocolClicked)
         # INITIALISATION:
         slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onCloseScene)
+        slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved)
+        slicer.mrmlScene.AddObserver(slicer.mrmlScene.StartSaveEvent, lambda caller, event: self.logic.onStartSaveScene())
+        slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndSaveEvent, lambda caller, event: self.logic.onEndSaveScene())
+        slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndImportEvent,
+                                     lambda caller, event: self.logic.migrateLandmarkDescriptions())
         self.UpdateInterface()
         self.logic.initComboboxdict()
 
     def onCloseScene(self, obj, event):
-        list = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
-        end = list.GetNumberOfItems()
-        for i in range(0,end):
-            model = list.GetItemAsObject(i)
-            hardenModel = slicer.mrmlScene.GetNodesByName(model.GetName()).GetItemAsObject(0)
-            slicer.mrmlScene.RemoveNode(hardenModel)
+        self.logic.releaseAllMarkupsSnapshots()
+        self.logic.measurements.clear()
+        self.logic.planes.clear()
+        self.logic.surfaceIndexes.clear()
+        self.logic.multiResolutionIndexes.clear()
+        self.logic.cancelMultiResolutionIndexes()
+        self.logic.cancelModelPreparation()
+        self.logic.pendingLandmarkTables.clear()
+        self.logic.hardenModels.clear()
+        self.logic.lockStates.clear()
+        self.logic.pendingLocks.clear()
+        self.logic.unlockedFidListID = None
+        self.logic.releaseAllLandmarkItemModels()
+        self.logic.releaseAllMarkupsDispatchers()
         if self.renderer1 :
             self.renderer1.RemoveActor(self.actor1)
         if self.renderer2 :
             self.renderer2.RemoveActor(self.actor2)
         if self.renderer3 :
             self.renderer3.RemoveActor(self.actor2)
-        self.ui.landmarkComboBox1.clear()
-        self.ui.landmarkComboBox.clear()
+        self.invalidateInterface()
+        for landmarkComboBox in (self.ui.landmarkComboBox, self.ui.landmarkComboBox1, self.ui.landmarkComboBox2,
+                                 self.ui.line1LAComboBox, self.ui.line1LBComboBox,
+                                 self.ui.line2LAComboBox, self.ui.line2LBComboBox):
+            self.logic.updateLandmarkComboBox(None, landmarkComboBox)
         self.ui.fidListComboBoxA.setCurrentNode(None)
         self.ui.fidListComboBoxB.setCurrentNode(None)
         self.ui.fidListComboBoxline1LA.setCurrentNode(None)
         self.ui.fidListComboBoxline1LB.setCurrentNode(None)
         self.ui.fidListComboBoxline2LA.setCurrentNode(None)
         self.ui.fidListComboBoxline2LB.setCurrentNode(None)
-        self.ui.line1LAComboBox.clear()
-        self.ui.line1LBComboBox.clear()
-        self.ui.line2LAComboBox.clear()
-        self.ui.line2LBComboBox.clear()
-        self.ui.landmarkComboBox2.clear()
         self.ui.fidListComboBoxline2LB.setCurrentNode(None)
         self.ui.inputModelSelector.setCurrentNode(None)
         self.ui.inputLandmarksSelector.setCurrentNode(None)
@@ -260,6 +388,19 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         self.distanceTable.setRowCount(0)
         self.distanceTable.setColumnCount(0)
 
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        if node.IsA("vtkMRMLModelNode"):
+            self.logic.hardenModels.release(node.GetID())
+        elif node.IsA("vtkMRMLMarkupsFiducialNode"):
+            self.logic.releaseMarkupsSnapshot(node.GetID())
+            self.logic.lockStates.pop(node.GetID(), None)
+            self.logic.pendingLocks.pop(node.GetID(), None)
+            self.logic.releaseLandmarkItemModel(node.GetID())
+            self.logic.releaseMarkupsDispatcher(node.GetID())
+            self.logic.removeLandmarkTable(node)
+            self.logic.hardenModels.evict()
+
     def enter(self):
         print("enter Q3DC")
         model = self.ui.inputModelSelector.currentNode()
@@ -269,23 +410,83 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
             if fidlist.GetAttribute("connectedModelID") != model.GetID():
                 self.ui.inputModelSelector.setCurrentNode(None)
                 self.ui.inputLandmarksSelector.setCurrentNode(None)
-                self.ui.landmarkComboBox.clear()
+                self.logic.updateLandmarkComboBox(None, self.ui.landmarkComboBox)
         self.UpdateInterface()
+        self.restoreResultTables()
 
         # Checking the names of the fiducials
         list = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
         end = list.GetNumberOfItems()
         for i in range(0,end):
             fidList = list.GetItemAsObject(i)
-            landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+            landmarkDescription = self.logic.getLandmarkDescription(fidList)
             if landmarkDescription:
                 for n in range(fidList.GetNumberOfMarkups()):
                     markupID = fidList.GetNthMarkupID(n)
                     markupLabel = fidList.GetNthMarkupLabel(n)
                     landmarkDescription[markupID]["landmarkLabel"] = markupLabel
-                fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+                    self.logic.renameLandmark(fidList, markupID, markupLabel)
+                self.logic.setLandmarkDescription(fidList, landmarkDescription)
+
+    def restoreResultTables(self):
+        # Show the results saved in the scene if nothing was computed yet
+        if not self.computedDistanceList:
+            distanceList = self.logic.resultsFromTable('distance')
+            if distanceList:
+                self.updateDistanceTable(lambda _: distanceList)
+        if not self.computedAnglesList:
+            angleList = self.logic.resultsFromTable('angle')
+            if angleList:
+                self.updateAnglesTable(lambda _: angleList)
+        if not self.computedLinePointList:
+            linePointList = self.logic.resultsFromTable('linePoint')
+            if linePointList:
+                self.updateLinePointTable(lambda _: linePointList)
 
     def UpdateInterface(self):
+        """Request a refresh of the interface. Requests are coalesced and the
+        interface is refreshed once per event loop iteration."""
+        if self.interfaceUpdatePending:
+            return
+        self.interfaceUpdatePending = True
+        qt.QTimer.singleShot(0, self.flushInterfaceUpdate)
+
+    def invalidateInterface(self):
+        # Force the line overlays and the lock state to be recomputed on the
+        # next refresh, even if their inputs did not change.
+        self.lineOverlayKeys = [None, None, None]
+        self.threeDViewKey = None
+        self.UpdateInterface()
+
+    def invalidateLineOverlays(self, fidList):
+        # Redraw the lines joining landmarks of fidList on the next refresh.
+        fidListID = fidList.GetID()
+        for lineIndex, key in enumerate(self.lineOverlayKeys):
+            if key is not None and fidListID in key[2:]:
+                self.lineOverlayKeys[lineIndex] = None
+        self.UpdateInterface()
+
+    def flushInterfaceUpdate(self):
+        self.interfaceUpdatePending = False
+        self.updateButtonsState()
+        self.updateLineOverlay(1, self.ui.line1LAComboBox, self.ui.line1LBComboBox,
+                               self.ui.fidListComboBoxline1LA, self.ui.fidListComboBoxline1LB)
+        self.updateLineOverlay(2, self.ui.line2LAComboBox, self.ui.line2LBComboBox,
+                               self.ui.fidListComboBoxline2LA, self.ui.fidListComboBoxline2LB)
+        self.updateLineOverlay(3, self.ui.lineLAComboBox, self.ui.lineLBComboBox,
+                               self.ui.fidListComboBoxlineLA, self.ui.fidListComboBoxlineLB)
+        selectedFidList = self.logic.selectedFidList
+        # Adding, importing or removing landmarks and connecting the list
+        # change the landmarks to lock even if the selected label is the same.
+        threeDViewKey = (selectedFidList.GetID() if selectedFidList else None,
+                         self.ui.landmarkComboBox.currentText,
+                         selectedFidList.GetNumberOfControlPoints() if selectedFidList else 0,
+                         selectedFidList.GetAttribute("connectedModelID") if selectedFidList else None)
+        if threeDViewKey != self.threeDViewKey:
+            self.threeDViewKey = threeDViewKey
+            self.logic.UpdateThreeDView(self.ui.landmarkComboBox.currentText)
+
+    def updateButtonsState(self):
         self.ui.defineMiddlePointButton.enabled = self.ui.landmarkComboBox1.currentText != '' and \
                                                self.ui.landmarkComboBox2.currentText != '' and \
                                                self.ui.landmarkComboBox1.currentText != self.ui.landmarkComboBox2.currentText
@@ -306,41 +507,30 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
                                                   self.ui.linePointComboBox.currentText != '' and\
                                                   self.ui.lineLAComboBox.currentText != self.ui.lineLBComboBox.currentText
 
-        # Clear Lines:
-        if self.renderer1 :
-            self.renderer1.RemoveActor(self.actor1)
-            self.renderer1 = None
-        if self.renderer2 :
-            self.renderer2.RemoveActor(self.actor2)
-            self.renderer2 = None
-        if self.renderer3 :
-            self.renderer3.RemoveActor(self.actor3)
-            self.renderer3 = None
-        if self.ui.line1LAComboBox.currentText != '' and\
-                        self.ui.line1LBComboBox.currentText != '' and\
-                        self.ui.line1LAComboBox.currentText != self.ui.line1LBComboBox.currentText :
-            self.renderer1, self.actor1 = \
-                self.logic.drawLineBetween2Landmark(self.ui.line1LAComboBox.currentText,
-                                                    self.ui.line1LBComboBox.currentText,
-                                                    self.ui.fidListComboBoxline1LA.currentNode(),
-                                                    self.ui.fidListComboBoxline1LB.currentNode())
-        if self.ui.line2LAComboBox.currentText != '' and\
-                        self.ui.line2LBComboBox.currentText != '' and\
-                        self.ui.line2LAComboBox.currentText != self.ui.line2LBComboBox.currentText :
-            self.renderer2, self.actor2 = \
-                self.logic.drawLineBetween2Landmark(self.ui.line2LAComboBox.currentText,
-                                                    self.ui.line2LBComboBox.currentText,
-                                                    self.ui.fidListComboBoxline2LA.currentNode(),
-                                                    self.ui.fidListComboBoxline2LB.currentNode())
-        if self.ui.lineLAComboBox.currentText != '' and\
-                        self.ui.lineLBComboBox.currentText != '' and\
-                        self.ui.lineLAComboBox.currentText != self.ui.lineLBComboBox.currentText:
-            self.renderer3, self.actor3 = \
-                self.logic.drawLineBetween2Landmark(self.ui.lineLAComboBox.currentText,
-                                                    self.ui.lineLBComboBox.currentText,
-                                                    self.ui.fidListComboBoxlineLA.currentNode(),
-                                                    self.ui.fidListComboBoxlineLB.currentNode())
-        self.logic.UpdateThreeDView(self.ui.landmarkComboBox.currentText)
+    def updateLineOverlay(self, lineNumber, comboBoxA, comboBoxB, fidListComboBoxA, fidListComboBoxB):
+        # Redraw the line only if the landmarks it joins changed, moving the
+        # landmarks is handled by Q3DCLogic.updateLinesEvent.
+        fidListA = fidListComboBoxA.currentNode()
+        fidListB = fidListComboBoxB.currentNode()
+        key = (comboBoxA.currentText, comboBoxB.currentText,
+               fidListA.GetID() if fidListA else None,
+               fidListB.GetID() if fidListB else None)
+        if key == self.lineOverlayKeys[lineNumber - 1]:
+            return
+        self.lineOverlayKeys[lineNumber - 1] = key
+        renderer = getattr(self, 'renderer%d' % lineNumber)
+        if renderer:
+            renderer.RemoveActor(getattr(self, 'actor%d' % lineNumber))
+            setattr(self, 'renderer%d' % lineNumber, None)
+        if comboBoxA.currentText != '' and\
+                comboBoxB.currentText != '' and\
+                comboBoxA.currentText != comboBoxB.currentText:
+            renderer, actor = self.logic.drawLineBetween2Landmark(comboBoxA.currentText,
+                                                                  comboBoxB.currentText,
+                                                                  fidListA,
+                                                                  fidListB)
+            setattr(self, 'renderer%d' % lineNumber, renderer)
+            setattr(self, 'actor%d' % lineNumber, actor)
 
     def init_anatomical_legend(self):
         if self.anatomical_legend is None:
@@ -400,7 +590,6 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
             # code would run correctly if we continued but wouldn't do anything
             return
         fid_index = fidList.GetNthControlPointIndexByID(selectedFidReflID)
-        old_name = fidList.GetNthControlPointLabel(fid_index)
 
         # Look in the legend for the info from the selected row.
         selected_indices = self.anatomical_legend_view.selectedIndexes()
@@ -421,14 +610,7 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         fidList.SetNthControlPointDescription(fid_index, description)
 
         # Update the landmark combo boxes to reflect the name change.
-        self.logic.updateLandmarkComboBox(fidList, self.ui.landmarkComboBox, False)
-        self.ui.landmarkComboBox.setCurrentText(name)
-        for box in (self.ui.landmarkComboBox1, self.ui.landmarkComboBox2):
-            new_selection = box.currentText
-            if new_selection == old_name:
-                new_selection = name
-            self.logic.updateLandmarkComboBox(fidList, box)
-            box.setCurrentText(new_selection)
+        self.logic.renameLandmark(fidList, selectedFidReflID, name)
         self.UpdateInterface()
 
     def on_select_legend_file_clicked(self):
@@ -468,7 +650,7 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
                                       self.ui.inputLandmarksSelector,
                                       onSurface)
             else:
-                self.ui.landmarkComboBox.clear()
+                self.logic.updateLandmarkComboBox(None, self.ui.landmarkComboBox)
 
     def onAddLandmarkButtonClicked(self):
         # Add fiducial on the scene.
@@ -484,6 +666,22 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         else:
             self.logic.warningMessage("Please select a model")
 
+    def onImportLandmarksButtonClicked(self):
+        fidList = self.logic.selectedFidList
+        if not (self.logic.selectedModel and fidList):
+            self.logic.warningMessage("Please connect a fiducial list to a model.")
+            return
+        filename = qt.QFileDialog.getOpenFileName(
+            None, 'Select File', '', 'Fiducials (*.fcsv *.csv)')
+        if filename == '':
+            # User canceled the file selection dialog.
+            return
+        onSurface = self.ui.loadLandmarksOnSurfacCheckBox.isChecked()
+        self.logic.importLandmarksFromFile(fidList, filename, onSurface)
+
+    def onSubVertexProjectionToggled(self, checked):
+        self.logic.subVertexProjection = checked
+
     def onSurfaceDeplacementStateChanged(self):
         activeInput = self.logic.selectedModel
         if not activeInput:
@@ -493,17 +691,17 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
             return
         selectedFidReflID = self.logic.findIDFromLabel(fidList, self.ui.landmarkComboBox.currentText)
         isOnSurface = self.ui.surfaceDeplacementCheckBox.isChecked()
-        landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.logic.getLandmarkDescription(fidList)
         if isOnSurface:
-            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
+            hardenModel = self.logic.getHardenModel(fidList)
             landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = True
             landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] =\
-                self.logic.projectOnSurface(hardenModel, fidList, selectedFidReflID)
+                self.logic.projectOnSurface(hardenModel, fidList, selectedFidReflID, landmarkDescription)
         else:
             landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = False
-            landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] = None
+            self.logic.storeProjections(landmarkDescription, [selectedFidReflID], [None])
             landmarkDescription[selectedFidReflID]["ROIradius"] = 0
-        fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+        self.logic.setLandmarkDescription(fidList, landmarkDescription)
 
     def onDefineMidPointClicked(self):
         fidList = self.logic.selectedFidList
@@ -517,7 +715,7 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         fidList.AddFiducial(coord[0],coord[1],coord[2], f'{label1}_{label2}')
         fidList.SetNthFiducialSelected(fidList.GetNumberOfMarkups() - 1, False)
         # update of the data structure
-        landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.logic.getLandmarkDescription(fidList)
         numOfMarkups = fidList.GetNumberOfMarkups()
         markupID = fidList.GetNthMarkupID(numOfMarkups - 1)
         landmarkDescription[landmark1ID]["midPoint"]["definedByThisMarkup"].append(markupID)
@@ -530,12 +728,13 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
 
         if self.ui.midPointOnSurfaceCheckBox.isChecked():
             landmarkDescription[markupID]["projection"]["isProjected"] = True
-            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
+            hardenModel = self.logic.getHardenModel(fidList)
             landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                self.logic.projectOnSurface(hardenModel, fidList, markupID)
+                self.logic.projectOnSurface(hardenModel, fidList, markupID, landmarkDescription)
         else:
             landmarkDescription[markupID]["projection"]["isProjected"] = False
-        fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+        self.logic.setLandmarkDescription(fidList, landmarkDescription)
+        self.logic.setLandmarkMidPoint(fidList, markupID, True)
         self.logic.UpdateInterface()
         self.logic.updateLandmarkComboBox(fidList, self.ui.landmarkComboBox, False)
         fidList.SetNthFiducialPositionFromArray(numOfMarkups - 1, coord)
@@ -549,20 +748,25 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
             self.logic.warningMessage("Please connect a fiducial list to a model.")
             return
         for fidListIter in list(set(nameList)):
-            landmarkDescription = slicer.mrmlScene.GetNodesByName(fidListIter).GetItemAsObject(0). \
-                GetAttribute("landmarkDescription")
-            if not landmarkDescription:
+            landmarkDescription = self.logic.getLandmarkDescription(
+                slicer.mrmlScene.GetNodesByName(fidListIter).GetItemAsObject(0))
+            if landmarkDescription is None:
                 self.logic.warningMessage(fidListIter + ' is not connected to a model. Please use "Add and Move '
                                                         'Landmarks" panel to connect the landmarks to a model.')
                 return
+        self.updateDistanceTable(lambda distanceList: self.logic.addOnDistanceList(distanceList,
+                                                                                  self.ui.landmarkComboBoxA.currentText,
+                                                                                  self.ui.landmarkComboBoxB.currentText,
+                                                                                  fidListA, fidListB))
+
+    def updateDistanceTable(self, updateList):
+        # updateList returns the new list of distances from the current one
         if self.computedDistanceList:
             self.exportDistanceButton.disconnect('clicked()', self.onExportButton)
             self.layout.removeWidget(self.distanceTable)
             self.layout.removeItem(self.tableAndExportLayout)
-        self.computedDistanceList = self.logic.addOnDistanceList(self.computedDistanceList,
-                                                                 self.ui.landmarkComboBoxA.currentText,
-                                                                 self.ui.landmarkComboBoxB.currentText,
-                                                                 fidListA,fidListB)
+        self.computedDistanceList = updateList(self.computedDistanceList)
+        self.logic.updateResultTable('distance', self.computedDistanceList)
         self.distanceTable = self.logic.defineDistanceTable(self.distanceTable, self.computedDistanceList)
         self.ui.distanceLayout.addLayout(self.tableAndExportLayout)
         self.exportDistanceButton.connect('clicked()', self.onExportButton)
@@ -586,29 +790,34 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
             self.logic.warningMessage("Please connect a fiducial list to a model.")
             return
         for fidListIter in list(set(nameList)):
-            landmarkDescription = slicer.mrmlScene.GetNodesByName(fidListIter).GetItemAsObject(0). \
-                GetAttribute("landmarkDescription")
-            if not landmarkDescription:
+            landmarkDescription = self.logic.getLandmarkDescription(
+                slicer.mrmlScene.GetNodesByName(fidListIter).GetItemAsObject(0))
+            if landmarkDescription is None:
                 self.logic.warningMessage(fidListIter + ' is not connected to a model. Please use "Add and Move '
                                                         'Landmarks" panel to connect the landmarks to a model.')
                 return
+        self.updateAnglesTable(lambda angleList: self.logic.addOnAngleList(angleList,
+                                                                          self.ui.line1LAComboBox.currentText,
+                                                                          self.ui.line1LBComboBox.currentText,
+                                                                          self.ui.fidListComboBoxline1LA.currentNode(),
+                                                                          self.ui.fidListComboBoxline1LB.currentNode(),
+                                                                          self.ui.line2LAComboBox.currentText,
+                                                                          self.ui.line2LBComboBox.currentText,
+                                                                          self.ui.fidListComboBoxline2LA.currentNode(),
+                                                                          self.ui.fidListComboBoxline2LB.currentNode(),
+                                                                          self.ui.pitchCheckBox.isChecked(),
+                                                                          self.ui.yawCheckBox.isChecked(),
+                                                                          self.ui.rollCheckBox.isChecked()
+                                                                          ))
+
+    def updateAnglesTable(self, updateList):
+        # updateList returns the new list of angles from the current one
         if self.computedAnglesList:
             self.exportAngleButton.disconnect('clicked()', self.onExportAngleButton)
             self.layout.removeWidget(self.anglesTable)
             self.layout.removeItem(self.tableAndExportAngleLayout)
-        self.computedAnglesList = self.logic.addOnAngleList(self.computedAnglesList,
-                                                            self.ui.line1LAComboBox.currentText,
-                                                            self.ui.line1LBComboBox.currentText,
-                                                            self.ui.fidListComboBoxline1LA.currentNode(),
-                                                            self.ui.fidListComboBoxline1LB.currentNode(),
-                                                            self.ui.line2LAComboBox.currentText,
-                                                            self.ui.line2LBComboBox.currentText,
-                                                            self.ui.fidListComboBoxline2LA.currentNode(),
-                                                            self.ui.fidListComboBoxline2LB.currentNode(),
-                                                            self.ui.pitchCheckBox.isChecked(),
-                                                            self.ui.yawCheckBox.isChecked(),
-                                                            self.ui.rollCheckBox.isChecked()
-                                                            )
+        self.computedAnglesList = updateList(self.computedAnglesList)
+        self.logic.updateResultTable('angle', self.computedAnglesList)
         self.anglesTable = self.logic.defineAnglesTable(self.anglesTable, self.computedAnglesList)
         self.ui.angleLayout.addLayout(self.tableAndExportAngleLayout)
         self.exportAngleButton.connect('clicked()', self.onExportAngleButton)
@@ -631,24 +840,29 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
         fidListPoint = self.ui.fidListComboBoxlinePoint.currentNode()
         nameList = [fidListlineLA.GetName(), fidListlineLB.GetName(), fidListPoint.GetName()]
         for fidListIter in list(set(nameList)):
-            landmarkDescription = slicer.mrmlScene.GetNodesByName(fidListIter).GetItemAsObject(0). \
-                GetAttribute("landmarkDescription")
-            if not landmarkDescription:
+            landmarkDescription = self.logic.getLandmarkDescription(
+                slicer.mrmlScene.GetNodesByName(fidListIter).GetItemAsObject(0))
+            if landmarkDescription is None:
                 self.logic.warningMessage(fidListIter + ' is not connected to a model. Please use "Add and Move '
                                                         'Landmarks" panel to connect the landmarks to a model.')
                 return
+        self.updateLinePointTable(lambda linePointList: self.logic.addOnLinePointList(linePointList,
+                                                                                     self.ui.lineLAComboBox.currentText,
+                                                                                     self.ui.lineLBComboBox.currentText,
+                                                                                     fidListlineLA,
+                                                                                     fidListlineLB,
+                                                                                     self.ui.linePointComboBox.currentText,
+                                                                                     fidListPoint,
+                                                                                     ))
+
+    def updateLinePointTable(self, updateList):
+        # updateList returns the new list of line-point distances from the current one
         if self.computedLinePointList:
             self.exportLinePointButton.disconnect('clicked()', self.onExportLinePointButton)
             self.layout.removeWidget(self.linePointTable)
             self.layout.removeItem(self.tableAndExportLinePointLayout)
-        self.computedLinePointList = self.logic.addOnLinePointList(self.computedLinePointList,
-                                                           self.ui.lineLAComboBox.currentText,
-                                                           self.ui.lineLBComboBox.currentText,
-                                                                   fidListlineLA,
-                                                                   fidListlineLB,
-                                                           self.ui.linePointComboBox.currentText,
-                                                                   fidListPoint,
-                                                           )
+        self.computedLinePointList = updateList(self.computedLinePointList)
+        self.logic.updateResultTable('linePoint', self.computedLinePointList)
         self.linePointTable = self.logic.defineDistanceLinePointTable(self.linePointTable, self.computedLinePointList)
         self.ui.LinePointLayout.addLayout(self.tableAndExportLinePointLayout)
         self.exportLinePointButton.connect('clicked()', self.onExportLinePointButton)
@@ -661,6 +875,113 @@ class Q3DCWidget(ScriptedLoadableModuleWidget):
             'linePoint'
         )
 
+    def onComputeDisplacementClicked(self):
+        sourceModel, targetModel = [selector.currentNode() for selector in self.displacementModelSelectors]
+        if not sourceModel or not targetModel or sourceModel is targetModel:
+            self.logic.warningMessage("Please select two different models.")
+            return
+        qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+        try:
+            distances, _ = self.logic.displaySurfaceDisplacement(sourceModel, targetModel)
+        finally:
+            qt.QApplication.restoreOverrideCursor()
+        if len(distances):
+            slicer.util.showStatusMessage(f'Displacement of {sourceModel.GetName()}: {distances.min():.2f} to '
+                                          f'{distances.max():.2f} mm', 3000)
+
+    def onUncertaintyChanged(self, value=None):
+        # applies to the next computed measurements
+        self.logic.uncertaintySigma = self.uncertaintySigmaSpinBox.value
+        self.logic.uncertaintySamples = self.uncertaintySamplesSpinBox.value
+        self.logic.uncertaintyConfidence = self.uncertaintyConfidenceSpinBox.value / 100
+        self.logic.uncertaintyOnSurface = self.uncertaintyOnSurfaceCheckBox.checked
+
+    def onComputeAsymmetryClicked(self):
+        fidList = self.logic.selectedFidList
+        if self.asymmetryCohortCheckBox.isChecked():
+            fidLists = list(slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode"))
+        elif fidList:
+            fidLists = [fidList]
+        else:
+            self.logic.warningMessage("Please connect a fiducial list to a model.")
+            return
+        asymmetry = self.logic.bilateralAsymmetry(fidLists)
+        if asymmetry is None:
+            self.logic.warningMessage("No right/left pair of landmarks (e.g. OrR/OrL) was found in every list.")
+            return
+        tableNode = self.logic.updateAsymmetryTable(fidLists, asymmetry)
+        slicer.util.showStatusMessage(f'Asymmetry of {len(asymmetry["pairs"])} pairs written to {tableNode.GetName()}',
+                                      3000)
+
+    def onComputeEDMAClicked(self):
+        groups = [selector.checkedNodes() for selector in self.edmaGroupSelectors]
+        if not all(groups):
+            self.logic.warningMessage("Please check the fiducial lists of both groups.")
+            return
+        qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+        try:
+            edma = self.logic.euclideanDistanceMatrixAnalysis(*groups)
+        finally:
+            qt.QApplication.restoreOverrideCursor()
+        if edma is None:
+            self.logic.warningMessage("The fiducial lists must share at least two landmarks.")
+            return
+        tableNode = self.logic.updateEDMATable(edma)
+        slicer.util.showStatusMessage(f'Form difference of {len(edma["labels"])} landmarks written to '
+                                      f'{tableNode.GetName()}', 3000)
+
+    def onAlignGroupsClicked(self):
+        fidLists = [fidList for selector in self.edmaGroupSelectors for fidList in selector.checkedNodes()]
+        procrustes = self.logic.generalizedProcrustesAnalysis(fidLists)
+        if procrustes is None:
+            self.logic.warningMessage("Please check fiducial lists sharing at least three landmarks.")
+            return
+        self.logic.createAlignedFidLists(fidLists, procrustes)
+        tableNode = self.logic.updateProcrustesTable(fidLists, procrustes)
+        slicer.util.showStatusMessage(f'{len(fidLists)} fiducial lists aligned, Procrustes distances written to '
+                                      f'{tableNode.GetName()}', 3000)
+
+    def onTrackLandmarksClicked(self):
+        timepoints = self.timepointsSequenceSelector.currentNode() or self.timepointsSelector.checkedNodes()
+        # the measurements listed in the result tables are computed at every timepoint
+        protocol = self.logic.protocolFromResults(self.computedDistanceList, self.computedAnglesList,
+                                                  self.computedLinePointList)
+        tracking = self.logic.trackLandmarks(timepoints, protocol)
+        if tracking is None:
+            self.logic.warningMessage("Please select timepoints sharing at least one landmark.")
+            return
+        self.logic.updateTrackingTables(tracking)
+        slicer.util.showStatusMessage(f'{len(tracking["labels"])} landmarks tracked over '
+                                      f'{len(tracking["times"])} timepoints', 3000)
+
+    def onRunProtocolClicked(self):
+        fidList = self.logic.selectedFidList
+        if not fidList:
+            self.logic.warningMessage("Please connect a fiducial list to a model.")
+            return
+        filename = qt.QFileDialog.getOpenFileName(
+            None, 'Select File', self.resourcePath('Data'), 'Measurement protocols (*.json *.yml *.yaml)')
+        if filename == '':
+            # User canceled the file selection dialog.
+            return
+        protocol = self.logic.load_measurement_protocol(filename)
+        if protocol is None:
+            return
+        results = self.logic.runMeasurementProtocol(protocol, fidList)
+        compiledProtocol = results["compiledProtocol"]
+        if compiledProtocol.missingLabels:
+            self.logic.warningMessage('The measurements using these landmarks were skipped, they are not in '
+                                      + fidList.GetName() + ': ' + ', '.join(sorted(compiledProtocol.missingLabels)))
+        if len(compiledProtocol.distances):
+            self.updateDistanceTable(lambda distanceList: self.logic.addProtocolResults(
+                results, distanceList=distanceList)[0])
+        if len(compiledProtocol.angles):
+            self.updateAnglesTable(lambda angleList: self.logic.addProtocolResults(
+                results, angleList=angleList)[1])
+        if len(compiledProtocol.linePoints):
+            self.updateLinePointTable(lambda linePointList: self.logic.addProtocolResults(
+                results, linePointList=linePointList)[2])
+
 
 class Q3DCLogic(ScriptedLoadableModuleLogic):
     def __init__(self, interface):
@@ -668,9 +989,69 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         self.selectedModel = None
         self.selectedFidList = None
         self.numberOfDecimals = 3
+        # Monte-Carlo landmark placement uncertainty, disabled when the
+        # standard deviation (mm) is 0
+        self.uncertaintySigma = 0.0
+        self.uncertaintySamples = 2000
+        self.uncertaintyConfidence = 0.95
+        self.uncertaintyOnSurface = True
+        self.uncertaintyGenerator = np.random.default_rng()
         system = qt.QLocale().system()
         self.decimalPoint = chr(system.decimalPoint())
         self.comboboxdict = dict()
+        # IDs of the fiducial lists whose point observers are suspended
+        self.suspendedFidListIDs = set()
+        # markups node ID -> [version, snapshot, observer tags]
+        self.markupsSnapshots = dict()
+        # harden model ID -> surfaceIndex
+        self.surfaceIndexes = dict()
+        # hardened copies of the models, shared by the fiducial lists
+        self.hardenModels = self.hardenModelCache(self, memoryBudget=2 * 1024**3)
+        # modelPreparationWorker of the selected model, while it runs
+        self.modelPreparation = None
+        # IDs of the fiducial lists whose compact landmark table is outdated
+        self.pendingLandmarkTables = set()
+        self.landmarkTableTimer = qt.QTimer()
+        self.landmarkTableTimer.setSingleShot(True)
+        self.landmarkTableTimer.setInterval(1000)
+        self.landmarkTableTimer.connect('timeout()', self.updatePendingLandmarkTables)
+        # fiducial list ID -> landmarkDescription attribute removed while the scene is saved
+        self.savedLandmarkDescriptions = dict()
+        # follow the mesh from the previous closest point while dragging
+        self.incrementalProjection = True
+        # project on the closest point of the triangles instead of the closest vertex
+        self.subVertexProjection = False
+        # surfaces with more points are dragged on a decimated copy
+        self.multiResolutionPointThreshold = 500000
+        self.multiResolutionTargetReduction = 0.9
+        # harden model ID -> multiResolutionSurfaceIndex
+        self.multiResolutionIndexes = dict()
+        # harden model ID -> multiResolutionWorker building its index
+        self.multiResolutionWorkers = dict()
+        # IDs of the fiducial lists being dragged in a view
+        self.interactingFidListIDs = set()
+        # fiducial list ID -> IDs of the landmarks only projected on the coarse surface
+        self.coarselyProjectedLandmarks = defaultdict(set)
+        # fiducial list ID -> (ID of the unlocked landmark, IDs of the landmarks
+        # of the list), kept up to date by trackLandmarkLocks
+        self.lockStates = dict()
+        # fiducial list ID -> IDs of the landmarks added since UpdateThreeDView locked them
+        self.pendingLocks = defaultdict(set)
+        # ID of the list whose selected landmark is unlocked
+        self.unlockedFidListID = None
+        # fiducial list ID -> landmarkItemModel shared by the landmark comboboxes
+        self.landmarkItemModels = dict()
+        self.emptyLandmarkModel = None
+        # fiducial list ID -> markupsEventDispatcher
+        self.markupsDispatchers = dict()
+        # stamps given to the landmark positions, increasing for the whole session
+        self.positionStampCounter = itertools.count(1)
+        # results of the measurements, reused while their landmarks do not move
+        self.measurements = self.measurementCache(maxEntries=20000)
+        # exports running in the background
+        self.exportWorkers = set()
+        # (fiducial list ID, plane name) -> leastSquaresPlane
+        self.planes = dict()
 
     @staticmethod
     def load_suggested_landmarks(filepath):
@@ -697,6 +1078,33 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             logging.info('User attempted to open a landmark legend file.\n' + repr(e))
             return None
 
+    @staticmethod
+    def load_measurement_protocol(filepath):
+        '''
+        Read a measurement protocol from a JSON or YAML file, see
+        measurementProtocol for the format.
+        '''
+        try:
+            with open(filepath, encoding='utf8') as protocol_file:
+                if os.path.splitext(filepath)[1].lower() in ('.yml', '.yaml'):
+                    import yaml
+                    description = yaml.safe_load(protocol_file)
+                else:
+                    description = json.load(protocol_file)
+            return Q3DCLogic.measurementProtocol(description)
+        except ImportError as e:
+            slicer.util.delayDisplay('Reading YAML protocols requires the PyYAML package.')
+            logging.info('User attempted to open a measurement protocol.\n' + repr(e))
+            return None
+        except OSError as e:
+            slicer.util.delayDisplay('Unable to find/open file.')
+            logging.info('User attempted to open a measurement protocol.\n' + repr(e))
+            return None
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            slicer.util.delayDisplay('The selected file is not a valid measurement protocol.')
+            logging.info('User attempted to open a measurement protocol.\n' + repr(e))
+            return None
+
     def initComboboxdict(self):
         self.comboboxdict[self.interface.landmarkComboBoxA] = None
         self.comboboxdict[self.interface.landmarkComboBoxB] = None
@@ -718,6 +1126,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             self.APComponent = None
             self.SIComponent = None
             self.ThreeDComponent = None
+            # value attribute -> (lower, upper) bounds of its confidence interval
+            self.confidenceIntervals = None
 
     class angleValuesStorage(object):
         def __init__(self):
@@ -732,6 +1142,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             self.Pitch = None
             self.Roll = None
             self.Yaw = None
+            # value attribute -> (lower, upper) bounds of its confidence interval
+            self.confidenceIntervals = None
 
     class distanceLinePointStorage(object):
         def __init__(self):
@@ -745,6 +1157,509 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             self.APComponent = None
             self.SIComponent = None
             self.ThreeDComponent = None
+            # value attribute -> (lower, upper) bounds of its confidence interval
+            self.confidenceIntervals = None
+
+    class markupsSnapshot(object):
+        """Positions, IDs, labels and selected flags of all the control points
+        of a markups node, read from the node in a single pass.
+
+        The arrays are read-only: use setMarkupsPositions or
+        setLandmarkPositions to move control points.
+        """
+        def __init__(self, markupsNode, version=None, stamp=0, previous=None):
+            self.version = version
+            points = vtk.vtkPoints()
+            points.SetDataTypeToDouble()
+            markupsNode.GetControlPointPositionsWorld(points)
+            self.positions = numpy_support.vtk_to_numpy(points.GetData()).reshape((-1, 3)).copy()
+            numOfMarkups = markupsNode.GetNumberOfControlPoints()
+            self.ids = np.array([markupsNode.GetNthControlPointID(n) for n in range(numOfMarkups)], dtype=object)
+            self.labels = np.array([markupsNode.GetNthControlPointLabel(n) for n in range(numOfMarkups)], dtype=object)
+            self.selected = np.array([markupsNode.GetNthControlPointSelected(n) for n in range(numOfMarkups)], dtype=bool)
+            for array in (self.positions, self.ids, self.labels, self.selected):
+                array.flags.writeable = False
+            self.indexFromID = {markupID: n for n, markupID in enumerate(self.ids)}
+            self.indexFromLabel = dict()
+            for n, label in enumerate(self.labels):
+                self.indexFromLabel.setdefault(label, n)
+            # The stamp of a landmark changes only when its position changes:
+            # landmarks that did not move since the previous snapshot keep
+            # their stamp, the others get the stamp of this snapshot.
+            self.positionStamps = np.full(numOfMarkups, stamp, dtype=np.int64)
+            if previous is not None and numOfMarkups:
+                previousIndices = np.array([previous.indexFromID.get(markupID, -1) for markupID in self.ids])
+                known = np.flatnonzero(previousIndices >= 0)
+                unmoved = known[np.all(previous.positions[previousIndices[known]] == self.positions[known], axis=1)]
+                self.positionStamps[unmoved] = previous.positionStamps[previousIndices[unmoved]]
+            self.positionStamps.flags.writeable = False
+
+        def positionStamp(self, markupID):
+            return int(self.positionStamps[self.indexFromID[markupID]])
+
+        def positionsFromIDs(self, markupIDs):
+            return self.positions[[self.indexFromID[markupID] for markupID in markupIDs]]
+
+    def getMarkupsSnapshot(self, markupsNode):
+        """Return a snapshot of markupsNode, only re-reading the node when it
+        has been modified since the last snapshot was taken.
+        """
+        nodeID = markupsNode.GetID()
+        if not nodeID:
+            # Nodes outside of the scene are not tracked, read them directly.
+            return self.markupsSnapshot(markupsNode, stamp=next(self.positionStampCounter))
+        entry = self.markupsSnapshots.get(nodeID)
+        if entry is None or entry["node"] is not markupsNode:
+            if entry is not None:
+                self.releaseMarkupsSnapshot(nodeID)
+            entry = {"node": markupsNode, "version": 0, "snapshot": None}
+            entry["tags"] = self.observeMarkupsVersion(markupsNode, entry)
+            self.markupsSnapshots[nodeID] = entry
+        if entry["snapshot"] is None or entry["snapshot"].version != entry["version"]:
+            entry["snapshot"] = self.markupsSnapshot(markupsNode, entry["version"],
+                                                     stamp=next(self.positionStampCounter),
+                                                     previous=entry["snapshot"])
+        return entry["snapshot"]
+
+    def observeMarkupsVersion(self, markupsNode, entry):
+        # Control point events do not update the node MTime, so the version of
+        # the snapshot is bumped by observers with a high priority: they run
+        # before any other callback that could read the snapshot.
+        def bumpVersion(obj, event):
+            entry["version"] += 1
+        events = (markupsNode.PointAddedEvent,
+                  markupsNode.PointRemovedEvent,
+                  markupsNode.PointModifiedEvent,
+                  vtk.vtkCommand.ModifiedEvent)
+        return [markupsNode.AddObserver(event, bumpVersion, 100.0) for event in events]
+
+    def releaseMarkupsSnapshot(self, nodeID):
+        entry = self.markupsSnapshots.pop(nodeID, None)
+        if entry is None:
+            return
+        for tag in entry["tags"]:
+            entry["node"].RemoveObserver(tag)
+
+    def releaseAllMarkupsSnapshots(self):
+        for nodeID in list(self.markupsSnapshots.keys()):
+            self.releaseMarkupsSnapshot(nodeID)
+
+    class surfaceIndex(object):
+        """Points of a surface and a kd-tree over them, used to find the
+        closest vertex of many positions in a single query."""
+        def __init__(self, polyData, points=None, kdtree=None, adjacency=None):
+            # points, kdtree and adjacency may have been prepared in the
+            # background by a modelPreparationWorker
+            self.polyData = polyData
+            self.mtime = polyData.GetMTime()
+            if points is None:
+                points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+            self.points = points
+            self.kdtree = scipy.spatial.cKDTree(self.points) if kdtree is None else kdtree
+            # compressed adjacency of the mesh vertices, built on first use
+            self.neighbors, self.neighborOffsets = (None, None) if adjacency is None else adjacency
+            # cell locator for the sub-vertex projection, built on first use
+            self.cellLocator = None
+            # normals of the vertices, computed on first use
+            self.normals = None
+
+        def closestPointIndices(self, positions):
+            distances, indices = self.kdtree.query(np.asarray(positions, dtype=np.float64).reshape((-1, 3)))
+            return indices
+
+        def memorySize(self):
+            # The kd-tree stores a copy of the points and a permutation of them.
+            size = 2 * self.points.nbytes + self.points.shape[0] * np.dtype(np.intp).itemsize
+            if self.neighbors is not None:
+                size += self.neighbors.nbytes + self.neighborOffsets.nbytes
+            if self.normals is not None:
+                size += self.normals.nbytes
+            return size
+
+        def pointNormals(self):
+            if self.normals is None:
+                normalsFilter = vtk.vtkPolyDataNormals()
+                normalsFilter.SetInputData(self.polyData)
+                normalsFilter.ComputePointNormalsOn()
+                normalsFilter.ComputeCellNormalsOff()
+                # keep one normal per point of the surface
+                normalsFilter.SplittingOff()
+                # point the normals outward whatever the winding of the
+                # triangles, e.g. for surfaces made from segmentations; this
+                # is only reliable for closed surfaces
+                normalsFilter.ConsistencyOn()
+                normalsFilter.AutoOrientNormalsOn()
+                normalsFilter.Update()
+                self.normals = numpy_support.vtk_to_numpy(
+                    normalsFilter.GetOutput().GetPointData().GetNormals()).astype(np.float64)
+            return self.normals
+
+        def closestSurfacePoints(self, positions):
+            """Return the closest points on the triangles of the surface, the
+            closest vertex of each of them and their cell projections: the
+            cell ID, the IDs of the points of the cell and the barycentric
+            weights of the closest point in the cell."""
+            positions = np.asarray(positions, dtype=np.float64).reshape((-1, 3))
+            if self.cellLocator is None:
+                self.cellLocator = vtk.vtkStaticCellLocator()
+                self.cellLocator.SetDataSet(self.polyData)
+                self.cellLocator.BuildLocator()
+            cell = vtk.vtkGenericCell()
+            pointIDList = vtk.vtkIdList()
+            closestPoints = []
+            cellIDs = []
+            cellPointIDs = []
+            for position in positions:
+                closestPoint = [0.0, 0.0, 0.0]
+                cellID = vtk.reference(0)
+                subID = vtk.reference(0)
+                dist2 = vtk.reference(0.0)
+                self.cellLocator.FindClosestPoint(position, closestPoint, cell, cellID, subID, dist2)
+                self.polyData.GetCellPoints(int(cellID), pointIDList)
+                pointIDs = [pointIDList.GetId(n) for n in range(pointIDList.GetNumberOfIds())]
+                if len(pointIDs) != 3:
+                    # Only triangles are interpolated, snap on the closest vertex of other cells.
+                    distances2 = np.sum((self.points[pointIDs] - position)**2, axis=1)
+                    pointIDs = [pointIDs[distances2.argmin()]] * 3
+                closestPoints.append(closestPoint)
+                cellIDs.append(int(cellID))
+                cellPointIDs.append(pointIDs)
+            cellPointIDs = np.array(cellPointIDs, dtype=np.int64).reshape((-1, 3))
+            weights = self.barycentricWeights(self.points[cellPointIDs],
+                                              np.array(closestPoints, dtype=np.float64).reshape((-1, 3)))
+            closestPoints = np.einsum('nk,nkd->nd', weights, self.points[cellPointIDs])
+            closestPointIndices = cellPointIDs[np.arange(len(cellPointIDs)), weights.argmax(axis=1)]
+            cellProjections = list(zip(cellIDs, cellPointIDs.tolist(), weights.tolist()))
+            return closestPoints, closestPointIndices.tolist(), cellProjections
+
+        @staticmethod
+        def barycentricWeights(triangles, positions):
+            # Barycentric coordinates of positions lying on their triangles,
+            # clamped to guard against rounding errors on the edges.
+            a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+            v0, v1, v2 = b - a, c - a, positions - a
+            d00 = np.sum(v0 * v0, axis=1)
+            d01 = np.sum(v0 * v1, axis=1)
+            d11 = np.sum(v1 * v1, axis=1)
+            d20 = np.sum(v2 * v0, axis=1)
+            d21 = np.sum(v2 * v1, axis=1)
+            denominator = d00 * d11 - d01 * d01
+            degenerate = denominator == 0
+            denominator[degenerate] = 1
+            v = (d11 * d20 - d01 * d21) / denominator
+            w = (d00 * d21 - d01 * d20) / denominator
+            weights = np.clip(np.stack((1 - v - w, v, w), axis=1), 0, None)
+            weights[degenerate] = [1, 0, 0]
+            return weights / weights.sum(axis=1)[:, np.newaxis]
+
+        def evaluateCellProjections(self, cellPointIDs, weights):
+            """Positions of stored cell projections on the current points of
+            the surface, e.g. after the model was transformed."""
+            cellPointIDs = np.asarray(cellPointIDs, dtype=np.int64).reshape((-1, 3))
+            weights = np.asarray(weights, dtype=np.float64).reshape((-1, 3))
+            return np.einsum('nk,nkd->nd', weights, self.points[cellPointIDs])
+
+        def buildAdjacency(self):
+            polys = self.polyData.GetPolys()
+            self.neighbors, self.neighborOffsets = self.adjacency(
+                numpy_support.vtk_to_numpy(polys.GetConnectivityArray()),
+                numpy_support.vtk_to_numpy(polys.GetOffsetsArray()), len(self.points))
+
+        @staticmethod
+        def adjacency(connectivity, cellOffsets, numberOfPoints):
+            # Edges of the polygons: each vertex is linked to the next one of
+            # its cell, the last vertex of a cell being linked to the first.
+            # Return the neighbors of all the vertices and the offsets of the
+            # neighbors of each vertex.
+            connectivity = connectivity.astype(np.int64)
+            cellOffsets = cellOffsets.astype(np.int64)
+            nextInCell = np.arange(1, len(connectivity) + 1)
+            nonEmpty = np.diff(cellOffsets) > 0
+            nextInCell[cellOffsets[1:][nonEmpty] - 1] = cellOffsets[:-1][nonEmpty]
+            edgeStart = np.concatenate((connectivity, connectivity[nextInCell]))
+            edgeEnd = np.concatenate((connectivity[nextInCell], connectivity))
+            order = np.lexsort((edgeEnd, edgeStart))
+            edgeStart, edgeEnd = edgeStart[order], edgeEnd[order]
+            unique = np.ones(len(edgeStart), dtype=bool)
+            unique[1:] = (edgeStart[1:] != edgeStart[:-1]) | (edgeEnd[1:] != edgeEnd[:-1])
+            return edgeEnd[unique], np.searchsorted(edgeStart[unique], np.arange(numberOfPoints + 1))
+
+        def walkToClosestPoint(self, position, startIndex, maxSteps=500):
+            """Greedily follow the mesh edges from startIndex toward position.
+
+            The local minimum where the walk stops is checked with a kd-tree
+            query bounded by its distance, so a closer vertex across a thin
+            or folded part of the surface is returned instead. Return None
+            when the walk takes more than maxSteps steps.
+            """
+            if self.neighbors is None:
+                self.buildAdjacency()
+            current = startIndex
+            currentDistance2 = np.sum((self.points[current] - position)**2)
+            for step in range(maxSteps):
+                candidates = self.neighbors[self.neighborOffsets[current]:self.neighborOffsets[current + 1]]
+                if len(candidates) == 0:
+                    return None
+                distances2 = np.sum((self.points[candidates] - position)**2, axis=1)
+                best = distances2.argmin()
+                if distances2[best] >= currentDistance2:
+                    distance, closest = self.kdtree.query(position, distance_upper_bound=np.sqrt(currentDistance2))
+                    return closest if closest < len(self.points) and distance ** 2 < currentDistance2 else current
+                current, currentDistance2 = candidates[best], distances2[best]
+            return None
+
+    class multiResolutionSurfaceIndex(object):
+        """Decimated copy of a large surface used while dragging, and the
+        partition of the full resolution points in patches around the coarse
+        points, used to refine a coarse projection locally."""
+        def __init__(self, polyData, targetReduction):
+            self.polyData = polyData
+            self.mtime = polyData.GetMTime()
+            decimate = vtk.vtkDecimatePro()
+            decimate.SetInputData(polyData)
+            decimate.SetTargetReduction(targetReduction)
+            decimate.PreserveTopologyOn()
+            decimate.Update()
+            self.coarse = Q3DCLogic.surfaceIndex(decimate.GetOutput())
+            self.finePoints = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+            distances, patchOfFinePoint = self.coarse.kdtree.query(self.finePoints)
+            self.patchMembers = np.argsort(patchOfFinePoint, kind='stable')
+            self.patchOffsets = np.searchsorted(patchOfFinePoint[self.patchMembers],
+                                                np.arange(len(self.coarse.points) + 1))
+            # vtkDecimatePro keeps a subset of the input points, so each coarse
+            # point is also a point of the full resolution surface.
+            self.fineFromCoarse = np.empty(len(self.coarse.points), dtype=np.int64)
+            self.fineFromCoarse[patchOfFinePoint[distances == 0]] = np.flatnonzero(distances == 0)
+            missing = np.ones(len(self.coarse.points), dtype=bool)
+            missing[patchOfFinePoint[distances == 0]] = False
+            for coarseIndex in np.flatnonzero(missing):
+                self.fineFromCoarse[coarseIndex] = self.refine(self.coarse.points[coarseIndex], coarseIndex)
+
+        def memorySize(self):
+            return (self.coarse.memorySize() + self.finePoints.nbytes + self.patchMembers.nbytes
+                    + self.patchOffsets.nbytes + self.fineFromCoarse.nbytes)
+
+        def coarseClosestPointIndex(self, position):
+            """Closest point of the coarse surface, as an index of the full
+            resolution surface."""
+            return int(self.fineFromCoarse[self.coarse.closestPointIndices(position)[0]])
+
+        def refine(self, position, coarseIndex=None):
+            """Closest full resolution point, searched in the patches of the
+            closest coarse point and of its neighbors."""
+            if coarseIndex is None:
+                coarseIndex = self.coarse.closestPointIndices(position)[0]
+            if self.coarse.neighbors is None:
+                self.coarse.buildAdjacency()
+            ring = self.coarse.neighbors[self.coarse.neighborOffsets[coarseIndex]:
+                                         self.coarse.neighborOffsets[coarseIndex + 1]]
+            members = np.concatenate([self.patchMembers[self.patchOffsets[patch]:self.patchOffsets[patch + 1]]
+                                      for patch in np.append(ring, coarseIndex)])
+            distances2 = np.sum((self.finePoints[members] - position)**2, axis=1)
+            return int(members[distances2.argmin()])
+
+    class multiResolutionWorker(object):
+        """Build the multiResolutionSurfaceIndex of a hardened model from a
+        background thread.
+
+        The thread works on a shallow copy of the surface taken on the main
+        thread. Like modelPreparationWorker, a timer on the main thread polls
+        it and calls onFinished(worker) once it is done. The decimation can
+        not be interrupted, a cancelled build is only discarded.
+        """
+        def __init__(self, hardenModelID, polyData, targetReduction, onFinished):
+            self.hardenModelID = hardenModelID
+            self.polyData = polyData
+            self.mtime = polyData.GetMTime()
+            self.surface = vtk.vtkPolyData()
+            self.surface.ShallowCopy(polyData)
+            self.targetReduction = targetReduction
+            self.index = None
+            self.error = None
+            self.cancelled = False
+            self.finished = False
+            self.onFinished = onFinished
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.timer = qt.QTimer()
+            self.timer.setInterval(100)
+            self.timer.connect('timeout()', self.poll)
+
+        def start(self):
+            self.thread.start()
+            self.timer.start()
+
+        def run(self):
+            try:
+                index = Q3DCLogic.multiResolutionSurfaceIndex(self.surface, self.targetReduction)
+                index.coarse.buildAdjacency()
+                self.index = index
+            except Exception as e:
+                self.error = e
+
+        def poll(self):
+            if not self.thread.is_alive():
+                self.finish()
+
+        def finish(self):
+            if self.finished:
+                return
+            self.finished = True
+            self.timer.stop()
+            self.onFinished(self)
+
+        def cancel(self):
+            self.cancelled = True
+            self.finish()
+
+    def getMultiResolutionIndex(self, hardenModel):
+        """Return the multi-resolution index of hardenModel, or None if the
+        model is small enough to be dragged on at full resolution or while
+        its index is built in the background."""
+        polyData = hardenModel.GetPolyData()
+        if polyData is None or polyData.GetNumberOfPoints() < self.multiResolutionPointThreshold:
+            return None
+        index = self.multiResolutionIndexes.get(hardenModel.GetID())
+        if index is None or index.polyData is not polyData or index.mtime != polyData.GetMTime():
+            self.prepareMultiResolutionIndex(hardenModel)
+            return None
+        return index
+
+    def prepareMultiResolutionIndex(self, hardenModel):
+        """Start building the multi-resolution index of hardenModel in the
+        background if it is large enough to need one and it is not built or
+        being built yet."""
+        polyData = hardenModel.GetPolyData()
+        if polyData is None or polyData.GetNumberOfPoints() < self.multiResolutionPointThreshold:
+            return None
+        hardenModelID = hardenModel.GetID()
+        index = self.multiResolutionIndexes.get(hardenModelID)
+        if index is not None and index.polyData is polyData and index.mtime == polyData.GetMTime():
+            return None
+        worker = self.multiResolutionWorkers.get(hardenModelID)
+        if worker is not None:
+            if worker.polyData is polyData and worker.mtime == polyData.GetMTime():
+                return worker
+            worker.cancel()
+        worker = self.multiResolutionWorker(hardenModelID, polyData, self.multiResolutionTargetReduction,
+                                            self.onMultiResolutionIndexBuilt)
+        self.multiResolutionWorkers[hardenModelID] = worker
+        worker.start()
+        return worker
+
+    def onMultiResolutionIndexBuilt(self, worker):
+        if self.multiResolutionWorkers.get(worker.hardenModelID) is worker:
+            del self.multiResolutionWorkers[worker.hardenModelID]
+        if worker.error is not None:
+            logging.info('Q3DC: the coarse surface of %s could not be built: %s'
+                         % (worker.hardenModelID, worker.error))
+        hardenModel = slicer.mrmlScene.GetNodeByID(worker.hardenModelID)
+        # discard the index if the surface changed in the meantime
+        if worker.cancelled or worker.index is None or hardenModel is None \
+                or hardenModel.GetPolyData() is not worker.polyData or worker.polyData.GetMTime() != worker.mtime:
+            return
+        worker.index.polyData = worker.polyData
+        worker.index.mtime = worker.mtime
+        self.multiResolutionIndexes[worker.hardenModelID] = worker.index
+
+    def cancelMultiResolutionIndexes(self, hardenModelID=None):
+        # cancel the background builds (of hardenModelID only if given)
+        for workerID, worker in list(self.multiResolutionWorkers.items()):
+            if hardenModelID is None or workerID == hardenModelID:
+                worker.cancel()
+
+    def refineCoarseProjections(self, fidList):
+        """Project again at full resolution the landmarks of fidList that were
+        only projected on the coarse surface while being dragged."""
+        markupIDs = self.coarselyProjectedLandmarks.pop(fidList.GetID(), set())
+        landmarkDescription = self.getLandmarkDescription(fidList)
+        if not markupIDs or not landmarkDescription:
+            return
+        hardenModel = self.getHardenModel(fidList)
+        multiResolutionIndex = self.getMultiResolutionIndex(hardenModel)
+        if multiResolutionIndex is None:
+            return
+        snapshot = self.getMarkupsSnapshot(fidList)
+        landmarkIndices = []
+        closestPointIndices = []
+        for markupID in markupIDs:
+            if markupID not in snapshot.indexFromID or not landmarkDescription[markupID]["projection"]["isProjected"]:
+                continue
+            landmarkIndex = snapshot.indexFromID[markupID]
+            closestPointIndex = multiResolutionIndex.refine(snapshot.positions[landmarkIndex])
+            self.storeProjections(landmarkDescription, [markupID], [closestPointIndex])
+            landmarkIndices.append(landmarkIndex)
+            closestPointIndices.append(closestPointIndex)
+        self.setLandmarkPositions(fidList, landmarkIndices, multiResolutionIndex.finePoints[closestPointIndices])
+        self.setLandmarkDescription(fidList, landmarkDescription)
+
+    def benchmarkMultiResolutionProjection(self, hardenModel, positions):
+        """Compare the coarse-then-refined projection of positions on
+        hardenModel with the full resolution nearest point snapping.
+        Return the timings per position (in seconds) and the errors (in mm)."""
+        positions = np.asarray(positions, dtype=np.float64).reshape((-1, 3))
+        startTime = time.perf_counter()
+        multiResolutionIndex = self.multiResolutionSurfaceIndex(hardenModel.GetPolyData(),
+                                                                self.multiResolutionTargetReduction)
+        multiResolutionBuildTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        surfaceIndex = self.surfaceIndex(hardenModel.GetPolyData())
+        fullBuildTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        exact = surfaceIndex.closestPointIndices(positions)
+        fullTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        coarse = [multiResolutionIndex.coarseClosestPointIndex(position) for position in positions]
+        coarseTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        refined = [multiResolutionIndex.refine(position) for position in positions]
+        refineTime = time.perf_counter() - startTime
+
+        exactDistances = np.linalg.norm(surfaceIndex.points[exact] - positions, axis=1)
+        coarseErrors = np.linalg.norm(surfaceIndex.points[coarse] - positions, axis=1) - exactDistances
+        refinedErrors = np.linalg.norm(surfaceIndex.points[refined] - positions, axis=1) - exactDistances
+        numberOfPositions = max(len(positions), 1)
+        return {
+            'numberOfPoints': len(surfaceIndex.points),
+            'numberOfCoarsePoints': len(multiResolutionIndex.coarse.points),
+            'fullBuildTime': fullBuildTime,
+            'multiResolutionBuildTime': multiResolutionBuildTime,
+            'fullTimePerPosition': fullTime / numberOfPositions,
+            'coarseTimePerPosition': coarseTime / numberOfPositions,
+            'refineTimePerPosition': refineTime / numberOfPositions,
+            'coarseMeanError': float(np.mean(coarseErrors)) if len(positions) else 0.0,
+            'coarseMaxError': float(np.max(coarseErrors)) if len(positions) else 0.0,
+            'refinedMeanError': float(np.mean(refinedErrors)) if len(positions) else 0.0,
+            'refinedMaxError': float(np.max(refinedErrors)) if len(positions) else 0.0,
+        }
+
+    def getSurfaceIndex(self, hardenModel):
+        """Return the kd-tree over the points of hardenModel, only rebuilding
+        it when the polydata of the model has changed."""
+        polyData = hardenModel.GetPolyData()
+        index = self.surfaceIndexes.get(hardenModel.GetID())
+        if index is None or index.polyData is not polyData or index.mtime != polyData.GetMTime():
+            index = self.surfaceIndex(polyData)
+            self.surfaceIndexes[hardenModel.GetID()] = index
+        return index
+
+    def getLandmarkPosition(self, markupsNode, landmarkIndex):
+        return self.getMarkupsSnapshot(markupsNode).positions[landmarkIndex]
+
+    def setMarkupsPositions(self, markupsNode, positions):
+        """Write the positions of all the control points of markupsNode at once."""
+        positions = np.ascontiguousarray(positions, dtype=np.float64).reshape((-1, 3))
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(positions, deep=True))
+        markupsNode.SetControlPointPositionsWorld(points)
+
+    def setLandmarkPositions(self, markupsNode, landmarkIndices, coords):
+        """Move the control points at landmarkIndices to coords in one batch."""
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        with NodeModify(markupsNode):
+            for landmarkIndex, coord in zip(landmarkIndices, coords):
+                markupsNode.SetNthControlPointPositionWorldFromArray(int(landmarkIndex), coord)
 
     def UpdateThreeDView(self, landmarkLabel):
         # Update the 3D view on Slicer
@@ -752,51 +1667,364 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             return
         if not self.selectedModel:
             return
-        print("UpdateThreeDView")
         active = self.selectedFidList
-        #deactivate all landmarks
-        list = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
-        end = list.GetNumberOfItems()
         selectedFidReflID = self.findIDFromLabel(active,landmarkLabel)
-        for i in range(0,end):
-            fidList = list.GetItemAsObject(i)
-            print(fidList.GetID())
-            landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            if landmarkDescription:
-                for key in landmarkDescription.keys():
-                    markupsIndex = fidList.GetNthControlPointIndexByID(key)
-                    if key != selectedFidReflID:
-                        fidList.SetNthMarkupLocked(markupsIndex, True)
-                    else:
-                        fidList.SetNthMarkupLocked(markupsIndex, False)
-                        fidList.SetNthMarkupLocked(markupsIndex, False)
+        # Only the selected landmark of the active list is unlocked. The lock
+        # state is only written for the landmarks it changes for: the
+        # previously unlocked landmark, the newly unlocked one and the
+        # landmarks added since the previous update (see trackLandmarkLocks),
+        # so only the previous and the new active lists are visited.
+        if active.GetID() not in self.lockStates:
+            # e.g. a list of a loaded scene, whose description was not written yet
+            self.trackLandmarkLocks(active, (self.getLandmarkDescription(active) or {}).keys())
+        fidListIDs = set(self.pendingLocks.keys())
+        fidListIDs.add(active.GetID())
+        if self.unlockedFidListID is not None:
+            fidListIDs.add(self.unlockedFidListID)
+        for fidListID in fidListIDs:
+            fidList = slicer.mrmlScene.GetNodeByID(fidListID)
+            addedIDs = self.pendingLocks.pop(fidListID, set())
+            if fidList is None or fidListID not in self.lockStates:
+                continue
+            previousUnlockedID, markupIDs = self.lockStates[fidListID]
+            unlockedID = selectedFidReflID if fidList is active and selectedFidReflID in markupIDs else None
+            lockChanges = dict((markupID, True) for markupID in addedIDs)
+            if previousUnlockedID != unlockedID and previousUnlockedID in markupIDs:
+                lockChanges[previousUnlockedID] = True
+            if unlockedID is not None and (unlockedID != previousUnlockedID or unlockedID in addedIDs):
+                lockChanges[unlockedID] = False
+            self.lockStates[fidListID] = (unlockedID, markupIDs)
+            if not lockChanges:
+                continue
+            with NodeModify(fidList):
+                for markupID, locked in lockChanges.items():
+                    markupsIndex = fidList.GetNthControlPointIndexByID(markupID)
+                    if markupsIndex >= 0:
+                        fidList.SetNthMarkupLocked(markupsIndex, locked)
+        self.unlockedFidListID = active.GetID() if selectedFidReflID else None
         displayNode = self.selectedModel.GetModelDisplayNode()
         displayNode.SetScalarVisibility(False)
         if selectedFidReflID != False:
             displayNode.SetScalarVisibility(True)
 
-    def createIntermediateHardenModel(self, model):
+    class hardenModelCache(object):
+        """Hardened copies of the models, shared by all the fiducial lists
+        connected to the same model, and the spatial indexes built on them.
+
+        A model is referenced by every fiducial list whose connectedModelID
+        is its ID, and by the selected model. When the footprint of the cache
+        is over memoryBudget (in bytes), the least recently used copies that
+        are not referenced are released.
+        """
+        def __init__(self, logic, memoryBudget):
+            self.logic = logic
+            self.memoryBudget = memoryBudget
+            # model ID -> harden model, least recently used first
+            self.entries = OrderedDict()
+
+        def acquire(self, model, update=False):
+            """Return the hardened copy of model, creating it if needed or
+            if update is True (e.g. the transform of the model changed). A
+            copy being prepared in the background is waited for, unless it is
+            outdated by update."""
+            if update:
+                self.logic.cancelModelPreparation(model)
+            else:
+                self.logic.waitForModelPreparation(model)
+            modelID = model.GetID()
+            hardenModel = self.entries.get(modelID)
+            if hardenModel is None or update or not slicer.mrmlScene.IsNodePresent(hardenModel):
+                if hardenModel is not None:
+                    self.logic.releaseSpatialIndexes(hardenModel.GetID())
+                hardenModel = self.logic.createIntermediateHardenModel(model)
+                self.entries[modelID] = hardenModel
+                model.SetAttribute("hardenModelID", hardenModel.GetID())
+                self.entries.move_to_end(modelID)
+                self.evict(keep=modelID)
+                self.logic.prepareMultiResolutionIndex(hardenModel)
+            else:
+                self.entries.move_to_end(modelID)
+            return hardenModel
+
+        def get(self, model):
+            hardenModel = self.entries.get(model.GetID())
+            if hardenModel is None or not slicer.mrmlScene.IsNodePresent(hardenModel):
+                return None
+            return hardenModel
+
+        def insert(self, model, hardenModel):
+            # hardened copy prepared outside of acquire
+            self.entries[model.GetID()] = hardenModel
+            self.entries.move_to_end(model.GetID())
+            model.SetAttribute("hardenModelID", hardenModel.GetID())
+            self.evict(keep=model.GetID())
+            self.logic.prepareMultiResolutionIndex(hardenModel)
+
+        def referenceCounts(self):
+            counts = defaultdict(int)
+            for fidList in slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode"):
+                connectedModelID = fidList.GetAttribute("connectedModelID")
+                if connectedModelID:
+                    counts[connectedModelID] += 1
+            if self.logic.selectedModel:
+                counts[self.logic.selectedModel.GetID()] += 1
+            return counts
+
+        def footprint(self):
+            """Memory used by the hardened copies and their spatial indexes, in bytes."""
+            return sum(self.entryFootprint(hardenModel) for hardenModel in self.entries.values())
+
+        def entryFootprint(self, hardenModel):
+            size = 0
+            polyData = hardenModel.GetPolyData()
+            if polyData:
+                size += polyData.GetActualMemorySize() * 1024
+            return size + self.logic.spatialIndexesFootprint(hardenModel.GetID())
+
+        def evict(self, keep=None):
+            # keep: ID of the model whose copy is being returned, never released
+            footprint = self.footprint()
+            if footprint <= self.memoryBudget:
+                return
+            counts = self.referenceCounts()
+            for modelID, hardenModel in list(self.entries.items()):
+                if footprint <= self.memoryBudget:
+                    break
+                if counts[modelID] == 0 and modelID != keep:
+                    footprint -= self.entryFootprint(hardenModel)
+                    self.release(modelID)
+            logging.info('Q3DC hardened model cache: %.1f MB used, budget %.1f MB'
+                         % (footprint / 1024**2, self.memoryBudget / 1024**2))
+
+        def releaseIfUnreferenced(self, modelID):
+            # release a copy acquired for a one-off computation
+            if self.referenceCounts()[modelID] == 0:
+                self.release(modelID)
+
+        def release(self, modelID):
+            hardenModel = self.entries.pop(modelID, None)
+            if hardenModel is None:
+                return
+            self.logic.releaseSpatialIndexes(hardenModel.GetID())
+            if slicer.mrmlScene.IsNodePresent(hardenModel):
+                slicer.mrmlScene.RemoveNode(hardenModel)
+
+        def clear(self):
+            for modelID in list(self.entries.keys()):
+                self.release(modelID)
+
+    class modelPreparationWorker(object):
+        """Prepare the hardened points, the kd-tree and the adjacency of a
+        model from a background thread.
+
+        The inputs are read on the main thread: the points, normals and
+        polygons of the model and the matrix of its linear transform to world
+        (None without transform). The thread only works on these arrays and
+        checks cancelEvent between its steps. A timer on the main thread
+        polls it and calls onFinished(worker) once it is done.
+        """
+        numberOfSteps = 3
+
+        def __init__(self, model, matrix, onFinished):
+            self.model = model
+            self.polyData = model.GetPolyData()
+            self.mtime = self.polyData.GetMTime()
+            self.matrix = matrix
+            self.sourcePoints = numpy_support.vtk_to_numpy(self.polyData.GetPoints().GetData())
+            normals = self.polyData.GetPointData().GetNormals()
+            self.sourceNormals = None
+            if normals is not None and matrix is not None:
+                self.normalsName = normals.GetName()
+                self.sourceNormals = numpy_support.vtk_to_numpy(normals)
+            polys = self.polyData.GetPolys()
+            self.connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+            self.cellOffsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+            self.step = 0
+            self.points = None
+            self.normals = None
+            self.kdtree = None
+            self.adjacency = None
+            self.error = None
+            self.finished = False
+            self.onFinished = onFinished
+            self.cancelEvent = threading.Event()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.timer = qt.QTimer()
+            self.timer.setInterval(100)
+            self.timer.connect('timeout()', self.poll)
+
+        def start(self):
+            self.thread.start()
+            self.timer.start()
+
+        def run(self):
+            try:
+                points = self.sourcePoints.astype(np.float64)
+                if self.matrix is not None:
+                    points = points.dot(self.matrix[:3, :3].T) + self.matrix[:3, 3]
+                    if self.sourceNormals is not None:
+                        # normals follow the inverse transpose of the transform
+                        normals = self.sourceNormals.dot(np.linalg.inv(self.matrix[:3, :3]))
+                        norms = np.linalg.norm(normals, axis=1)[:, np.newaxis]
+                        self.normals = np.divide(normals, norms, out=np.zeros(normals.shape), where=norms != 0)
+                self.points = points
+                self.step = 1
+                if self.cancelEvent.is_set():
+                    return
+                self.kdtree = scipy.spatial.cKDTree(points)
+                self.step = 2
+                if self.cancelEvent.is_set():
+                    return
+                if len(self.connectivity):
+                    self.adjacency = Q3DCLogic.surfaceIndex.adjacency(self.connectivity, self.cellOffsets,
+                                                                      len(points))
+                self.step = 3
+            except Exception as e:
+                self.error = e
+
+        def poll(self):
+            if not self.thread.is_alive():
+                self.finish()
+
+        def finish(self):
+            if self.finished:
+                return
+            self.finished = True
+            self.timer.stop()
+            self.onFinished(self)
+
+        def cancel(self):
+            self.cancelEvent.set()
+
+        def isComplete(self):
+            return not self.cancelEvent.is_set() and self.error is None and self.step == self.numberOfSteps
+
+    def prepareModel(self, model):
+        """Start preparing the hardened copy of model and its spatial index
+        in the background, cancelling the preparation of the previous model.
+        Models under a non-linear transform are hardened right away."""
+        self.cancelModelPreparation()
+        polyData = model.GetPolyData()
+        if self.hardenModels.get(model) is not None or polyData is None or polyData.GetPoints() is None:
+            self.hardenModels.acquire(model)
+            return None
+        matrix = None
+        transformNode = model.GetParentTransformNode()
+        if transformNode:
+            if not transformNode.IsTransformToWorldLinear():
+                self.hardenModels.acquire(model)
+                return None
+            vtkMatrix = vtk.vtkMatrix4x4()
+            transformNode.GetMatrixTransformToWorld(vtkMatrix)
+            matrix = slicer.util.arrayFromVTKMatrix(vtkMatrix)
+        worker = self.modelPreparationWorker(model, matrix, self.onModelPrepared)
+        self.modelPreparation = worker
+        slicer.util.showStatusMessage('Preparing ' + model.GetName() + '...')
+        worker.start()
+        return worker
+
+    def onModelPrepared(self, worker):
+        if self.modelPreparation is worker:
+            self.modelPreparation = None
+        model = worker.model
+        if worker.error is not None:
+            logging.info('Q3DC: the preparation of %s failed: %s' % (model.GetName(), worker.error))
+        # discard the preparation if the model changed in the meantime
+        if not worker.isComplete() or not slicer.mrmlScene.IsNodePresent(model) \
+                or model.GetPolyData() is not worker.polyData or worker.polyData.GetMTime() != worker.mtime \
+                or self.hardenModels.get(model) is not None:
+            return
+        hardenModel = self.createIntermediateHardenModel(model, worker.points, worker.normals)
+        if worker.normals is not None:
+            hardenModel.GetPolyData().GetPointData().GetNormals().SetName(worker.normalsName)
+        self.surfaceIndexes[hardenModel.GetID()] = self.surfaceIndex(hardenModel.GetPolyData(), worker.points,
+                                                                     worker.kdtree, worker.adjacency)
+        self.hardenModels.insert(model, hardenModel)
+        slicer.util.showStatusMessage(model.GetName() + ' is ready', 2000)
+
+    def waitForModelPreparation(self, model):
+        """Wait for the background preparation of model, if any, showing
+        its progress. The preparation is cancelled if the wait is."""
+        worker = self.modelPreparation
+        if worker is None or worker.model is not model:
+            return
+        if worker.thread.is_alive():
+            progress = qt.QProgressDialog('Preparing ' + model.GetName() + '...', 'Cancel', 0,
+                                          worker.numberOfSteps, slicer.util.mainWindow())
+            progress.setWindowModality(qt.Qt.WindowModal)
+            progress.setMinimumDuration(500)
+            while worker.thread.is_alive() and not progress.wasCanceled:
+                progress.setValue(worker.step)
+                slicer.app.processEvents()
+                worker.thread.join(0.05)
+            if progress.wasCanceled:
+                worker.cancel()
+            progress.close()
+        worker.finish()
+
+    def cancelModelPreparation(self, model=None):
+        # cancel the background preparation of model (of any model by default)
+        worker = self.modelPreparation
+        if worker is not None and (model is None or worker.model is model):
+            worker.cancel()
+            worker.finish()
+
+    def getHardenModel(self, fidList):
+        """Return the hardened copy of the model fidList is connected to."""
+        model = slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("connectedModelID"))
+        if model is None:
+            return None
+        hardenModel = self.hardenModels.acquire(model)
+        if fidList.GetAttribute("hardenModelID") != hardenModel.GetID():
+            fidList.SetAttribute("hardenModelID", hardenModel.GetID())
+        return hardenModel
+
+    def releaseSpatialIndexes(self, hardenModelID):
+        self.surfaceIndexes.pop(hardenModelID, None)
+        self.multiResolutionIndexes.pop(hardenModelID, None)
+        self.cancelMultiResolutionIndexes(hardenModelID)
+
+    def spatialIndexesFootprint(self, hardenModelID):
+        size = 0
+        for indexes in (self.surfaceIndexes, self.multiResolutionIndexes):
+            index = indexes.get(hardenModelID)
+            if index is not None:
+                size += index.memorySize()
+        return size
+
+    def createIntermediateHardenModel(self, model, points=None, normals=None):
+        # points (and normals) are the hardened ones if they were prepared by
+        # a modelPreparationWorker
         hardenModel = slicer.mrmlScene.GetNodesByName("SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(
             slicer.app.applicationPid())).GetItemAsObject(0)
         if hardenModel is None:
             hardenModel = slicer.vtkMRMLModelNode()
         hardenPolyData = vtk.vtkPolyData()
-        hardenPolyData.DeepCopy(model.GetPolyData())
+        if points is None:
+            hardenPolyData.DeepCopy(model.GetPolyData())
+        else:
+            hardenPolyData.ShallowCopy(model.GetPolyData())
+            hardenPoints = vtk.vtkPoints()
+            hardenPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+            hardenPolyData.SetPoints(hardenPoints)
+            if normals is not None:
+                hardenPolyData.GetPointData().SetNormals(numpy_support.numpy_to_vtk(normals, deep=True))
         hardenModel.SetAndObservePolyData(hardenPolyData)
         hardenModel.SetName(
             "SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(slicer.app.applicationPid()))
-        if model.GetParentTransformNode():
+        if points is None and model.GetParentTransformNode():
             hardenModel.SetAndObserveTransformNodeID(model.GetParentTransformNode().GetID())
         hardenModel.HideFromEditorsOn()
         slicer.mrmlScene.AddNode(hardenModel)
-        logic = slicer.vtkSlicerTransformLogic()
-        logic.hardenTransform(hardenModel)
+        if points is None:
+            logic = slicer.vtkSlicerTransformLogic()
+            logic.hardenTransform(hardenModel)
         return hardenModel
 
     def onModelModified(self, obj, event):
         #recompute the harden model
-        hardenModel = self.createIntermediateHardenModel(obj)
-        obj.SetAttribute("hardenModelID",hardenModel.GetID())
+        hardenModel = self.hardenModels.acquire(obj, update=True)
         # for each fiducial list
         list = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
         end = list.GetNumberOfItems()
@@ -808,28 +2036,38 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                     #replace the harden model with the new one
                     fidList.SetAttribute("hardenModelID",hardenModel.GetID())
                     #reproject the fiducials on the new model
-                    landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-                    for n in range(fidList.GetNumberOfMarkups()):
-                        markupID = fidList.GetNthMarkupID(n)
-                        if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-                            markupsIndex = fidList.GetNthControlPointIndexByID(markupID)
-                            self.replaceLandmark(hardenModel.GetPolyData(), fidList, markupsIndex,
-                                                 landmarkDescription[markupID]["projection"]["closestPointIndex"])
-                        fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                    landmarkDescription = self.getLandmarkDescription(fidList)
+                    snapshot = self.getMarkupsSnapshot(fidList)
+                    surfaceIndex = self.getSurfaceIndex(hardenModel)
+                    vertexIndices, closestPointIndices = [], []
+                    cellIndices, cellPointIDs, weights = [], [], []
+                    for markupID, landmarkState in landmarkDescription.items():
+                        projection = landmarkState["projection"]
+                        if not projection["isProjected"] or projection["closestPointIndex"] is None:
+                            continue
+                        if "cellPointIDs" in projection:
+                            cellIndices.append(snapshot.indexFromID[markupID])
+                            cellPointIDs.append(projection["cellPointIDs"])
+                            weights.append(projection["weights"])
+                        else:
+                            vertexIndices.append(snapshot.indexFromID[markupID])
+                            closestPointIndices.append(projection["closestPointIndex"])
+                    self.setLandmarkPositions(fidList, vertexIndices + cellIndices, np.concatenate((
+                        surfaceIndex.points[closestPointIndices].reshape((-1, 3)),
+                        surfaceIndex.evaluateCellProjections(cellPointIDs, weights))))
 
     def ModelChanged(self, inputModelSelector, inputLandmarksSelector):
         inputModel = inputModelSelector.currentNode()
         # if a Model Node is present
         if inputModel:
             self.selectedModel = inputModel
-            hardenModel = self.createIntermediateHardenModel(inputModel)
-            inputModel.SetAttribute("hardenModelID",hardenModel.GetID())
+            self.prepareModel(inputModel)
             modelModifieTagEvent = inputModel.AddObserver(inputModel.TransformModifiedEvent, self.onModelModified)
             inputModel.SetAttribute("modelModifieTagEvent",self.encodeJSON({'modelModifieTagEvent':modelModifieTagEvent}))
             inputLandmarksSelector.setEnabled(True)
         # if no model is selected
         else:
+            self.cancelModelPreparation()
             # Update the fiducial list selector
             inputLandmarksSelector.setCurrentNode(None)
             inputLandmarksSelector.setEnabled(False)
@@ -885,22 +2123,13 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         constructed. This function recovers this information.
         '''
         # Build the data structures we will need.
-        point_ids = []
-        points = []
-        ids_and_midpoints = []
-        all_ids = []
-        scratch_array = np.zeros(3)
-        for n in range(landmarks.GetNumberOfMarkups()):
-            markupID = landmarks.GetNthMarkupID(n)
-            is_sel = landmarks.GetNthFiducialSelected(n)
-            landmarks.GetNthFiducialPosition(n, scratch_array)
-            markup_pos = np.copy(scratch_array)
-            if is_sel:  # not a midpoint
-                point_ids.append(markupID)
-                points.append(markup_pos)
-            else:       # midpoint
-                ids_and_midpoints.append((markupID, markup_pos))
-            all_ids.append(markupID)
+        snapshot = Q3DCLogic.markupsSnapshot(landmarks)
+        all_ids = list(snapshot.ids)
+        # selected points are not midpoints
+        point_ids = list(snapshot.ids[snapshot.selected])
+        points = snapshot.positions[snapshot.selected]
+        ids_and_midpoints = list(zip(snapshot.ids[~snapshot.selected],
+                                     snapshot.positions[~snapshot.selected]))
 
         # This is the structure we want to populate to help build
         # landmarkDescription in createNewDataStructure.
@@ -915,7 +2144,6 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
 
         # Use a kd-tree to find points that could be the missing endpoint of a
         # hypothetical midpoint operation.
-        points = np.array(points)
         n_new_points = len(points)
         while n_new_points > 0 and len(ids_and_midpoints) > 0:
             kdt = scipy.spatial.KDTree(points)
@@ -962,33 +2190,25 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             markupID = landmarks.GetNthMarkupID(n)
             landmarkDescription[markupID] = {'midPoint': midpoint_data[markupID]}
 
-        for n in range(landmarks.GetNumberOfMarkups()):
-            markupID = landmarks.GetNthMarkupID(n)
-            landmarkLabel = landmarks.GetNthMarkupLabel(n)
+        snapshot = self.getMarkupsSnapshot(landmarks)
+        for markupID, landmarkLabel in zip(snapshot.ids, snapshot.labels):
             landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
             landmarkDescription[markupID]["ROIradius"] = 0
-            landmarkDescription[markupID]["projection"] = dict()
-            if onSurface and not landmarkDescription[markupID]['midPoint']['isMidPoint']:
-                landmarkDescription[markupID]["projection"]["isProjected"] = True
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(landmarks.GetAttribute("hardenModelID"))
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, landmarks, markupID)
-            else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
+            landmarkDescription[markupID]["projection"] = {
+                "isProjected": onSurface and not landmarkDescription[markupID]['midPoint']['isMidPoint'],
+                "closestPointIndex": None,
+            }
 
         if onSurface:
-            for n in range(landmarks.GetNumberOfMarkups()):
-                markupID = landmarks.GetNthMarkupID(n)
-                nth_midpoint_data = landmarkDescription[markupID]['midPoint']
-                if nth_midpoint_data['isMidPoint']:
-                    parent_id1 = nth_midpoint_data['Point1']
-                    parent_id2 = nth_midpoint_data['Point2']
-                    coord = self.calculateMidPointCoord(landmarks, parent_id1, parent_id2)
-                    index = landmarks.GetNthControlPointIndexByID(markupID)
-                    landmarks.SetNthFiducialPositionFromArray(index, coord)
-
-        landmarks.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+            hardenModel = self.getHardenModel(landmarks)
+            projectedIDs = [markupID for markupID in snapshot.ids
+                            if landmarkDescription[markupID]["projection"]["isProjected"]]
+            midPointIDs = [markupID for markupID in self.midPointDependencyOrder(landmarkDescription)
+                           if landmarkDescription[markupID]['midPoint']['isMidPoint']]
+            self.projectLandmarksAndMidPoints(hardenModel, landmarks, landmarkDescription,
+                                              projectedIDs, midPointIDs)
+
+        self.setLandmarkDescription(landmarks, landmarkDescription)
         planeDescription = dict()
         landmarks.SetAttribute("planeDescription",self.encodeJSON(planeDescription))
         landmarks.SetAttribute("isClean",self.encodeJSON({"isClean":False}))
@@ -998,7 +2218,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         self.conform_selectedness_to_midpoint_status(landmarks)
 
     def conform_selectedness_to_midpoint_status(self, landmarks):
-        landmarkDescription = self.decodeJSON(landmarks.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.getLandmarkDescription(landmarks)
         for n in range(landmarks.GetNumberOfMarkups()):
             markupID = landmarks.GetNthMarkupID(n)
             isMidPoint = landmarkDescription[markupID]['midPoint']['isMidPoint']
@@ -1007,35 +2227,63 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
     def changementOfConnectedModel(self, landmarks, model, onSurface):
         landmarks.SetAttribute("connectedModelID", model.GetID())
         landmarks.SetAttribute("hardenModelID", model.GetAttribute("hardenModelID"))
-        landmarkDescription = self.decodeJSON(landmarks.GetAttribute("landmarkDescription"))
-
-        D = nx.DiGraph()
-        for n in range(landmarks.GetNumberOfMarkups()):
-            markupID = landmarks.GetNthMarkupID(n)
-            D.add_node(markupID)
-            dbtm = landmarkDescription[markupID]['midPoint']['definedByThisMarkup']
-            for dependent_point in dbtm:
-                D.add_edge(markupID, dependent_point)
+        landmarkDescription = self.getLandmarkDescription(landmarks)
 
-        for markupID in nx.topological_sort(D):
-            if onSurface:
+        if onSurface:
+            hardenModel = self.getHardenModel(landmarks)
+            projectedIDs = []
+            midPointIDs = []
+            for markupID in self.midPointDependencyOrder(landmarkDescription):
                 if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(landmarks.GetAttribute("hardenModelID"))
-                    landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, landmarks, markupID)
+                    projectedIDs.append(markupID)
                 elif landmarkDescription[markupID]['midPoint']['isMidPoint']:
-                    parent_id1 = landmarkDescription[markupID]['midPoint']['Point1']
-                    parent_id2 = landmarkDescription[markupID]['midPoint']['Point2']
-                    coord = self.calculateMidPointCoord(landmarks, parent_id1, parent_id2)
-                    index = landmarks.GetNthControlPointIndexByID(markupID)
-                    landmarks.SetNthFiducialPositionFromArray(index, coord)
-            else:
+                    midPointIDs.append(markupID)
+            self.projectLandmarksAndMidPoints(hardenModel, landmarks, landmarkDescription,
+                                              projectedIDs, midPointIDs)
+        else:
+            for markupID in landmarkDescription:
                 landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
+            self.storeProjections(landmarkDescription, list(landmarkDescription),
+                                  [None] * len(landmarkDescription))
 
-        landmarks.SetAttribute("landmarkDescription", self.encodeJSON(landmarkDescription))
+        self.setLandmarkDescription(landmarks, landmarkDescription)
         landmarks.SetAttribute("isClean",self.encodeJSON({"isClean":False}))
 
+    @staticmethod
+    def midPointDependencyOrder(landmarkDescription):
+        # IDs of the landmarks sorted so that each midpoint comes after the
+        # landmarks it is defined by.
+        D = nx.DiGraph()
+        for markupID, landmarkState in landmarkDescription.items():
+            D.add_node(markupID)
+            for dependent_point in landmarkState['midPoint']['definedByThisMarkup']:
+                D.add_edge(markupID, dependent_point)
+        return list(nx.topological_sort(D))
+
+    def projectLandmarksAndMidPoints(self, hardenModel, landmarks, landmarkDescription,
+                                     projectedIDs, midPointIDs):
+        """Snap the landmarks projectedIDs on hardenModel with a single kd-tree
+        query, then recompute the midpoints midPointIDs (given in dependency
+        order) and write all the new positions back in one batch.
+        The closest point indices are stored in landmarkDescription."""
+        snapshot = self.getMarkupsSnapshot(landmarks)
+        positions = snapshot.positions.copy()
+        projectedIndices = [snapshot.indexFromID[markupID] for markupID in projectedIDs]
+        if projectedIndices:
+            surfaceIndex = self.getSurfaceIndex(hardenModel)
+            positions[projectedIndices], closestPointIndices, cellProjections = \
+                self.snapOnSurface(surfaceIndex, positions[projectedIndices])
+            self.storeProjections(landmarkDescription, projectedIDs, closestPointIndices, cellProjections)
+        midPointIndices = []
+        for markupID in midPointIDs:
+            midPoint = landmarkDescription[markupID]['midPoint']
+            index = snapshot.indexFromID[markupID]
+            positions[index] = (positions[snapshot.indexFromID[midPoint['Point1']]] +
+                                positions[snapshot.indexFromID[midPoint['Point2']]]) / 2
+            midPointIndices.append(index)
+        modifiedIndices = projectedIndices + midPointIndices
+        self.setLandmarkPositions(landmarks, modifiedIndices, positions[modifiedIndices])
+
     def connectLandmarks(self, modelSelector, landmarkSelector, onSurface):
         model = modelSelector.currentNode()
         landmarks = landmarkSelector.currentNode()
@@ -1048,34 +2296,12 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             landmarkSelector.setCurrentNode(None)
             return
         connectedModelID = landmarks.GetAttribute("connectedModelID")
-        try:
-            tag = self.decodeJSON(landmarks.GetAttribute("PointAddedEventTag"))
-            landmarks.RemoveObserver(tag["PointAddedEventTag"])
-            print("adding observers removed!")
-        except:
-            pass
-        try:
-            tag = self.decodeJSON(landmarks.GetAttribute("UpdatesLinesEventTag"))
-            landmarks.RemoveObserver(tag["UpdatesLinesEventTag"])
-            print("lines observers removed!")
-        except:
-            pass
-        try:
-            tag = self.decodeJSON(landmarks.GetAttribute("PointModifiedEventTag"))
-            landmarks.RemoveObserver(tag["PointModifiedEventTag"])
-            print("moving observers removed!")
-        except:
-            pass
-        try:
-            tag = self.decodeJSON(landmarks.GetAttribute("PointRemovedEventTag"))
-            landmarks.RemoveObserver(tag["PointRemovedEventTag"])
-            print("removing observers removed!")
-        except:
-            pass
+        self.releaseMarkupsDispatcher(landmarks.GetID())
         if connectedModelID:
             if connectedModelID != model.GetID():
                 if self.connectedModelChangement():
                     self.changementOfConnectedModel(landmarks, model, onSurface)
+                    self.getLandmarkItemModel(landmarks, reset=True)
                 else:
                     landmarkSelector.setCurrentNode(None)
                     return
@@ -1084,75 +2310,215 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         # creation of the data structure
         else:
             self.createNewDataStructure(landmarks, model, onSurface)
+            self.getLandmarkItemModel(landmarks, reset=True)
         #update of the landmark Combo Box
         self.updateLandmarkComboBox(landmarks, self.interface.landmarkComboBox, False)
         self.updateLandmarkComboBox(landmarks, self.interface.landmarkComboBox1)
         self.updateLandmarkComboBox(landmarks, self.interface.landmarkComboBox2)
         #adding of listeners
-        PointAddedEventTag = landmarks.AddObserver(landmarks.PointAddedEvent, self.onPointAddedEvent)
-        landmarks.SetAttribute("PointAddedEventTag",self.encodeJSON({"PointAddedEventTag":PointAddedEventTag}))
-        UpdatesLinesEventTag = landmarks.AddObserver(landmarks.PointModifiedEvent, self.updateLinesEvent)
-        landmarks.SetAttribute("UpdatesLinesEventTag",self.encodeJSON({"UpdatesLinesEventTag":UpdatesLinesEventTag}))
-        PointModifiedEventTag = landmarks.AddObserver(landmarks.PointModifiedEvent, self.onPointModifiedEvent)
-        landmarks.SetAttribute("PointModifiedEventTag",self.encodeJSON({"PointModifiedEventTag":PointModifiedEventTag}))
-        PointRemovedEventTag = landmarks.AddObserver(landmarks.PointRemovedEvent, self.onPointRemovedEvent)
-        landmarks.SetAttribute("PointRemovedEventTag",self.encodeJSON({"PointRemovedEventTag":PointRemovedEventTag}))
+        self.markupsDispatchers[landmarks.GetID()] = self.markupsEventDispatcher(self, landmarks)
+        self.UpdateInterface()
+
+    class markupsEventDispatcher(object):
+        """Observers of the control point events of a connected fiducial list.
+
+        There is one observer per event type; it calls the handlers of the
+        logic for this event in order. A handler is not called again while
+        it is running, so it can move the control points without being
+        notified of its own changes. The observer tags stay in Python: call
+        release() when the list is disconnected or removed.
+        """
+        # Attributes where the observer tags used to be stored
+        legacyTagAttributes = ("PointAddedEventTag", "UpdatesLinesEventTag", "PointModifiedEventTag",
+                               "PointRemovedEventTag", "PointInteractionEventTags")
+
+        def __init__(self, logic, markupsNode):
+            self.markupsNode = markupsNode
+            self.runningHandlers = set()
+            handlers = (
+                (markupsNode.PointAddedEvent, (logic.onPointAddedEvent,)),
+                (markupsNode.PointModifiedEvent, (logic.updateLinesEvent, logic.onPointModifiedEvent)),
+                (markupsNode.PointRemovedEvent, (logic.onPointRemovedEvent,)),
+                (markupsNode.PointStartInteractionEvent, (logic.onPointStartInteractionEvent,)),
+                (markupsNode.PointEndInteractionEvent, (logic.onPointEndInteractionEvent,)),
+            )
+            self.tags = [markupsNode.AddObserver(event, self.makeObserver(eventHandlers))
+                         for event, eventHandlers in handlers]
+            for attributeName in self.legacyTagAttributes:
+                if markupsNode.GetAttribute(attributeName) is not None:
+                    markupsNode.RemoveAttribute(attributeName)
+
+        def makeObserver(self, eventHandlers):
+            def observer(caller, event):
+                for handler in eventHandlers:
+                    self.call(handler, caller, event)
+            return observer
+
+        def call(self, handler, caller, event):
+            if handler in self.runningHandlers:
+                return
+            self.runningHandlers.add(handler)
+            try:
+                handler(caller, event)
+            finally:
+                self.runningHandlers.discard(handler)
+
+        def release(self):
+            for tag in self.tags:
+                self.markupsNode.RemoveObserver(tag)
+            self.tags = []
+
+    def callMarkupsHandler(self, markupsNode, handler, event=None):
+        # Call handler outside of an event, with the same reentrance guard as
+        # the dispatcher of markupsNode.
+        dispatcher = self.markupsDispatchers.get(markupsNode.GetID())
+        if dispatcher is None:
+            handler(markupsNode, event)
+        else:
+            dispatcher.call(handler, markupsNode, event)
+
+    def releaseMarkupsDispatcher(self, nodeID):
+        dispatcher = self.markupsDispatchers.pop(nodeID, None)
+        if dispatcher is not None:
+            dispatcher.release()
+
+    def releaseAllMarkupsDispatchers(self):
+        for nodeID in list(self.markupsDispatchers.keys()):
+            self.releaseMarkupsDispatcher(nodeID)
 
     # Called when a landmark is added on a model
     def onPointAddedEvent(self, obj, event):
+        if obj.GetID() in self.suspendedFidListIDs:
+            return
         print("------markup adding-------")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.getLandmarkDescription(obj)
         numOfMarkups = obj.GetNumberOfMarkups()
         markupID = obj.GetNthMarkupID(numOfMarkups - 1)
-        landmarkDescription[markupID] = dict()
         landmarkLabel = obj.GetNthMarkupLabel(numOfMarkups - 1)
-        landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-        landmarkDescription[markupID]["ROIradius"] = 0
-        landmarkDescription[markupID]["projection"] = dict()
-        landmarkDescription[markupID]["projection"]["isProjected"] = True
         # The landmark will be projected by onPointModifiedEvent
-        landmarkDescription[markupID]["midPoint"] = dict()
-        landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = list()
-        landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-        landmarkDescription[markupID]["midPoint"]["Point1"] = None
-        landmarkDescription[markupID]["midPoint"]["Point2"] = None
-        obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+        landmarkDescription[markupID] = self.newLandmarkState(landmarkLabel, True)
+        self.setLandmarkDescription(obj, landmarkDescription)
         self.updateAllLandmarkComboBox(obj, markupID)
         self.UpdateInterface()
-        qt.QTimer.singleShot(0, lambda : self.onPointModifiedEvent(obj,None))
+        qt.QTimer.singleShot(0, lambda : self.callMarkupsHandler(obj, self.onPointModifiedEvent))
+
+    @staticmethod
+    def newLandmarkState(landmarkLabel, isProjected):
+        # Description of a landmark that is not a midpoint
+        return {
+            "landmarkLabel": landmarkLabel,
+            "ROIradius": 0,
+            "projection": {
+                "isProjected": isProjected,
+                "closestPointIndex": None,
+            },
+            "midPoint": {
+                "definedByThisMarkup": [],
+                "isMidPoint": False,
+                "Point1": None,
+                "Point2": None,
+            },
+        }
+
+    def addLandmarks(self, fidList, coords, labels=None, descriptions=None, onSurface=True):
+        """Add several landmarks to fidList in one batch.
+
+        The point observers of fidList are suspended while the points are
+        added. If fidList is connected to a model, the descriptions of the new
+        landmarks are built in one pass, the landmarks are projected on the
+        surface together and the comboboxes are refreshed once.
+        Return the IDs of the new landmarks.
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        if labels is None:
+            labels = [''] * len(coords)
+        fidListID = fidList.GetID()
+        self.suspendedFidListIDs.add(fidListID)
+        try:
+            firstIndex = fidList.GetNumberOfControlPoints()
+            with NodeModify(fidList):
+                for n, (coord, label) in enumerate(zip(coords, labels)):
+                    index = fidList.AddFiducial(coord[0], coord[1], coord[2], label)
+                    if descriptions is not None:
+                        fidList.SetNthControlPointDescription(index, descriptions[n])
+            snapshot = self.getMarkupsSnapshot(fidList)
+            markupIDs = list(snapshot.ids[firstIndex:])
+            landmarkDescription = self.getLandmarkDescription(fidList)
+            if landmarkDescription is None:
+                # The list is not connected to a model yet, createNewDataStructure
+                # will describe the new landmarks.
+                return markupIDs
+            for markupID, landmarkLabel in zip(markupIDs, snapshot.labels[firstIndex:]):
+                landmarkDescription[markupID] = self.newLandmarkState(landmarkLabel, onSurface)
+            if onSurface:
+                hardenModel = self.getHardenModel(fidList)
+                self.projectLandmarksOnSurface(hardenModel, fidList, markupIDs, landmarkDescription)
+            self.setLandmarkDescription(fidList, landmarkDescription)
+        finally:
+            self.suspendedFidListIDs.discard(fidListID)
+        itemModel = self.getLandmarkItemModel(fidList)
+        for markupID, landmarkLabel in zip(markupIDs, snapshot.labels[firstIndex:]):
+            if markupID not in itemModel.items:
+                itemModel.addLandmark(markupID, landmarkLabel)
+        self.updateLandmarkComboBox(fidList, self.interface.landmarkComboBox, False)
+        self.UpdateInterface()
+        return markupIDs
+
+    @staticmethod
+    def read_fiducials_file(filepath):
+        '''
+        Read the labels, positions (RAS) and descriptions of the control
+        points stored in a Slicer fiducials file (.fcsv).
+        '''
+        columns = ['id', 'x', 'y', 'z', 'ow', 'ox', 'oy', 'oz',
+                   'vis', 'sel', 'lock', 'label', 'desc', 'associatedNodeID']
+        isLPS = False
+        labels = []
+        coords = []
+        descriptions = []
+        with open(filepath, newline='', encoding='utf8') as fiducials_file:
+            for row in csv.reader(fiducials_file):
+                if not row:
+                    continue
+                if row[0].startswith('#'):
+                    key, _, value = ','.join(row).lstrip('#').partition('=')
+                    key, value = key.strip(), value.strip()
+                    if key == 'CoordinateSystem':
+                        isLPS = value in ('LPS', '1')
+                    elif key == 'columns':
+                        columns = [column.strip() for column in value.split(',')]
+                    continue
+                fields = dict(zip(columns, row))
+                coords.append([float(fields['x']), float(fields['y']), float(fields['z'])])
+                labels.append(fields.get('label', ''))
+                descriptions.append(fields.get('desc', ''))
+        coords = np.array(coords, dtype=np.float64).reshape((-1, 3))
+        if isLPS:
+            coords[:, :2] *= -1
+        return labels, coords, descriptions
+
+    def importLandmarksFromFile(self, fidList, filepath, onSurface=True):
+        try:
+            labels, coords, descriptions = self.read_fiducials_file(filepath)
+        except OSError as e:
+            slicer.util.delayDisplay('Unable to find/open file.')
+            logging.info('User attempted to import a landmark file.\n' + repr(e))
+            return None
+        except (csv.Error, KeyError, ValueError) as e:
+            slicer.util.delayDisplay('The selected file is not formatted properly.')
+            logging.info('User attempted to import a landmark file.\n' + repr(e))
+            return None
+        return self.addLandmarks(fidList, coords, labels, descriptions, onSurface)
 
     def updateLinesEvent(self, obj, event):
-        if self.interface.line1LAComboBox.currentText != '' and self.interface.line1LBComboBox.currentText != '' \
-                and self.interface.line1LAComboBox.currentText != self.interface.line1LBComboBox.currentText :
-            # Clear Lines, then define new ones
-            if self.interface.renderer1 :
-                self.interface.renderer1.RemoveActor(self.interface.actor1)
-            self.interface.renderer1, self.interface.actor1 = \
-                self.drawLineBetween2Landmark(self.interface.line1LAComboBox.currentText,
-                                              self.interface.line1LBComboBox.currentText,
-                                              self.interface.fidListComboBoxline1LA.currentNode(),
-                                              self.interface.fidListComboBoxline1LB.currentNode())
-        if self.interface.line2LAComboBox.currentText != '' and self.interface.line2LBComboBox.currentText != '' \
-                and self.interface.line2LAComboBox.currentText != self.interface.line2LBComboBox.currentText :
-            if self.interface.renderer2 :
-                self.interface.renderer2.RemoveActor(self.interface.actor2)
-            self.interface.renderer2, self.interface.actor2 = \
-                self.drawLineBetween2Landmark(self.interface.line2LAComboBox.currentText,
-                                              self.interface.line2LBComboBox.currentText,
-                                              self.interface.fidListComboBoxline2LA.currentNode(),
-                                              self.interface.fidListComboBoxline2LB.currentNode())
-        if self.interface.lineLAComboBox.currentText != '' and self.interface.lineLBComboBox.currentText != '' \
-                and self.interface.lineLAComboBox.currentText != self.interface.lineLBComboBox.currentText :
-            if self.interface.renderer3 :
-                self.interface.renderer3.RemoveActor(self.interface.actor3)
-            self.interface.renderer3, self.interface.actor3 = \
-                self.drawLineBetween2Landmark(self.interface.lineLAComboBox.currentText,
-                                              self.interface.lineLBComboBox.currentText,
-                                              self.interface.fidListComboBoxlineLA.currentNode(),
-                                              self.interface.fidListComboBoxlineLB.currentNode())
+        if obj.GetID() in self.suspendedFidListIDs:
+            return
+        # The lines joining landmarks of obj are redrawn on the next refresh
+        # of the interface.
+        self.InvalidateLines(obj)
 
     def updateMidPoint(self, fidList, landmarkID):
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.getLandmarkDescription(fidList)
         for midPointID in landmarkDescription[landmarkID]["midPoint"]["definedByThisMarkup"]:
             if landmarkDescription[midPointID]["midPoint"]["isMidPoint"]:
                 landmark1ID = landmarkDescription[midPointID]["midPoint"]["Point1"]
@@ -1161,40 +2527,67 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 index = fidList.GetNthControlPointIndexByID(midPointID)
                 fidList.SetNthFiducialPositionFromArray(index, coord)
                 if landmarkDescription[midPointID]["projection"]["isProjected"]:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
+                    hardenModel = self.getHardenModel(fidList)
                     landmarkDescription[midPointID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, fidList, midPointID)
-                    fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                        self.projectOnSurface(hardenModel, fidList, midPointID, landmarkDescription)
+                    self.setLandmarkDescription(fidList, landmarkDescription)
                 self.updateMidPoint(fidList, midPointID)
 
     # Called when a landmarks is moved
     def onPointModifiedEvent(self, obj, event):
+        if obj.GetID() in self.suspendedFidListIDs:
+            return
         print("----onPointModifiedEvent Q3DC-----")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.getLandmarkDescription(obj)
         if not landmarkDescription:
             return
         selectedLandmarkID = self.findIDFromLabel(obj, self.interface.landmarkComboBox.currentText)
-        # remove observer to make sure, the callback function won't work..
-        tag = self.decodeJSON(obj.GetAttribute("PointModifiedEventTag"))
-        obj.RemoveObserver(tag["PointModifiedEventTag"])
+        # The dispatcher does not call this method again for the moves it makes.
         if selectedLandmarkID:
             activeLandmarkState = landmarkDescription[selectedLandmarkID]
             print(activeLandmarkState)
             if activeLandmarkState["projection"]["isProjected"]:
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(obj.GetAttribute("hardenModelID"))
-                activeLandmarkState["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, obj, selectedLandmarkID)
-                obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                hardenModel = self.getHardenModel(obj)
+                multiResolutionIndex = None
+                if obj.GetID() in self.interactingFidListIDs:
+                    multiResolutionIndex = self.getMultiResolutionIndex(hardenModel)
+                if multiResolutionIndex is not None and not self.subVertexProjection:
+                    landmarkIndex = self.getMarkupsSnapshot(obj).indexFromID[selectedLandmarkID]
+                    closestPointIndex = multiResolutionIndex.coarseClosestPointIndex(
+                        self.getLandmarkPosition(obj, landmarkIndex))
+                    self.setLandmarkPositions(obj, [landmarkIndex],
+                                              multiResolutionIndex.finePoints[[closestPointIndex]])
+                    self.storeProjections(landmarkDescription, [selectedLandmarkID], [closestPointIndex])
+                    self.coarselyProjectedLandmarks[obj.GetID()].add(selectedLandmarkID)
+                elif self.incrementalProjection:
+                    activeLandmarkState["projection"]["closestPointIndex"] = \
+                        self.projectLandmarkIncrementally(hardenModel, obj, selectedLandmarkID,
+                                                          activeLandmarkState["projection"]["closestPointIndex"],
+                                                          landmarkDescription)
+                else:
+                    activeLandmarkState["projection"]["closestPointIndex"] = \
+                        self.projectOnSurface(hardenModel, obj, selectedLandmarkID, landmarkDescription)
+                self.setLandmarkDescription(obj, landmarkDescription)
             self.updateMidPoint(obj,selectedLandmarkID)
             self.findROI(obj)
         time.sleep(0.08)
-        # Add the observer again
-        PointModifiedEventTag = obj.AddObserver(obj.PointModifiedEvent, self.onPointModifiedEvent)
-        obj.SetAttribute("PointModifiedEventTag",self.encodeJSON({"PointModifiedEventTag":PointModifiedEventTag}))
+
+    def onPointStartInteractionEvent(self, obj, event):
+        self.interactingFidListIDs.add(obj.GetID())
+
+    def onPointEndInteractionEvent(self, obj, event):
+        self.interactingFidListIDs.discard(obj.GetID())
+        if obj.GetID() in self.coarselyProjectedLandmarks:
+            self.refineCoarseProjections(obj)
+            selectedLandmarkID = self.findIDFromLabel(obj, self.interface.landmarkComboBox.currentText)
+            if selectedLandmarkID:
+                self.updateMidPoint(obj, selectedLandmarkID)
 
     def onPointRemovedEvent(self, obj, event):
+        if obj.GetID() in self.suspendedFidListIDs:
+            return
         print("------markup deleting-------")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.getLandmarkDescription(obj)
         IDs = []
         for ID, value in landmarkDescription.items():
             isFound = False
@@ -1205,56 +2598,134 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             if not isFound:
                 IDs.append(ID)
         for ID in IDs:
-            self.deleteLandmark(obj, landmarkDescription[ID]["landmarkLabel"])
+            self.deleteLandmark(obj, ID)
             landmarkDescription.pop(ID,None)
-        obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+        self.setLandmarkDescription(obj, landmarkDescription)
+        self.removePlanesOfLandmarks(obj, IDs)
 
-    def addLandmarkToCombox(self, fidList, combobox, markupID):
-        if not fidList:
-            return
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        combobox.addItem(landmarkDescription[markupID]["landmarkLabel"])
+    class landmarkItemModel(object):
+        """Items of the landmark comboboxes showing one fiducial list.
+
+        The landmarks are stored once, in a QStandardItemModel shared by all
+        the comboboxes showing the list, and the items are updated one by one
+        when landmarks are added, removed or renamed. landmarksOnly is a proxy
+        of the same items hiding the midpoints.
+        """
+        MarkupIDRole = qt.Qt.UserRole
+        MidPointRole = qt.Qt.UserRole + 1
+
+        def __init__(self):
+            self.model = qt.QStandardItemModel()
+            self.landmarksOnly = qt.QSortFilterProxyModel()
+            self.landmarksOnly.setSourceModel(self.model)
+            self.landmarksOnly.setFilterRole(self.MidPointRole)
+            self.landmarksOnly.setFilterFixedString("false")
+            # markup ID -> item
+            self.items = dict()
+
+        def reset(self, markupIDs, labels, midPointIDs=()):
+            self.model.clear()
+            self.items.clear()
+            midPointIDs = set(midPointIDs)
+            for markupID, label in zip(markupIDs, labels):
+                self.addLandmark(markupID, label, markupID in midPointIDs)
+
+        def addLandmark(self, markupID, label, isMidPoint=False):
+            item = qt.QStandardItem(label)
+            item.setData(markupID, self.MarkupIDRole)
+            item.setData(bool(isMidPoint), self.MidPointRole)
+            self.items[markupID] = item
+            self.model.appendRow(item)
+
+        def removeLandmark(self, markupID):
+            item = self.items.pop(markupID, None)
+            if item is not None:
+                self.model.removeRow(item.row())
+
+        def renameLandmark(self, markupID, label):
+            item = self.items.get(markupID)
+            if item is not None and item.text() != label:
+                item.setText(label)
+
+        def setMidPoint(self, markupID, isMidPoint):
+            item = self.items.get(markupID)
+            if item is not None:
+                item.setData(bool(isMidPoint), self.MidPointRole)
+
+        def rowCount(self):
+            return self.model.rowCount()
+
+    def getLandmarkItemModel(self, fidList, reset=False):
+        """Return the item model of the landmarks of fidList.
+
+        The models of the lists connected to a model are kept up to date by the
+        point observers. The other lists are not observed, their model is
+        rebuilt each time it is requested.
+        """
+        fidListID = fidList.GetID()
+        itemModel = self.landmarkItemModels.get(fidListID)
+        landmarkDescription = self.getLandmarkDescription(fidList)
+        if itemModel is None:
+            itemModel = self.landmarkItemModel()
+            self.landmarkItemModels[fidListID] = itemModel
+            reset = True
+        elif landmarkDescription is None or itemModel.rowCount() != fidList.GetNumberOfControlPoints():
+            reset = True
+        if reset:
+            snapshot = self.getMarkupsSnapshot(fidList)
+            midPointIDs = []
+            if landmarkDescription:
+                midPointIDs = [markupID for markupID in snapshot.ids
+                               if landmarkDescription[markupID]["midPoint"]["isMidPoint"]]
+            itemModel.reset(snapshot.ids, snapshot.labels, midPointIDs)
+        return itemModel
+
+    def releaseLandmarkItemModel(self, fidListID):
+        self.landmarkItemModels.pop(fidListID, None)
+
+    def releaseAllLandmarkItemModels(self):
+        self.landmarkItemModels.clear()
+
+    def renameLandmark(self, fidList, markupID, landmarkLabel):
+        itemModel = self.landmarkItemModels.get(fidList.GetID())
+        if itemModel is not None:
+            itemModel.renameLandmark(markupID, landmarkLabel)
+
+    def setLandmarkMidPoint(self, fidList, markupID, isMidPoint):
+        itemModel = self.landmarkItemModels.get(fidList.GetID())
+        if itemModel is not None:
+            itemModel.setMidPoint(markupID, isMidPoint)
 
     def updateAllLandmarkComboBox(self, fidList, markupID):
-        # update of the Combobox that are always updated
+        # The comboboxes showing fidList share its item model, adding the
+        # landmark to it updates all of them.
+        itemModel = self.getLandmarkItemModel(fidList)
+        if markupID not in itemModel.items:
+            landmarkIndex = fidList.GetNthControlPointIndexByID(markupID)
+            itemModel.addLandmark(markupID, fidList.GetNthControlPointLabel(landmarkIndex))
         self.updateLandmarkComboBox(fidList, self.interface.landmarkComboBox, False)
-        self.addLandmarkToCombox(fidList, self.interface.landmarkComboBox1, markupID)
-        self.addLandmarkToCombox(fidList, self.interface.landmarkComboBox2, markupID)
-        #update of the Comboboxes that display the fidcial list just modified
-        for key,value in self.comboboxdict.items():
-            if value is fidList:
-                self.addLandmarkToCombox(fidList, key, markupID)
 
     def updateLandmarkComboBox(self, fidList, combobox, displayMidPoint = True):
+        # Show the landmarks of fidList (none if fidList is None) in combobox
+        # and select the last one.
         combobox.blockSignals(True)
-        combobox.clear()
-        if not fidList:
-            return
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        if not fidList:
-            return
-        numOfFid = fidList.GetNumberOfMarkups()
-        if numOfFid > 0:
-            for i in range(0, numOfFid):
-                if displayMidPoint is False:
-                    ID = fidList.GetNthMarkupID(i)
-                    if not landmarkDescription[ID]["midPoint"]["isMidPoint"]:
-                        landmarkLabel = fidList.GetNthMarkupLabel(i)
-                        combobox.addItem(landmarkLabel)
-                else:
-                    landmarkLabel = fidList.GetNthMarkupLabel(i)
-                    combobox.addItem(landmarkLabel)
+        if fidList:
+            itemModel = self.getLandmarkItemModel(fidList)
+            model = itemModel.model if displayMidPoint else itemModel.landmarksOnly
+        else:
+            if self.emptyLandmarkModel is None:
+                self.emptyLandmarkModel = qt.QStandardItemModel()
+            model = self.emptyLandmarkModel
+        combobox.setModel(model)
         combobox.setCurrentIndex(combobox.count - 1)
         combobox.blockSignals(False)
 
-    def deleteLandmark(self, fidList, label):
-        # update of the Combobox that are always updated
-        self.interface.landmarkComboBox.removeItem(self.interface.landmarkComboBox.findText(label))
-        self.interface.landmarkComboBox1.removeItem(self.interface.landmarkComboBox1.findText(label))
-        self.interface.landmarkComboBox2.removeItem(self.interface.landmarkComboBox2.findText(label))
-        for key,value in self.comboboxdict.items():
-            if value is fidList:
-                key.removeItem(key.findText(label))
+    def deleteLandmark(self, fidList, markupID):
+        # Removing the item from the shared model updates all the comboboxes
+        # showing fidList.
+        itemModel = self.landmarkItemModels.get(fidList.GetID())
+        if itemModel is not None:
+            itemModel.removeLandmark(markupID)
 
     @staticmethod
     def findIDFromLabel(fidList, landmarkLabel):
@@ -1265,9 +2736,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         return None
 
     def getClosestPointIndex(self, fidNode, inputPolyData, landmarkID):
-        landmarkCoord = np.zeros(3)
-        landmarkCoord[1] = 42
-        fidNode.GetNthFiducialPosition(landmarkID, landmarkCoord)
+        landmarkCoord = self.getLandmarkPosition(fidNode, landmarkID)
         pointLocator = vtk.vtkPointLocator()
         pointLocator.SetDataSet(inputPolyData)
         pointLocator.AutomaticOn()
@@ -1281,26 +2750,238 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         print(landmarkCoord)
         fidNode.SetNthFiducialPositionFromArray(landmarkID,landmarkCoord)
 
-    def projectOnSurface(self, modelOnProject, fidNode, selectedFidReflID):
+    def projectLandmarkIncrementally(self, modelOnProject, fidNode, markupID, previousClosestPointIndex,
+                                     landmarkDescription=None):
+        """Project a landmark that moved a little since it was last projected
+        on previousClosestPointIndex: the mesh is walked from that point, so
+        the cost depends on the displacement rather than on the mesh size.
+        The global kd-tree is only queried if the walk stalls."""
+        surfaceIndex = self.getSurfaceIndex(modelOnProject)
+        if previousClosestPointIndex is None or previousClosestPointIndex >= len(surfaceIndex.points) \
+                or self.subVertexProjection:
+            return self.projectOnSurface(modelOnProject, fidNode, markupID, landmarkDescription)
+        snapshot = self.getMarkupsSnapshot(fidNode)
+        landmarkIndex = snapshot.indexFromID[markupID]
+        position = snapshot.positions[landmarkIndex]
+        closestPointIndex = surfaceIndex.walkToClosestPoint(position, previousClosestPointIndex)
+        if closestPointIndex is None:
+            closestPointIndex = surfaceIndex.closestPointIndices(position)[0]
+        self.setLandmarkPositions(fidNode, [landmarkIndex], surfaceIndex.points[[closestPointIndex]])
+        if landmarkDescription is not None:
+            self.storeProjections(landmarkDescription, [markupID], [int(closestPointIndex)])
+        return int(closestPointIndex)
+
+    def projectOnSurface(self, modelOnProject, fidNode, selectedFidReflID, landmarkDescription=None):
         if selectedFidReflID:
-            markupsIndex = fidNode.GetNthControlPointIndexByID(selectedFidReflID)
-            indexClosestPoint = self.getClosestPointIndex(fidNode, modelOnProject.GetPolyData(), markupsIndex)
-            self.replaceLandmark(modelOnProject.GetPolyData(), fidNode, markupsIndex, indexClosestPoint)
-            return indexClosestPoint
+            return self.projectLandmarksOnSurface(modelOnProject, fidNode, [selectedFidReflID],
+                                                  landmarkDescription)[0]
+
+    @staticmethod
+    def storeProjections(landmarkDescription, markupIDs, closestPointIndices, cellProjections=None):
+        # In sub-vertex mode, the projection also keeps the cell the landmark
+        # is on, the IDs of the points of that cell and its barycentric
+        # weights in it, see surfaceIndex.closestSurfacePoints.
+        for n, markupID in enumerate(markupIDs):
+            projection = landmarkDescription[markupID]["projection"]
+            projection["closestPointIndex"] = closestPointIndices[n]
+            if cellProjections is None:
+                for key in ("cellID", "cellPointIDs", "weights"):
+                    projection.pop(key, None)
+            else:
+                projection["cellID"], projection["cellPointIDs"], projection["weights"] = cellProjections[n]
+
+    def snapOnSurface(self, surfaceIndex, positions):
+        """Return the positions snapped on the surface, the closest point
+        indices and, in sub-vertex mode, the cell projections."""
+        if self.subVertexProjection:
+            return surfaceIndex.closestSurfacePoints(positions)
+        closestPointIndices = surfaceIndex.closestPointIndices(positions)
+        return surfaceIndex.points[closestPointIndices], closestPointIndices.tolist(), None
+
+    def projectLandmarksOnSurface(self, modelOnProject, fidNode, markupIDs, landmarkDescription=None):
+        """Project the landmarks markupIDs of fidNode on modelOnProject in one
+        batch and return the index of the closest point of each landmark.
+        If landmarkDescription is given, the projections are stored in it."""
+        if not markupIDs:
+            return []
+        snapshot = self.getMarkupsSnapshot(fidNode)
+        landmarkIndices = [snapshot.indexFromID[markupID] for markupID in markupIDs]
+        surfaceIndex = self.getSurfaceIndex(modelOnProject)
+        snappedPositions, closestPointIndices, cellProjections = \
+            self.snapOnSurface(surfaceIndex, snapshot.positions[landmarkIndices])
+        self.setLandmarkPositions(fidNode, landmarkIndices, snappedPositions)
+        if landmarkDescription is not None:
+            self.storeProjections(landmarkDescription, markupIDs, closestPointIndices, cellProjections)
+        return closestPointIndices
 
     def calculateMidPointCoord(self, fidList, landmark1ID, landmark2ID):
         """Set the midpoint when you know the the mrml nodes"""
-        landmark1Index = fidList.GetNthControlPointIndexByID(landmark1ID)
-        landmark2Index = fidList.GetNthControlPointIndexByID(landmark2ID)
-        coord1 = [-1, -1, -1]
-        coord2 = [-1, -1, -1]
-        fidList.GetNthFiducialPosition(landmark1Index, coord1)
-        fidList.GetNthFiducialPosition(landmark2Index, coord2)
-        midCoord = [-1, -1, -1]
-        midCoord[0] = (coord1[0] + coord2[0])/2
-        midCoord[1] = (coord1[1] + coord2[1])/2
-        midCoord[2] = (coord1[2] + coord2[2])/2
-        return midCoord
+        coord1, coord2 = self.getMarkupsSnapshot(fidList).positionsFromIDs([landmark1ID, landmark2ID])
+        midCoord = (coord1 + coord2)/2
+        return midCoord.tolist()
+
+    class measurementCache(object):
+        """Results of the measurements, keyed on the type and options of the
+        measurement and on the (node ID, markup ID) of its landmarks.
+
+        A result is stored with the position stamps of its landmarks and only
+        served while they are unchanged, so it is recomputed as soon as one of
+        its landmarks moves. At most maxEntries results are kept, the least
+        recently used ones are evicted first.
+        """
+        def __init__(self, maxEntries):
+            self.maxEntries = maxEntries
+            # key -> {"stamps", "result"}, least recently used first
+            self.entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+        def get(self, key, stamps, compute):
+            entry = self.entries.get(key)
+            if entry is not None and entry["stamps"] == stamps:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["result"]
+            self.misses += 1
+            entry = {"stamps": stamps, "result": compute()}
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+            return entry["result"]
+
+        def clear(self):
+            self.entries.clear()
+
+    def measure(self, measurementType, landmarks, compute, options=()):
+        """Return compute() for the landmarks [(markupsNode, markupID), ...].
+        The result is served from the cache while none of the landmarks moved
+        since it was computed."""
+        key = (measurementType, options + (self.numberOfDecimals,)) + \
+              tuple((markupsNode.GetID(), markupID) for markupsNode, markupID in landmarks)
+        stamps = tuple(self.getMarkupsSnapshot(markupsNode).positionStamp(markupID)
+                       for markupsNode, markupID in landmarks)
+        return self.measurements.get(key, stamps, compute)
+
+    # typeCalculation -> (vectorised engine, landmark indices of the
+    # measurement, value attributes in the order of the engine)
+    uncertaintyEngines = {
+        'distance': ('distanceComponents', [[0, 1]], ('RLComponent', 'APComponent', 'SIComponent', 'ThreeDComponent')),
+        'angle': ('lineAngles', [[0, 1, 2, 3]], ('Pitch', 'Roll', 'Yaw')),
+        'linePoint': ('linePointComponents', [[0, 1, 2]],
+                      ('RLComponent', 'APComponent', 'SIComponent', 'ThreeDComponent')),
+    }
+
+    @staticmethod
+    def perturbedPositions(positions, sigma, numberOfSamples, generator):
+        # numberOfSamples x L x 3 positions with an isotropic Gaussian noise of
+        # standard deviation sigma (a scalar or one value per landmark)
+        sigma = np.reshape(sigma, (-1, 1))
+        return positions + sigma * generator.standard_normal((numberOfSamples,) + positions.shape)
+
+    def sampleLandmarks(self, landmarks):
+        """Monte-Carlo samples (uncertaintySamples x L x 3) of the positions
+        of the landmarks [(markupsNode, markupID), ...]. The samples of the
+        landmarks projected on their model are put back on the surface (its
+        closest vertices, all the samples of a landmark in one query) if
+        uncertaintyOnSurface."""
+        positions = np.array([self.getMarkupsSnapshot(markupsNode).positionsFromIDs([markupID])[0]
+                              for markupsNode, markupID in landmarks])
+        samples = self.perturbedPositions(positions, self.uncertaintySigma, self.uncertaintySamples,
+                                          self.uncertaintyGenerator)
+        if self.uncertaintyOnSurface:
+            for n, (markupsNode, markupID) in enumerate(landmarks):
+                landmarkDescription = self.getLandmarkDescription(markupsNode)
+                hardenModel = slicer.mrmlScene.GetNodeByID(markupsNode.GetAttribute("hardenModelID") or "")
+                if not landmarkDescription or markupID not in landmarkDescription or hardenModel is None \
+                        or not landmarkDescription[markupID]["projection"]["isProjected"]:
+                    continue
+                surfaceIndex = self.getSurfaceIndex(hardenModel)
+                samples[:, n] = surfaceIndex.points[surfaceIndex.closestPointIndices(samples[:, n])]
+        return positions, samples
+
+    def measurementUncertainty(self, typeCalculation, landmarks):
+        """Confidence intervals of the values of a measurement
+        ('distance', 'angle' or 'linePoint') of the landmarks
+        [(markupsNode, markupID), ...] when they are misplaced following the
+        uncertainty settings. All the samples are evaluated in one vectorised
+        call. Return {value attribute: (lower, upper)}, or None when the
+        uncertainty is disabled. The result is cached like the measurement."""
+        if self.uncertaintySigma <= 0 or self.uncertaintySamples <= 0:
+            return None
+        engineName, indices, attributes = self.uncertaintyEngines[typeCalculation]
+        engine = getattr(self, engineName)
+        indices = np.array(indices, dtype=np.intp)
+
+        def computeIntervals():
+            positions, samples = self.sampleLandmarks(landmarks)
+            return self.intervalsFromSamples(typeCalculation, engine(positions, indices, 15),
+                                             engine(samples, indices, 15))[0]
+
+        intervals = self.measure(typeCalculation + 'Uncertainty', landmarks, computeIntervals,
+                                 options=(self.uncertaintySigma, self.uncertaintySamples,
+                                          self.uncertaintyConfidence, self.uncertaintyOnSurface))
+        return intervals
+
+    def intervalsFromSamples(self, typeCalculation, nominal, values):
+        """Confidence intervals of N measurements of one type from their
+        nominal values (N x k) and their values on the Monte-Carlo samples
+        (samples x N x k). Return one {value attribute: (lower, upper)} per
+        measurement, without the values that are NaN."""
+        attributes = self.uncertaintyEngines[typeCalculation][2]
+        if typeCalculation == 'angle':
+            # unwrapped around the nominal angle, an interval crossing
+            # +/-180 goes beyond it
+            values = nominal + (values - nominal + 180) % 360 - 180
+        tail = 50 * (1 - self.uncertaintyConfidence)
+        with warnings.catch_warnings():
+            # all-NaN columns: angles on a projection where a line is a point
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.round(np.nanpercentile(values, [tail, 100 - tail], axis=0), self.numberOfDecimals)
+        return [dict((attribute, (float(lower[m, n]), float(upper[m, n])))
+                     for n, attribute in enumerate(attributes) if not np.isnan(lower[m, n]))
+                for m in range(len(nominal))]
+
+    def protocolUncertainty(self, markupsNode, compiledProtocol):
+        """Confidence intervals of all the measurements of a compiled
+        protocol on markupsNode, like measurementUncertainty: the landmarks
+        used by the protocol are sampled once and each type of measurement is
+        evaluated on all the samples in one vectorised call. Return
+        {'distances': [...], 'angles': [...], 'linePoints': [...]} with one
+        interval dict per measurement, or None when the uncertainty is
+        disabled."""
+        if self.uncertaintySigma <= 0 or self.uncertaintySamples <= 0:
+            return None
+        sections = (('distances', 'distance', compiledProtocol.distances),
+                    ('angles', 'angle', compiledProtocol.angles),
+                    ('linePoints', 'linePoint', compiledProtocol.linePoints))
+        used = np.unique(np.concatenate([indices.ravel() for _, _, indices in sections]))
+        intervals = dict((name, []) for name, _, _ in sections)
+        if not used.size:
+            return intervals
+        positions, samples = self.sampleLandmarks([(markupsNode, compiledProtocol.markupIDs[index])
+                                                   for index in used])
+        for name, typeCalculation, indices in sections:
+            if not len(indices):
+                continue
+            engine = getattr(self, self.uncertaintyEngines[typeCalculation][0])
+            indices = np.searchsorted(used, indices)
+            nominal = engine(positions, indices, 15)
+            values = engine(samples, indices, 15)
+            if typeCalculation == 'angle':
+                nominal[~compiledProtocol.angleStates] = np.nan
+                values[:, ~compiledProtocol.angleStates] = np.nan
+            intervals[name] = self.intervalsFromSamples(typeCalculation, nominal, values)
+        return intervals
+
+    @staticmethod
+    def valueText(element, attribute, text=None):
+        # Text of a value of a result table, followed by its confidence interval
+        text = str(getattr(element, attribute)) if text is None else text
+        interval = (element.confidenceIntervals or {}).get(attribute)
+        if interval is None:
+            return text
+        return text + '\n[' + str(interval[0]) + ', ' + str(interval[1]) + ']'
 
     def removecomponentFromStorage(self, type, element):
         if type == 'angles':
@@ -1315,13 +2996,9 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         return element
 
     def defineDistances(self, markupsNode1, landmark1Index, markupsNode2, landmark2Index):
-        coord1 = [-1, -1, -1]
-        coord2 = [-1, -1, -1]
-        markupsNode1.GetNthFiducialPosition(landmark1Index, coord1)
-        markupsNode2.GetNthFiducialPosition(landmark2Index, coord2)
-        diffRAxis = coord2[0] - coord1[0]
-        diffAAxis = coord2[1] - coord1[1]
-        diffSAxis = coord2[2] - coord1[2]
+        coord1 = self.getLandmarkPosition(markupsNode1, landmark1Index)
+        coord2 = self.getLandmarkPosition(markupsNode2, landmark2Index)
+        diffRAxis, diffAAxis, diffSAxis = (coord2 - coord1).tolist()
         threeDDistance = math.sqrt(vtk.vtkMath().Distance2BetweenPoints(coord1, coord2))
         return round(diffRAxis, self.numberOfDecimals),\
                round(diffAAxis, self.numberOfDecimals),\
@@ -1333,6 +3010,10 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         fidID2 = self.findIDFromLabel(fidlist2,fidLabel2)
         landmark1Index = fidlist1.GetNthControlPointIndexByID(fidID1)
         landmark2Index = fidlist2.GetNthControlPointIndexByID(fidID2)
+        distances = self.measure('distance', [(fidlist1, fidID1), (fidlist2, fidID2)],
+                                 lambda: self.defineDistances(fidlist1, landmark1Index,
+                                                              fidlist2, landmark2Index))
+        confidenceIntervals = self.measurementUncertainty('distance', [(fidlist1, fidID1), (fidlist2, fidID2)])
         elementToAdd = self.distanceValuesStorage()
         # if this distance has already been computed before -> replace values
         for element in distanceList:
@@ -1340,15 +3021,16 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 element = self.removecomponentFromStorage('distance', element)
                 element.startLandmarkName = fidLabel1
                 element.endLandmarkName = fidLabel2
-                element.RLComponent, element.APComponent, element.SIComponent, element.ThreeDComponent = \
-                    self.defineDistances(fidlist1, landmark1Index, fidlist2, landmark2Index)
+                element.RLComponent, element.APComponent, element.SIComponent, element.ThreeDComponent = distances
+                element.confidenceIntervals = confidenceIntervals
                 return distanceList
         elementToAdd.startLandmarkID = fidID1
         elementToAdd.endLandmarkID = fidID2
         elementToAdd.startLandmarkName = fidLabel1
         elementToAdd.endLandmarkName = fidLabel2
         elementToAdd.RLComponent, elementToAdd.APComponent, elementToAdd.SIComponent, elementToAdd.ThreeDComponent = \
-            self.defineDistances(fidlist1, landmark1Index, fidlist2, landmark2Index)
+            distances
+        elementToAdd.confidenceIntervals = confidenceIntervals
         distanceList.append(elementToAdd)
         return distanceList
 
@@ -1366,7 +3048,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
             table.setCellWidget(i, 0,label)
             if element.RLComponent != None:
-                label = qt.QLabel(element.RLComponent)
+                label = qt.QLabel(self.valueText(element, 'RLComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 1, label)
             else:
@@ -1375,7 +3057,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 table.setCellWidget(i, 1, label)
 
             if element.APComponent != None:
-                label = qt.QLabel(element.APComponent)
+                label = qt.QLabel(self.valueText(element, 'APComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 2, label)
             else:
@@ -1384,7 +3066,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 table.setCellWidget(i, 2, label)
 
             if element.SIComponent != None:
-                label = qt.QLabel(element.SIComponent)
+                label = qt.QLabel(self.valueText(element, 'SIComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 3, label)
             else:
@@ -1393,7 +3075,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 table.setCellWidget(i, 3, label)
 
             if element.ThreeDComponent != None:
-                label = qt.QLabel(element.ThreeDComponent)
+                label = qt.QLabel(self.valueText(element, 'ThreeDComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 4, label)
             else:
@@ -1409,15 +3091,10 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                      markupsNode3, landmark3Index,
                      markupsNode4, landmark4Index):
         # Pitch is computed by projection on the plan (y,z)
-        coord1 = [-1, -1, -1]
-        coord2 = [-1, -1, -1]
-        coord3 = [-1, -1, -1]
-        coord4 = [-1, -1, -1]
-
-        markupsNode1.GetNthFiducialPosition(landmark1Index, coord1)
-        markupsNode2.GetNthFiducialPosition(landmark2Index, coord2)
-        markupsNode3.GetNthFiducialPosition(landmark3Index, coord3)
-        markupsNode4.GetNthFiducialPosition(landmark4Index, coord4)
+        coord1 = self.getLandmarkPosition(markupsNode1, landmark1Index)
+        coord2 = self.getLandmarkPosition(markupsNode2, landmark2Index)
+        coord3 = self.getLandmarkPosition(markupsNode3, landmark3Index)
+        coord4 = self.getLandmarkPosition(markupsNode4, landmark4Index)
 
         vectLine1 = [0, coord2[1]-coord1[1], coord2[2]-coord1[2] ]
         normVectLine1 = np.sqrt( vectLine1[1]*vectLine1[1] + vectLine1[2]*vectLine1[2] )
@@ -1440,15 +3117,10 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                     markupsNode3, landmark3Index,
                     markupsNode4, landmark4Index):
         # Roll is computed by projection on the plan (x,z)
-        coord1 = [-1, -1, -1]
-        coord2 = [-1, -1, -1]
-        coord3 = [-1, -1, -1]
-        coord4 = [-1, -1, -1]
-
-        markupsNode1.GetNthFiducialPosition(landmark1Index, coord1)
-        markupsNode2.GetNthFiducialPosition(landmark2Index, coord2)
-        markupsNode3.GetNthFiducialPosition(landmark3Index, coord3)
-        markupsNode4.GetNthFiducialPosition(landmark4Index, coord4)
+        coord1 = self.getLandmarkPosition(markupsNode1, landmark1Index)
+        coord2 = self.getLandmarkPosition(markupsNode2, landmark2Index)
+        coord3 = self.getLandmarkPosition(markupsNode3, landmark3Index)
+        coord4 = self.getLandmarkPosition(markupsNode4, landmark4Index)
 
         vectLine1 = [coord2[0]-coord1[0], 0, coord2[2]-coord1[2] ]
         normVectLine1 = np.sqrt( vectLine1[0]*vectLine1[0] + vectLine1[2]*vectLine1[2] )
@@ -1471,15 +3143,10 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                    markupsNode3, landmark3Index,
                    markupsNode4, landmark4Index):
         # Yaw is computed by projection on the plan (x,y)
-        coord1 = [-1, -1, -1]
-        coord2 = [-1, -1, -1]
-        coord3 = [-1, -1, -1]
-        coord4 = [-1, -1, -1]
-
-        markupsNode1.GetNthFiducialPosition(landmark1Index, coord1)
-        markupsNode2.GetNthFiducialPosition(landmark2Index, coord2)
-        markupsNode3.GetNthFiducialPosition(landmark3Index, coord3)
-        markupsNode4.GetNthFiducialPosition(landmark4Index, coord4)
+        coord1 = self.getLandmarkPosition(markupsNode1, landmark1Index)
+        coord2 = self.getLandmarkPosition(markupsNode2, landmark2Index)
+        coord3 = self.getLandmarkPosition(markupsNode3, landmark3Index)
+        coord4 = self.getLandmarkPosition(markupsNode4, landmark4Index)
 
         vectLine1 = [coord2[0]-coord1[0], coord2[1]-coord1[1], 0 ]
         normVectLine1 = np.sqrt( vectLine1[0]*vectLine1[0] + vectLine1[1]*vectLine1[1] )
@@ -1509,6 +3176,16 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         landmark2Index = fidlist1B.GetNthControlPointIndexByID(fidID1B)
         landmark3Index = fidlist2A.GetNthControlPointIndexByID(fidID2A)
         landmark4Index = fidlist2B.GetNthControlPointIndexByID(fidID2B)
+        landmarks = [(fidlist1A, fidID1A), (fidlist1B, fidID1B), (fidlist2A, fidID2A), (fidlist2B, fidID2B)]
+        indices = (fidlist1A, landmark1Index, fidlist1B, landmark2Index,
+                   fidlist2A, landmark3Index, fidlist2B, landmark4Index)
+        def computeAngles():
+            return (self.computePitch(*indices) if PitchState else None,
+                    self.computeRoll(*indices) if RollState else None,
+                    self.computeYaw(*indices) if YawState else None)
+        angles = self.measure('angle', landmarks, computeAngles,
+                              options=(bool(PitchState), bool(RollState), bool(YawState)))
+        confidenceIntervals = self.measurementUncertainty('angle', landmarks)
         # if angles has already been computed before -> replace values
         elementToAdd = self.angleValuesStorage()
         for element in angleList:
@@ -1517,21 +3194,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                             element.landmarkALine2ID == fidID2A and\
                             element.landmarkBLine2ID == fidID2B:
                 element = self.removecomponentFromStorage('angles', element)
-                if PitchState:
-                    element.Pitch = self.computePitch(fidlist1A, landmark1Index,
-                                                      fidlist1B, landmark2Index,
-                                                      fidlist2A, landmark3Index,
-                                                      fidlist2B, landmark4Index)
-                if RollState:
-                    element.Roll = self.computeRoll(fidlist1A, landmark1Index,
-                                                    fidlist1B, landmark2Index,
-                                                    fidlist2A, landmark3Index,
-                                                    fidlist2B, landmark4Index)
-                if YawState:
-                    element.Yaw = self.computeYaw(fidlist1A, landmark1Index,
-                                                  fidlist1B, landmark2Index,
-                                                  fidlist2A, landmark3Index,
-                                                  fidlist2B, landmark4Index)
+                element.Pitch, element.Roll, element.Yaw = angles
+                element.confidenceIntervals = confidenceIntervals
                 element.landmarkALine1Name = fidLabel1A
                 element.landmarkBLine1Name = fidLabel1B
                 element.landmarkALine2Name = fidLabel2A
@@ -1546,21 +3210,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         elementToAdd.landmarkBLine1Name = fidLabel1B
         elementToAdd.landmarkALine2Name = fidLabel2A
         elementToAdd.landmarkBLine2Name = fidLabel2B
-        if PitchState:
-            elementToAdd.Pitch = self.computePitch(fidlist1A, landmark1Index,
-                                                   fidlist1B, landmark2Index,
-                                                   fidlist2A, landmark3Index,
-                                                   fidlist2B, landmark4Index)
-        if RollState:
-            elementToAdd.Roll = self.computeRoll(fidlist1A, landmark1Index,
-                                                 fidlist1B, landmark2Index,
-                                                 fidlist2A, landmark3Index,
-                                                 fidlist2B, landmark4Index)
-        if YawState:
-            elementToAdd.Yaw = self.computeYaw(fidlist1A, landmark1Index,
-                                               fidlist1B, landmark2Index,
-                                               fidlist2A, landmark3Index,
-                                               fidlist2B, landmark4Index)
+        elementToAdd.Pitch, elementToAdd.Roll, elementToAdd.Yaw = angles
+        elementToAdd.confidenceIntervals = confidenceIntervals
         angleList.append(elementToAdd)
         return angleList
 
@@ -1584,7 +3235,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             table.setCellWidget(i, 0, label)
             if element.Yaw != None:
                 sign = np.sign(element.Yaw)
-                label = qt.QLabel(str(element.Yaw)+' / '+str(sign*(180-abs(element.Yaw))))
+                label = qt.QLabel(self.valueText(element, 'Yaw',
+                                                 str(element.Yaw)+' / '+str(sign*(180-abs(element.Yaw)))))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 1, label)
             else:
@@ -1594,7 +3246,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
 
             if element.Pitch != None:
                 sign = np.sign(element.Pitch)
-                label = qt.QLabel(str(element.Pitch) + ' / ' + str(sign*(180 - abs(element.Pitch))))
+                label = qt.QLabel(self.valueText(element, 'Pitch',
+                                                 str(element.Pitch) + ' / ' + str(sign*(180 - abs(element.Pitch)))))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 2, label)
             else:
@@ -1604,7 +3257,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
 
             if element.Roll != None:
                 sign = np.sign(element.Roll)
-                label = qt.QLabel(str(element.Roll) + ' / ' + str(sign * (180 - abs(element.Roll))))
+                label = qt.QLabel(self.valueText(element, 'Roll',
+                                                 str(element.Roll) + ' / ' + str(sign * (180 - abs(element.Roll)))))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 3, label)
             else:
@@ -1619,12 +3273,9 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                                  markupsNodeLine2, landmarkLine2Index,
                                  markupsNodepoint, landmarkpointIndex):
         line = vtk.vtkLine()
-        coordLine1 = [-1, -1, -1]
-        coordLine2 = [-1, -1, -1]
-        coordPoint = [-1, -1, -1]
-        markupsNodeLine1.GetNthFiducialPosition(landmarkLine1Index, coordLine1)
-        markupsNodeLine2.GetNthFiducialPosition(landmarkLine2Index, coordLine2)
-        markupsNodepoint.GetNthFiducialPosition(landmarkpointIndex, coordPoint)
+        coordLine1 = self.getLandmarkPosition(markupsNodeLine1, landmarkLine1Index).tolist()
+        coordLine2 = self.getLandmarkPosition(markupsNodeLine2, landmarkLine2Index).tolist()
+        coordPoint = self.getLandmarkPosition(markupsNodepoint, landmarkpointIndex).tolist()
         parametric = vtk.mutable(0)
         projectCoord = [0, 0, 0]
         distance = line.DistanceToLine(coordPoint, coordLine1, coordLine2, parametric, projectCoord)
@@ -1646,6 +3297,12 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         lineLBIndex = fidListLineLB.GetNthControlPointIndexByID(lineLBID)
         PointID = self.findIDFromLabel(fidListPoint, fidLabelPoint)
         PointIndex = fidListPoint.GetNthControlPointIndexByID(PointID)
+        landmarks = [(fidListLineLA, lineLAID), (fidListLineLB, lineLBID), (fidListPoint, PointID)]
+        distances = self.measure('linePoint', landmarks,
+                                 lambda: self.defineDistancesLinePoint(fidListLineLA, lineLAIndex,
+                                                                       fidListLineLB, lineLBIndex,
+                                                                       fidListPoint, PointIndex))
+        confidenceIntervals = self.measurementUncertainty('linePoint', landmarks)
         elementToAdd = self.distanceLinePointStorage()
         # if this distance has already been computed before -> replace values
         for element in linePointList:
@@ -1659,10 +3316,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 element.landmarkALineName = fidLabelLineA
                 element.landmarkBLineName = fidLabelLineB
                 element.landmarkPointName = fidLabelPoint
-                element.RLComponent, element.APComponent, element.SIComponent, element.ThreeDComponent = \
-                    self.defineDistancesLinePoint(fidListLineLA, lineLAIndex,
-                                                  fidListLineLB, lineLBIndex,
-                                                  fidListPoint, PointIndex)
+                element.RLComponent, element.APComponent, element.SIComponent, element.ThreeDComponent = distances
+                element.confidenceIntervals = confidenceIntervals
                 return linePointList
         elementToAdd.landmarkALineID = lineLAID
         elementToAdd.landmarkBLineID = lineLBID
@@ -1671,9 +3326,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         elementToAdd.landmarkBLineName = fidLabelLineB
         elementToAdd.landmarkPointName = fidLabelPoint
         elementToAdd.RLComponent, elementToAdd.APComponent, elementToAdd.SIComponent, elementToAdd.ThreeDComponent = \
-            self.defineDistancesLinePoint(fidListLineLA, lineLAIndex,
-                                          fidListLineLB, lineLBIndex,
-                                          fidListPoint, PointIndex)
+            distances
+        elementToAdd.confidenceIntervals = confidenceIntervals
         linePointList.append(elementToAdd)
         return linePointList
 
@@ -1693,7 +3347,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
             table.setCellWidget(i, 0,label)
             if element.RLComponent != None:
-                label = qt.QLabel(element.RLComponent)
+                label = qt.QLabel(self.valueText(element, 'RLComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 1, label)
             else:
@@ -1702,7 +3356,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 table.setCellWidget(i, 1, label)
 
             if element.APComponent != None:
-                label = qt.QLabel(element.APComponent)
+                label = qt.QLabel(self.valueText(element, 'APComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 2, label)
             else:
@@ -1711,7 +3365,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 table.setCellWidget(i, 2, label)
 
             if element.SIComponent != None:
-                label = qt.QLabel(element.SIComponent)
+                label = qt.QLabel(self.valueText(element, 'SIComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 3, label)
             else:
@@ -1720,7 +3374,7 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
                 table.setCellWidget(i, 3, label)
 
             if element.ThreeDComponent != None:
-                label = qt.QLabel(element.ThreeDComponent)
+                label = qt.QLabel(self.valueText(element, 'ThreeDComponent'))
                 label.setStyleSheet('QLabel{qproperty-alignment:AlignCenter;}')
                 table.setCellWidget(i, 4, label)
             else:
@@ -1731,9 +3385,781 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             i += 1
         return table
 
+    class measurementProtocol(object):
+        """Distances, angles and line-point distances to measure, given by
+        the labels of their landmarks:
+
+            {"distances": [["S", "N"], ...],
+             "angles": [{"line1": ["S", "N"], "line2": ["Go", "Me"],
+                         "yaw": true, "pitch": true, "roll": false}, ...],
+             "linePoints": [{"line": ["S", "N"], "point": "A"}, ...]}
+
+        Every section is optional and the angles are all computed by default.
+        """
+        def __init__(self, description):
+            self.distances = [tuple(str(label) for label in pair) for pair in description.get("distances", [])]
+            self.angles = []
+            self.angleStates = []
+            for angle in description.get("angles", []):
+                self.angles.append(tuple(str(label) for label in list(angle["line1"]) + list(angle["line2"])))
+                # pitch, roll, yaw: the order of angleValuesStorage
+                self.angleStates.append((bool(angle.get("pitch", True)),
+                                         bool(angle.get("roll", True)),
+                                         bool(angle.get("yaw", True))))
+            self.linePoints = [tuple(str(label) for label in list(linePoint["line"]) + [linePoint["point"]])
+                               for linePoint in description.get("linePoints", [])]
+            for labels, size in ((self.distances, 2), (self.angles, 4), (self.linePoints, 3)):
+                if any(len(row) != size for row in labels):
+                    raise ValueError("Expected %d landmarks per measurement" % size)
+
+        def compile(self, snapshot):
+            """Return the protocol resolved against the landmarks of a
+            markups snapshot, the measurements using unknown labels are left
+            out and reported in missingLabels."""
+            return Q3DCLogic.compiledMeasurementProtocol(self, snapshot.ids, snapshot.indexFromLabel)
+
+        def compileLabels(self, labels):
+            """Return the protocol resolved against landmarks given by their
+            labels only, e.g. the columns of cohortPositions."""
+            return Q3DCLogic.compiledMeasurementProtocol(self, np.array(labels, dtype=object),
+                                                          dict((label, n) for n, label in enumerate(labels)))
+
+    class compiledMeasurementProtocol(object):
+        """Measurements of a protocol as arrays of landmark indices into one
+        markups node: distances (D x 2), angles (A x 4) with their
+        pitch/roll/yaw selection (A x 3) and linePoints (P x 3, the two
+        landmarks of the line then the point)."""
+        def __init__(self, protocol, markupIDs, indexFromLabel):
+            self.markupIDs = markupIDs
+            self.missingLabels = set()
+            def resolve(rows, size):
+                kept = []
+                indices = []
+                for n, labels in enumerate(rows):
+                    rowIndices = [indexFromLabel.get(label) for label in labels]
+                    if None in rowIndices:
+                        self.missingLabels.update(label for label, index in zip(labels, rowIndices) if index is None)
+                        continue
+                    kept.append(n)
+                    indices.append(rowIndices)
+                return kept, np.array(indices, dtype=np.intp).reshape((len(kept), size))
+            kept, self.distances = resolve(protocol.distances, 2)
+            self.distanceLabels = [protocol.distances[n] for n in kept]
+            kept, self.angles = resolve(protocol.angles, 4)
+            self.angleLabels = [protocol.angles[n] for n in kept]
+            self.angleStates = np.array([protocol.angleStates[n] for n in kept], dtype=bool).reshape((-1, 3))
+            kept, self.linePoints = resolve(protocol.linePoints, 3)
+            self.linePointLabels = [protocol.linePoints[n] for n in kept]
+
+        def isValidFor(self, snapshot):
+            # The indices stay valid while the landmarks are not added,
+            # removed or reordered.
+            return len(snapshot.ids) == len(self.markupIDs) and bool(np.all(snapshot.ids == self.markupIDs))
+
+    @staticmethod
+    def distanceComponents(positions, pairs, decimals):
+        """R-L, A-P, S-I components and 3D length of the vectors going from
+        positions[pairs[:, 0]] to positions[pairs[:, 1]], as an N x 4 array.
+        positions may be stacked (..., L, 3), the result is then (..., N, 4)."""
+        vectors = positions[..., pairs[:, 1], :] - positions[..., pairs[:, 0], :]
+        return np.round(np.concatenate((vectors, np.linalg.norm(vectors, axis=-1)[..., np.newaxis]), axis=-1),
+                        decimals)
+
+    @staticmethod
+    def lineAngles(positions, quads, decimals):
+        """Signed pitch, roll and yaw in degrees between the lines
+        quads[:, 0]-quads[:, 1] and quads[:, 2]-quads[:, 3], as an N x 3 array.
+        The angles are the ones of computePitch, computeRoll and computeYaw,
+        NaN where one of the projected lines is a point. positions may be
+        stacked (..., L, 3), the result is then (..., N, 3)."""
+        vectors1 = positions[..., quads[:, 1], :] - positions[..., quads[:, 0], :]
+        vectors2 = positions[..., quads[:, 3], :] - positions[..., quads[:, 2], :]
+        angles = np.full(vectors1.shape, np.nan)
+        # pitch on the (y, z) plane, roll on (x, z), yaw on (x, y)
+        for column, (u, v) in enumerate(((1, 2), (0, 2), (0, 1))):
+            line1 = vectors1[..., [u, v]]
+            line2 = vectors2[..., [u, v]]
+            det2D = line1[..., 0] * line2[..., 1] - line1[..., 1] * line2[..., 0]
+            dot = np.einsum('...j,...j->...', line1, line2)
+            notSigned = np.round(np.degrees(np.arctan2(np.abs(det2D), dot)), decimals)
+            valid = (np.linalg.norm(line1, axis=-1) != 0) & (np.linalg.norm(line2, axis=-1) != 0)
+            angles[..., column] = np.where(valid, np.copysign(notSigned, det2D), np.nan)
+        return angles
+
+    @staticmethod
+    def linePointComponents(positions, triples, decimals):
+        """R-L, A-P, S-I components and length of the vectors going from the
+        projection of positions[triples[:, 2]] on the (infinite) line
+        triples[:, 0]-triples[:, 1] to that point, as an N x 4 array.
+        positions may be stacked (..., L, 3), the result is then (..., N, 4)."""
+        lineStarts = positions[..., triples[:, 0], :]
+        directions = positions[..., triples[:, 1], :] - lineStarts
+        points = positions[..., triples[:, 2], :]
+        squaredLengths = np.einsum('...j,...j->...', directions, directions)
+        parametric = np.divide(np.einsum('...j,...j->...', points - lineStarts, directions), squaredLengths,
+                               out=np.zeros(squaredLengths.shape), where=squaredLengths != 0)
+        vectors = points - (lineStarts + parametric[..., np.newaxis] * directions)
+        return np.round(np.concatenate((vectors, np.linalg.norm(vectors, axis=-1)[..., np.newaxis]), axis=-1),
+                        decimals)
+
+    def runMeasurementProtocol(self, protocol, markupsNode, compiledProtocol=None):
+        """Compute all the measurements of protocol on the landmarks of
+        markupsNode, each type in one vectorised call. compiledProtocol is
+        reused if it is still valid for markupsNode. Return a dict with the
+        compiled protocol, the distances (D x 4), angles (A x 3, pitch,
+        roll, yaw with NaN where not requested) and linePoints (P x 4), and
+        their confidenceIntervals (see protocolUncertainty)."""
+        snapshot = self.getMarkupsSnapshot(markupsNode)
+        if compiledProtocol is None or not compiledProtocol.isValidFor(snapshot):
+            compiledProtocol = protocol.compile(snapshot)
+        angles = self.lineAngles(snapshot.positions, compiledProtocol.angles, self.numberOfDecimals)
+        angles[~compiledProtocol.angleStates] = np.nan
+        return {
+            "compiledProtocol": compiledProtocol,
+            "distances": self.distanceComponents(snapshot.positions, compiledProtocol.distances,
+                                                 self.numberOfDecimals),
+            "angles": angles,
+            "linePoints": self.linePointComponents(snapshot.positions, compiledProtocol.linePoints,
+                                                   self.numberOfDecimals),
+            "confidenceIntervals": self.protocolUncertainty(markupsNode, compiledProtocol),
+        }
+
+    def runStackedMeasurementProtocol(self, protocol, labels, positions, compiledProtocol=None):
+        """Same as runMeasurementProtocol on stacked configurations
+        (..., L, 3) of the landmarks labels, e.g. the aligned subjects of
+        generalizedProcrustesAnalysis. The results are (..., D, 4),
+        (..., A, 3) and (..., P, 4) arrays."""
+        if compiledProtocol is None:
+            compiledProtocol = protocol.compileLabels(labels)
+        angles = self.lineAngles(positions, compiledProtocol.angles, self.numberOfDecimals)
+        angles[..., ~compiledProtocol.angleStates] = np.nan
+        return {
+            "compiledProtocol": compiledProtocol,
+            "distances": self.distanceComponents(positions, compiledProtocol.distances, self.numberOfDecimals),
+            "angles": angles,
+            "linePoints": self.linePointComponents(positions, compiledProtocol.linePoints, self.numberOfDecimals),
+        }
+
+    def addProtocolResults(self, results, distanceList=None, angleList=None, linePointList=None):
+        """Add the results of runMeasurementProtocol to the lists of the
+        widget, replacing the values of the measurements already listed. The
+        lists left to None are not updated."""
+        compiledProtocol = results["compiledProtocol"]
+        ids = compiledProtocol.markupIDs
+        confidenceIntervals = results.get("confidenceIntervals")
+        def value(number):
+            return None if np.isnan(number) else float(number)
+        def intervals(name, n):
+            return None if confidenceIntervals is None else confidenceIntervals[name][n]
+        if distanceList is not None:
+            existing = dict(((element.startLandmarkID, element.endLandmarkID), element) for element in distanceList)
+            for n, (labels, indices, values) in enumerate(zip(compiledProtocol.distanceLabels,
+                                                              compiledProtocol.distances, results["distances"])):
+                key = tuple(ids[indices])
+                element = existing.get(key)
+                if element is None:
+                    element = self.distanceValuesStorage()
+                    element.startLandmarkID, element.endLandmarkID = key
+                    distanceList.append(element)
+                    existing[key] = element
+                element.startLandmarkName, element.endLandmarkName = labels
+                element.RLComponent, element.APComponent, element.SIComponent, element.ThreeDComponent = \
+                    [value(number) for number in values]
+                element.confidenceIntervals = intervals("distances", n)
+        if angleList is not None:
+            existing = dict(((element.landmarkALine1ID, element.landmarkBLine1ID,
+                              element.landmarkALine2ID, element.landmarkBLine2ID), element) for element in angleList)
+            for n, (labels, indices, values) in enumerate(zip(compiledProtocol.angleLabels,
+                                                              compiledProtocol.angles, results["angles"])):
+                key = tuple(ids[indices])
+                element = existing.get(key)
+                if element is None:
+                    element = self.angleValuesStorage()
+                    element.landmarkALine1ID, element.landmarkBLine1ID, \
+                        element.landmarkALine2ID, element.landmarkBLine2ID = key
+                    angleList.append(element)
+                    existing[key] = element
+                element.landmarkALine1Name, element.landmarkBLine1Name, \
+                    element.landmarkALine2Name, element.landmarkBLine2Name = labels
+                element.Pitch, element.Roll, element.Yaw = [value(number) for number in values]
+                element.confidenceIntervals = intervals("angles", n)
+        if linePointList is not None:
+            existing = dict(((element.landmarkALineID, element.landmarkBLineID, element.landmarkPointID), element)
+                            for element in linePointList)
+            for n, (labels, indices, values) in enumerate(zip(compiledProtocol.linePointLabels,
+                                                              compiledProtocol.linePoints, results["linePoints"])):
+                key = tuple(ids[indices])
+                element = existing.get(key)
+                if element is None:
+                    element = self.distanceLinePointStorage()
+                    element.landmarkALineID, element.landmarkBLineID, element.landmarkPointID = key
+                    linePointList.append(element)
+                    existing[key] = element
+                element.landmarkALineName, element.landmarkBLineName, element.landmarkPointName = labels
+                element.RLComponent, element.APComponent, element.SIComponent, element.ThreeDComponent = \
+                    [value(number) for number in values]
+                element.confidenceIntervals = intervals("linePoints", n)
+        return distanceList, angleList, linePointList
+
+    class leastSquaresPlane(object):
+        """Plane fitted by least squares to the landmarks markupIDs.
+
+        The sum and the sum of the outer products of the points are kept, so
+        moving some of the landmarks only updates these sums before the 3 x 3
+        scatter matrix is decomposed again. The normal is oriented like the
+        normal of the triangle of the first three landmarks.
+        """
+        def __init__(self, markupIDs, points, stamps):
+            self.markupIDs = list(markupIDs)
+            self.points = np.array(points, dtype=np.float64).reshape((-1, 3))
+            self.stamps = np.array(stamps)
+            self.pointSum = self.points.sum(axis=0)
+            self.outerSum = self.points.T.dot(self.points)
+            self.fit()
+
+        def movePoints(self, indices, points, stamps):
+            points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+            previousPoints = self.points[indices]
+            self.pointSum += points.sum(axis=0) - previousPoints.sum(axis=0)
+            self.outerSum += points.T.dot(points) - previousPoints.T.dot(previousPoints)
+            self.points[indices] = points
+            self.stamps[indices] = stamps
+            self.fit()
+
+        def fit(self):
+            numberOfPoints = len(self.points)
+            self.origin = self.pointSum / numberOfPoints
+            scatter = self.outerSum / numberOfPoints - np.outer(self.origin, self.origin)
+            eigenvalues, eigenvectors = np.linalg.eigh(scatter)
+            normal = eigenvectors[:, 0]
+            orientation = np.cross(self.points[1] - self.points[0], self.points[2] - self.points[0])
+            if normal.dot(orientation) < 0:
+                normal = -normal
+            self.normal = normal
+            # root mean square distance of the landmarks to the plane
+            self.residual = math.sqrt(max(eigenvalues[0], 0))
+
+    def definePlane(self, fidList, planeName, landmarkLabels):
+        """Define the plane planeName of fidList as the least-squares plane of
+        three or more of its landmarks, given by label. The plane is kept in
+        the planeDescription attribute of fidList."""
+        if len(landmarkLabels) < 3:
+            raise ValueError('A plane needs at least three landmarks')
+        snapshot = self.getMarkupsSnapshot(fidList)
+        markupIDs = [snapshot.ids[snapshot.indexFromLabel[label]] for label in landmarkLabels]
+        planeDescription = self.decodeJSON(fidList.GetAttribute("planeDescription")) or dict()
+        planeDescription[planeName] = {"landmarkIDs": markupIDs}
+        fidList.SetAttribute("planeDescription", self.encodeJSON(planeDescription))
+        self.planes.pop((fidList.GetID(), planeName), None)
+        return self.getPlane(fidList, planeName)
+
+    def getPlane(self, fidList, planeName):
+        """Return the leastSquaresPlane planeName of fidList, or None if it is
+        not defined or one of its landmarks was deleted (the plane is then
+        removed). The plane is only refitted for the landmarks that moved
+        since it was last returned, and its origin and normal are then
+        written back to planeDescription."""
+        planeDescription = self.decodeJSON(fidList.GetAttribute("planeDescription"))
+        if not planeDescription or planeName not in planeDescription:
+            return None
+        markupIDs = planeDescription[planeName]["landmarkIDs"]
+        snapshot = self.getMarkupsSnapshot(fidList)
+        missingIDs = [markupID for markupID in markupIDs if markupID not in snapshot.indexFromID]
+        if missingIDs:
+            logging.info('Q3DC: the landmarks of the plane %s of %s were deleted' % (planeName, fidList.GetName()))
+            self.removePlanesOfLandmarks(fidList, missingIDs)
+            return None
+        indices = [snapshot.indexFromID[markupID] for markupID in markupIDs]
+        stamps = snapshot.positionStamps[indices]
+        key = (fidList.GetID(), planeName)
+        plane = self.planes.get(key)
+        if plane is None or plane.markupIDs != markupIDs:
+            plane = self.leastSquaresPlane(markupIDs, snapshot.positions[indices], stamps)
+            self.planes[key] = plane
+        else:
+            moved = np.flatnonzero(plane.stamps != stamps)
+            if not moved.size:
+                return plane
+            plane.movePoints(moved, snapshot.positions[indices][moved], stamps[moved])
+        planeDescription[planeName]["origin"] = plane.origin.tolist()
+        planeDescription[planeName]["normal"] = plane.normal.tolist()
+        fidList.SetAttribute("planeDescription", self.encodeJSON(planeDescription))
+        return plane
+
+    def removePlanesOfLandmarks(self, fidList, markupIDs):
+        # Planes cannot be fitted once one of their landmarks is removed
+        planeDescription = self.decodeJSON(fidList.GetAttribute("planeDescription"))
+        if not planeDescription:
+            return
+        markupIDs = set(markupIDs)
+        for planeName in list(planeDescription.keys()):
+            if markupIDs.intersection(planeDescription[planeName]["landmarkIDs"]):
+                planeDescription.pop(planeName)
+                self.planes.pop((fidList.GetID(), planeName), None)
+        fidList.SetAttribute("planeDescription", self.encodeJSON(planeDescription))
+
+    @staticmethod
+    def signedDistancesToPlane(positions, origin, normal):
+        # Signed distances of the N x 3 positions to the plane, positive on
+        # the side the normal points to.
+        return (np.asarray(positions).reshape((-1, 3)) - origin).dot(normal)
+
+    @staticmethod
+    def anglesToPlane(vectors, normal):
+        # Signed angles in degrees between the N x 3 vectors and the plane,
+        # positive when they point to the side of the normal.
+        vectors = np.asarray(vectors).reshape((-1, 3))
+        norms = np.linalg.norm(vectors, axis=1)
+        sines = np.divide(vectors.dot(normal), norms, out=np.full(len(vectors), np.nan), where=norms != 0)
+        return np.degrees(np.arcsin(np.clip(sines, -1, 1)))
+
+    @staticmethod
+    def anglesBetweenPlanes(normals1, normals2):
+        # N x M angles in degrees (0 to 90) between two sets of planes
+        cosines = np.abs(np.asarray(normals1).reshape((-1, 3)).dot(np.asarray(normals2).reshape((-1, 3)).T))
+        return np.degrees(np.arccos(np.clip(cosines, 0, 1)))
+
+    def pointToPlaneDistances(self, fidList, planeName, markupIDs=None):
+        """Signed distances of the landmarks markupIDs of fidList (all of them
+        by default) to the plane planeName, in one vectorised computation.
+        Return None if the plane is not defined."""
+        plane = self.getPlane(fidList, planeName)
+        if plane is None:
+            logging.info('Q3DC: no plane %s in %s' % (planeName, fidList.GetName()))
+            return None
+        snapshot = self.getMarkupsSnapshot(fidList)
+        positions = snapshot.positions if markupIDs is None else snapshot.positionsFromIDs(markupIDs)
+        return np.round(self.signedDistancesToPlane(positions, plane.origin, plane.normal), self.numberOfDecimals)
+
+    def lineToPlaneAngles(self, fidList, planeName, lines):
+        """Angles in degrees between the lines [(markupID A, markupID B), ...]
+        of fidList and the plane planeName, or None if the plane is not
+        defined."""
+        plane = self.getPlane(fidList, planeName)
+        if plane is None:
+            logging.info('Q3DC: no plane %s in %s' % (planeName, fidList.GetName()))
+            return None
+        snapshot = self.getMarkupsSnapshot(fidList)
+        ends = snapshot.positionsFromIDs([markupID for line in lines for markupID in line]).reshape((-1, 2, 3))
+        return np.round(self.anglesToPlane(ends[:, 1] - ends[:, 0], plane.normal), self.numberOfDecimals)
+
+    def planeToPlaneAngles(self, fidList, planeNames):
+        """Matrix of the angles in degrees between the planes planeNames of
+        fidList, or None if one of them is not defined."""
+        planes = [self.getPlane(fidList, planeName) for planeName in planeNames]
+        if None in planes:
+            logging.info('Q3DC: the planes %s are not all defined in %s' % (planeNames, fidList.GetName()))
+            return None
+        normals = np.array([plane.normal for plane in planes])
+        return np.round(self.anglesBetweenPlanes(normals, normals), self.numberOfDecimals)
+
+    def cohortPositions(self, fidLists, labels=None):
+        """Stack the positions of the landmarks labels (by default all the
+        labels common to the lists, sorted) of every fiducial list of fidLists
+        (one list per subject). Return the labels and a subjects x L x 3
+        array."""
+        return self.stackSnapshots([self.getMarkupsSnapshot(fidList) for fidList in fidLists], labels)
+
+    @staticmethod
+    def stackSnapshots(snapshots, labels=None):
+        # labels and len(snapshots) x L x 3 positions of the landmarks labels
+        # (by default all the labels common to the snapshots, sorted)
+        if labels is None:
+            labels = sorted(set.intersection(*[set(snapshot.labels) for snapshot in snapshots])) if snapshots else []
+        positions = np.empty((len(snapshots), len(labels), 3))
+        for n, snapshot in enumerate(snapshots):
+            positions[n] = snapshot.positions[[snapshot.indexFromLabel[label] for label in labels]]
+        return list(labels), positions
+
+    @staticmethod
+    def pairBilateralLabels(labels):
+        """Pair the right and left landmarks of labels following the naming of
+        the anatomical legend, where the two labels of a pair only differ by
+        one R/L letter (OrR/OrL, UR6/UL6, RGo/LGo, LR6/LL6...). Return the
+        sorted list of (right label, left label)."""
+        labels = set(labels)
+        pairs = set()
+        for label in labels:
+            for n, character in enumerate(label):
+                if character == 'R' and label[:n] + 'L' + label[n + 1:] in labels:
+                    pairs.add((label, label[:n] + 'L' + label[n + 1:]))
+        return sorted(pairs)
+
+    @staticmethod
+    def bilateralPlane(rightPositions, leftPositions):
+        # Mid-sagittal plane of bilateral pairs (..., P, 3): it goes through
+        # the mean of the midpoints of the pairs and its normal is the mean
+        # left to right direction. Return the origins and the normals (..., 3).
+        directions = rightPositions - leftPositions
+        directions = directions / np.linalg.norm(directions, axis=-1)[..., np.newaxis]
+        normals = directions.mean(axis=-2)
+        normals /= np.linalg.norm(normals, axis=-1)[..., np.newaxis]
+        origins = ((rightPositions + leftPositions) / 2).mean(axis=-2)
+        return origins, normals
+
+    @staticmethod
+    def reflectionAsymmetry(rightPositions, leftPositions, origins, normals):
+        """Asymmetry of bilateral pairs (..., P, 3) with respect to their
+        mid-sagittal planes (..., 3). The left landmarks are reflected through
+        the plane. Return the R-L, A-P, S-I components of the vectors from the
+        reflected left landmarks to the right ones (..., P, 3), their lengths
+        (..., P) and the asymmetry index of each axis in percent (..., P, 3):
+        the component over the sum of the distances of the two landmarks to
+        the origin of the plane along that axis."""
+        origins = origins[..., np.newaxis, :]
+        normals = normals[..., np.newaxis, :]
+        leftOffsets = np.sum((leftPositions - origins) * normals, axis=-1)[..., np.newaxis]
+        reflectedLeft = leftPositions - 2 * leftOffsets * normals
+        components = rightPositions - reflectedLeft
+        extents = np.abs(rightPositions - origins) + np.abs(reflectedLeft - origins)
+        indices = 100 * np.divide(np.abs(components), extents,
+                                  out=np.full(components.shape, np.nan), where=extents != 0)
+        return components, np.linalg.norm(components, axis=-1), indices
+
+    def bilateralAsymmetry(self, fidLists, planeName=None):
+        """Asymmetry of all the bilateral pairs found in every fiducial list
+        of fidLists (one list per subject), computed for the whole cohort at
+        once. The mid-sagittal plane of each subject is its plane planeName
+        (see definePlane) if given, otherwise it is fitted to its pairs.
+        Return a dict with the pairs (right label, left label), the origins and
+        normals of the planes (S x 3) and the components (S x P x 3), distances
+        (S x P) and asymmetry indices (S x P x 3) of reflectionAsymmetry."""
+        labels, positions = self.cohortPositions(fidLists)
+        pairs = self.pairBilateralLabels(labels)
+        if not pairs:
+            return None
+        rightPositions = positions[:, [labels.index(right) for right, _ in pairs]]
+        leftPositions = positions[:, [labels.index(left) for _, left in pairs]]
+        if planeName is None:
+            origins, normals = self.bilateralPlane(rightPositions, leftPositions)
+        else:
+            planes = [self.getPlane(fidList, planeName) for fidList in fidLists]
+            if None in planes:
+                return None
+            origins = np.array([plane.origin for plane in planes])
+            normals = np.array([plane.normal for plane in planes])
+        components, distances, indices = self.reflectionAsymmetry(rightPositions, leftPositions, origins, normals)
+        return {
+            "pairs": pairs,
+            "origins": origins,
+            "normals": normals,
+            "components": np.round(components, self.numberOfDecimals),
+            "distances": np.round(distances, self.numberOfDecimals),
+            "indices": np.round(indices, self.numberOfDecimals),
+        }
+
+    def updateAsymmetryTable(self, fidLists, asymmetry):
+        """Write the results of bilateralAsymmetry in the 'Q3DC Asymmetry'
+        table node, one row per subject and pair."""
+        numberOfSubjects, numberOfPairs = asymmetry["distances"].shape
+        columns = OrderedDict()
+        columns['Subject'] = [fidList.GetName() for fidList in fidLists for _ in range(numberOfPairs)]
+        columns['Right Landmark'] = [right for _ in range(numberOfSubjects) for right, _ in asymmetry["pairs"]]
+        columns['Left Landmark'] = [left for _ in range(numberOfSubjects) for _, left in asymmetry["pairs"]]
+        for axis, axisName in enumerate(('R-L', 'A-P', 'S-I')):
+            columns[axisName + ' Component'] = asymmetry["components"][..., axis].ravel()
+        columns['Reflection Distance'] = asymmetry["distances"].ravel()
+        for axis, axisName in enumerate(('R-L', 'A-P', 'S-I')):
+            columns[axisName + ' Asymmetry Index'] = asymmetry["indices"][..., axis].ravel()
+        tableNode = self.getResultTableNode('asymmetry')
+        with NodeModify(tableNode):
+            tableNode.SetAndObserveTable(self.tableFromColumns(columns))
+        return tableNode
+
+    @staticmethod
+    def formMatrices(positions):
+        # Form matrices (..., L, L) of all the inter-landmark distances of the
+        # configurations (..., L, 3)
+        return np.linalg.norm(positions[..., :, np.newaxis, :] - positions[..., np.newaxis, :, :], axis=-1)
+
+    @staticmethod
+    def formDifference(meanForm1, meanForm2):
+        # Form difference matrices: ratios of the mean form of the second
+        # group to the one of the first, 1 on the diagonals.
+        return np.divide(meanForm2, meanForm1, out=np.ones(np.broadcast(meanForm1, meanForm2).shape),
+                         where=meanForm1 != 0)
+
+    @staticmethod
+    def bootstrapFormDifferences(forms1, forms2, numberOfBootstrap, seed=None, numberOfWorkers=None,
+                                 chunkSize=64):
+        """Form difference matrices (numberOfBootstrap x L x L) of
+        resamplings with replacement of the subjects of both groups, given
+        their form matrices (subjects x L x L). Each resampling is drawn as
+        counts of the subjects, so that the mean forms of a chunk of
+        resamplings are one matrix product. The chunks are independent streams
+        of random numbers spawned from seed, computed in parallel."""
+        numberOfLandmarks = forms1.shape[-1]
+        flatForms1 = forms1.reshape((len(forms1), -1))
+        flatForms2 = forms2.reshape((len(forms2), -1))
+        chunkSizes = [min(chunkSize, numberOfBootstrap - start) for start in range(0, numberOfBootstrap, chunkSize)]
+        streams = np.random.SeedSequence(seed).spawn(len(chunkSizes))
+
+        def resample(size, stream):
+            generator = np.random.default_rng(stream)
+
+            def meanForms(flatForms):
+                numberOfSubjects = len(flatForms)
+                drawn = generator.integers(numberOfSubjects, size=(size, numberOfSubjects))
+                counts = np.zeros((size, numberOfSubjects))
+                np.add.at(counts, (np.arange(size)[:, np.newaxis], drawn), 1)
+                return counts.dot(flatForms) / numberOfSubjects
+
+            return Q3DCLogic.formDifference(meanForms(flatForms1), meanForms(flatForms2))
+
+        with ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+            chunks = list(executor.map(resample, chunkSizes, streams))
+        if not chunks:
+            return np.empty((0, numberOfLandmarks, numberOfLandmarks))
+        return np.concatenate(chunks).reshape((-1, numberOfLandmarks, numberOfLandmarks))
+
+    def euclideanDistanceMatrixAnalysis(self, fidLists1, fidLists2, numberOfBootstrap=1000, confidence=0.95,
+                                        seed=None, numberOfWorkers=None):
+        """Compare the forms of two groups of subjects (e.g. pre- and
+        post-surgery), each subject being a fiducial list, on the landmarks
+        common to all of them. Return a dict with the labels, the stacked form
+        matrices of the groups (subjects x L x L), their mean forms, the form
+        difference matrix (group 2 / group 1) and the bounds of its bootstrap
+        confidence intervals, or None if the groups have less than two
+        common landmarks."""
+        if not fidLists1 or not fidLists2:
+            return None
+        labels, positions = self.cohortPositions(list(fidLists1) + list(fidLists2))
+        if len(labels) < 2:
+            return None
+        forms = self.formMatrices(positions)
+        forms1, forms2 = forms[:len(fidLists1)], forms[len(fidLists1):]
+        meanForm1, meanForm2 = forms1.mean(axis=0), forms2.mean(axis=0)
+        differences = self.bootstrapFormDifferences(forms1, forms2, numberOfBootstrap, seed, numberOfWorkers)
+        tail = 50 * (1 - confidence)
+        if len(differences):
+            lower, upper = np.percentile(differences, [tail, 100 - tail], axis=0)
+        else:
+            lower = upper = np.full(meanForm1.shape, np.nan)
+        return {
+            "labels": labels,
+            "forms1": forms1,
+            "forms2": forms2,
+            "meanForm1": meanForm1,
+            "meanForm2": meanForm2,
+            "formDifference": self.formDifference(meanForm1, meanForm2),
+            "lower": lower,
+            "upper": upper,
+        }
+
+    def updateEDMATable(self, edma):
+        """Write the results of euclideanDistanceMatrixAnalysis in the
+        'Q3DC EDMA' table node, one row per pair of landmarks."""
+        rows, columns = np.triu_indices(len(edma["labels"]), k=1)
+        tableColumns = OrderedDict()
+        tableColumns['Landmark A'] = [edma["labels"][row] for row in rows]
+        tableColumns['Landmark B'] = [edma["labels"][column] for column in columns]
+        for key, columnName in (('meanForm1', 'Mean Form 1'), ('meanForm2', 'Mean Form 2'),
+                                ('formDifference', 'Form Difference'), ('lower', 'CI Lower'),
+                                ('upper', 'CI Upper')):
+            tableColumns[columnName] = np.round(edma[key][rows, columns], self.numberOfDecimals)
+        tableNode = self.getResultTableNode('edma')
+        with NodeModify(tableNode):
+            tableNode.SetAndObserveTable(self.tableFromColumns(tableColumns))
+        return tableNode
+
+    @staticmethod
+    def generalizedProcrustes(positions, scaling=False, tolerance=1e-10, maxIterations=100):
+        """Generalized Procrustes alignment of the configurations S x L x 3.
+        Every configuration is centered (and scaled to a unit centroid size if
+        scaling), then all of them are rotated at once (one batched SVD) onto
+        their mean until it converges. The mean starts as the first
+        configuration, so the aligned ones keep its orientation. Return the
+        aligned configurations (S x L x 3), the mean (L x 3), the rotations
+        (S x 3 x 3, applied to the centered rows), the centroids (S x 3), the
+        centroid sizes (S) and the Procrustes distances to the mean (S)."""
+        centroids = positions.mean(axis=1)
+        centered = positions - centroids[:, np.newaxis]
+        sizes = np.sqrt(np.sum(centered ** 2, axis=(1, 2)))
+        if scaling:
+            centered = centered / np.where(sizes != 0, sizes, 1)[:, np.newaxis, np.newaxis]
+        mean = centered[0]
+        rotations = np.broadcast_to(np.eye(3), (len(positions), 3, 3))
+        aligned = centered
+        for _ in range(maxIterations):
+            u, _, vt = np.linalg.svd(np.einsum('sli,lj->sij', centered, mean))
+            # no reflection
+            u[:, :, -1] *= np.where(np.linalg.det(np.matmul(u, vt)) < 0, -1, 1)[:, np.newaxis]
+            rotations = np.matmul(u, vt)
+            aligned = np.matmul(centered, rotations)
+            previousMean, mean = mean, aligned.mean(axis=0)
+            if scaling:
+                mean /= np.linalg.norm(mean)
+            if np.linalg.norm(mean - previousMean) < tolerance:
+                break
+        distances = np.sqrt(np.sum((aligned - mean) ** 2, axis=(1, 2)))
+        return aligned, mean, rotations, centroids, sizes, distances
+
+    def generalizedProcrustesAnalysis(self, fidLists, scaling=False):
+        """Align the fiducial lists fidLists (one per subject) on the
+        landmarks common to all of them, matched by label, so that their
+        measurements no longer depend on the head orientation. Return a dict
+        with the labels and the results of generalizedProcrustes, or None if
+        the lists have less than three common landmarks. The aligned
+        configurations can be measured by runStackedMeasurementProtocol or
+        written to fiducial lists by createAlignedFidLists."""
+        if not fidLists:
+            return None
+        labels, positions = self.cohortPositions(fidLists)
+        if len(labels) < 3:
+            return None
+        aligned, mean, rotations, centroids, sizes, distances = self.generalizedProcrustes(positions, scaling)
+        return {
+            "labels": labels,
+            "aligned": aligned,
+            "mean": mean,
+            "rotations": rotations,
+            "centroids": centroids,
+            "centroidSizes": sizes,
+            "distances": distances,
+        }
+
+    def createAlignedFidLists(self, fidLists, procrustes):
+        """Write the aligned configurations of generalizedProcrustesAnalysis
+        to new fiducial lists named after fidLists, on which the distances
+        and angles of the module can be computed."""
+        alignedFidLists = []
+        for fidList, aligned in zip(fidLists, procrustes["aligned"]):
+            alignedFidList = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLMarkupsFiducialNode", slicer.mrmlScene.GenerateUniqueName(fidList.GetName() + "_aligned"))
+            with NodeModify(alignedFidList):
+                for label, position in zip(procrustes["labels"], aligned):
+                    alignedFidList.AddFiducial(position[0], position[1], position[2], label)
+            alignedFidLists.append(alignedFidList)
+        return alignedFidLists
+
+    def updateProcrustesTable(self, fidLists, procrustes):
+        """Write the centroid sizes and the Procrustes distances of
+        generalizedProcrustesAnalysis in the 'Q3DC Procrustes' table node."""
+        columns = OrderedDict()
+        columns['Subject'] = [fidList.GetName() for fidList in fidLists]
+        columns['Centroid Size'] = np.round(procrustes["centroidSizes"], self.numberOfDecimals)
+        columns['Procrustes Distance'] = np.round(procrustes["distances"], self.numberOfDecimals)
+        tableNode = self.getResultTableNode('procrustes')
+        with NodeModify(tableNode):
+            tableNode.SetAndObserveTable(self.tableFromColumns(columns))
+        return tableNode
+
+    def timepointFidLists(self, timepoints):
+        """Fiducial lists and times of the timepoints: either an ordered
+        collection of fiducial lists (times 0, 1, 2...) or a sequence node of
+        fiducial lists, whose index values are the times when they are
+        numbers."""
+        if isinstance(timepoints, slicer.vtkMRMLSequenceNode):
+            fidLists = []
+            times = []
+            for n in range(timepoints.GetNumberOfDataNodes()):
+                fidList = timepoints.GetNthDataNode(n)
+                if not isinstance(fidList, slicer.vtkMRMLMarkupsFiducialNode):
+                    continue
+                fidLists.append(fidList)
+                try:
+                    times.append(float(timepoints.GetNthIndexValue(n)))
+                except ValueError:
+                    times.append(float(n))
+            if len(set(times)) != len(times):
+                times = range(len(fidLists))
+            return fidLists, np.array(times, dtype=np.float64)
+        fidLists = list(timepoints)
+        return fidLists, np.arange(len(fidLists), dtype=np.float64)
+
+    def protocolFromResults(self, distanceList=(), angleList=(), linePointList=()):
+        """measurementProtocol of the measurements listed in the result
+        tables, by the labels of their landmarks."""
+        return self.measurementProtocol({
+            "distances": [[element.startLandmarkName, element.endLandmarkName] for element in distanceList],
+            "angles": [{"line1": [element.landmarkALine1Name, element.landmarkBLine1Name],
+                        "line2": [element.landmarkALine2Name, element.landmarkBLine2Name],
+                        "pitch": element.Pitch is not None,
+                        "roll": element.Roll is not None,
+                        "yaw": element.Yaw is not None} for element in angleList],
+            "linePoints": [{"line": [element.landmarkALineName, element.landmarkBLineName],
+                            "point": element.landmarkPointName} for element in linePointList],
+        })
+
+    def trackLandmarks(self, timepoints, protocol=None):
+        """Follow the landmarks common to all the timepoints (see
+        timepointFidLists). Their positions are stacked in a T x L x 3 array,
+        on which the measurements of protocol are computed for every
+        timepoint at once (see runStackedMeasurementProtocol). Return a dict
+        with the labels, times, positions, the displacements from the first
+        timepoint (T x L x 3), the velocities between consecutive timepoints
+        (T - 1 x L x 3), the cumulative displacements along the trajectories
+        (T x L) and the measurements, or None without common landmarks."""
+        fidLists, times = self.timepointFidLists(timepoints)
+        # the data nodes of a sequence are not in the scene, read them directly
+        snapshots = [self.getMarkupsSnapshot(fidList) if slicer.mrmlScene.IsNodePresent(fidList)
+                     else self.markupsSnapshot(fidList) for fidList in fidLists]
+        labels, positions = self.stackSnapshots(snapshots)
+        if not labels:
+            return None
+        steps = np.diff(positions, axis=0)
+        stepLengths = np.linalg.norm(steps, axis=-1)
+        tracking = {
+            "names": [fidList.GetName() for fidList in fidLists],
+            "labels": labels,
+            "times": times,
+            "positions": positions,
+            "displacements": positions - positions[0],
+            "velocities": steps / np.diff(times)[:, np.newaxis, np.newaxis],
+            "cumulativeDisplacements": np.concatenate((np.zeros((1, len(labels))), np.cumsum(stepLengths, axis=0))),
+            "measurements": None,
+        }
+        if protocol is not None:
+            tracking["measurements"] = self.runStackedMeasurementProtocol(protocol, labels, positions)
+        return tracking
+
+    def updateTrackingTables(self, tracking):
+        """Write the results of trackLandmarks in the 'Q3DC Tracking' table
+        node, one row per timepoint and landmark, and the measurements in the
+        'Q3DC Time Series' table node, one row per timepoint."""
+        numberOfTimepoints, numberOfLandmarks = tracking["cumulativeDisplacements"].shape
+        velocities = np.concatenate((np.zeros((1, numberOfLandmarks, 3)), tracking["velocities"]))
+        columns = OrderedDict()
+        columns['Timepoint'] = [name for name in tracking["names"] for _ in range(numberOfLandmarks)]
+        columns['Time'] = np.repeat(tracking["times"], numberOfLandmarks)
+        columns['Landmark'] = list(tracking["labels"]) * numberOfTimepoints
+        for axis, axisName in enumerate(('R-L', 'A-P', 'S-I')):
+            columns[axisName + ' Displacement'] = tracking["displacements"][..., axis].ravel()
+        for axis, axisName in enumerate(('R-L', 'A-P', 'S-I')):
+            columns[axisName + ' Velocity'] = velocities[..., axis].ravel()
+        columns['Speed'] = np.linalg.norm(velocities, axis=-1).ravel()
+        columns['Cumulative Displacement'] = tracking["cumulativeDisplacements"].ravel()
+        for name in list(columns.keys())[3:]:
+            columns[name] = np.round(columns[name], self.numberOfDecimals)
+        trackingTableNode = self.getResultTableNode('tracking')
+        with NodeModify(trackingTableNode):
+            trackingTableNode.SetAndObserveTable(self.tableFromColumns(columns))
+        measurements = tracking["measurements"]
+        if measurements is None:
+            return trackingTableNode, None
+        compiledProtocol = measurements["compiledProtocol"]
+        columns = OrderedDict()
+        columns['Timepoint'] = tracking["names"]
+        columns['Time'] = tracking["times"]
+        for labels, values in zip(compiledProtocol.distanceLabels, np.moveaxis(measurements["distances"], 1, 0)):
+            for column, valueName in enumerate(('R-L', 'A-P', 'S-I', '3D')):
+                columns['-'.join(labels) + ' ' + valueName] = values[:, column]
+        for labels, states, values in zip(compiledProtocol.angleLabels, compiledProtocol.angleStates,
+                                          np.moveaxis(measurements["angles"], 1, 0)):
+            for column, valueName in enumerate(('Pitch', 'Roll', 'Yaw')):
+                if states[column]:
+                    columns['-'.join(labels[:2]) + ' / ' + '-'.join(labels[2:]) + ' ' + valueName] = values[:, column]
+        for labels, values in zip(compiledProtocol.linePointLabels, np.moveaxis(measurements["linePoints"], 1, 0)):
+            for column, valueName in enumerate(('R-L', 'A-P', 'S-I', '3D')):
+                columns['-'.join(labels[:2]) + ' / ' + labels[2] + ' ' + valueName] = values[:, column]
+        timeSeriesTableNode = self.getResultTableNode('timeSeries')
+        with NodeModify(timeSeriesTableNode):
+            timeSeriesTableNode.SetAndObserveTable(self.tableFromColumns(columns))
+        return trackingTableNode, timeSeriesTableNode
+
     def drawLineBetween2Landmark(self, landmark1label, landmark2label, fidList1, fidList2):
         if not fidList1 or not fidList2 or not landmark1label or not landmark2label:
-            return
+            return None, None
         landmark1ID = self.findIDFromLabel(fidList1, landmark1label)
         landmark2ID = self.findIDFromLabel(fidList2, landmark2label)
 
@@ -1742,10 +4168,8 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
         landmark1Index = fidList1.GetNthControlPointIndexByID(landmark1ID)
         landmark2Index = fidList2.GetNthControlPointIndexByID(landmark2ID)
 
-        coord1 = [-1, -1, -1]
-        coord2 = [-1, -1, -1]
-        fidList1.GetNthFiducialPosition(landmark1Index, coord1)
-        fidList2.GetNthFiducialPosition(landmark2Index, coord2)
+        coord1 = self.getLandmarkPosition(fidList1, landmark1Index)
+        coord2 = self.getLandmarkPosition(fidList2, landmark2Index)
 
         line = vtk.vtkLineSource()
         line.SetPoint1(coord1)
@@ -1770,6 +4194,126 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
 
         return renderer, actor
 
+    # typeCalculation -> (storage class, (attribute, column) of the landmark
+    # names, attributes of their IDs, (attribute, column) of the values)
+    resultTableFields = {
+        'distance': ('distanceValuesStorage',
+                     (('startLandmarkName', 'Landmark A'), ('endLandmarkName', 'Landmark B')),
+                     ('startLandmarkID', 'endLandmarkID'),
+                     (('RLComponent', 'R-L Component'), ('APComponent', 'A-P Component'),
+                      ('SIComponent', 'S-I Component'), ('ThreeDComponent', '3D Distance'))),
+        'angle': ('angleValuesStorage',
+                  (('landmarkALine1Name', 'Line 1 Landmark A'), ('landmarkBLine1Name', 'Line 1 Landmark B'),
+                   ('landmarkALine2Name', 'Line 2 Landmark A'), ('landmarkBLine2Name', 'Line 2 Landmark B')),
+                  ('landmarkALine1ID', 'landmarkBLine1ID', 'landmarkALine2ID', 'landmarkBLine2ID'),
+                  (('Yaw', 'Yaw'), ('Pitch', 'Pitch'), ('Roll', 'Roll'))),
+        'linePoint': ('distanceLinePointStorage',
+                      (('landmarkALineName', 'Line Landmark A'), ('landmarkBLineName', 'Line Landmark B'),
+                       ('landmarkPointName', 'Landmark X')),
+                      ('landmarkALineID', 'landmarkBLineID', 'landmarkPointID'),
+                      (('RLComponent', 'R-L Component'), ('APComponent', 'A-P Component'),
+                       ('SIComponent', 'S-I Component'), ('ThreeDComponent', '3D Distance'))),
+    }
+    resultTableNames = {'distance': 'Q3DC Distances', 'angle': 'Q3DC Angles', 'linePoint': 'Q3DC Line-Point Distances',
+                        'asymmetry': 'Q3DC Asymmetry', 'edma': 'Q3DC EDMA',
+                        'procrustes': 'Q3DC Procrustes', 'tracking': 'Q3DC Tracking',
+                        'timeSeries': 'Q3DC Time Series'}
+
+    def getResultTableNode(self, typeCalculation, create=True):
+        """Return the table node holding the results of typeCalculation
+        ('distance', 'angle' or 'linePoint'), saved with the scene."""
+        for tableNode in slicer.mrmlScene.GetNodesByClass("vtkMRMLTableNode"):
+            if tableNode.GetAttribute("Q3DCResultType") == typeCalculation:
+                return tableNode
+        if not create:
+            return None
+        tableNode = slicer.mrmlScene.AddNewNodeByClass(
+            "vtkMRMLTableNode", slicer.mrmlScene.GenerateUniqueName(self.resultTableNames[typeCalculation]))
+        tableNode.SetAttribute("Q3DCResultType", typeCalculation)
+        return tableNode
+
+    def resultColumns(self, listToExport, typeCalculation, supplements=False):
+        """Columns of listToExport: the landmark names and IDs as lists of
+        strings, then one float64 array per value, NaN where it was not
+        computed. With supplements, each angle is followed by its supplement.
+        The columns are gathered from the storage objects, one getattr per
+        value: this is a copy, not a view of the result tables."""
+        storageName, nameFields, idAttributes, valueFields = self.resultTableFields[typeCalculation]
+        columns = OrderedDict()
+        for attribute, columnName in nameFields:
+            columns[columnName] = [str(getattr(element, attribute)) for element in listToExport]
+        for attribute, (_, columnName) in zip(idAttributes, nameFields):
+            columns[columnName + ' ID'] = [str(getattr(element, attribute)) for element in listToExport]
+        # None (not computed) becomes NaN in a float64 array
+        values = np.array([[getattr(element, attribute) for attribute, _ in valueFields]
+                           for element in listToExport],
+                          dtype=np.float64).reshape((-1, len(valueFields)))
+        for (_, columnName), columnValues in zip(valueFields, values.T):
+            columns[columnName] = np.ascontiguousarray(columnValues)
+            if supplements and typeCalculation == 'angle':
+                columns[columnName + ' Supplement'] = np.sign(columnValues) * (180 - np.abs(columnValues))
+        return columns
+
+    def updateResultTable(self, typeCalculation, listToExport):
+        """Write listToExport in the result table of typeCalculation. The
+        values are written one column at a time from NumPy arrays, missing
+        values (e.g. angles not computed) are NaN."""
+        tableNode = self.getResultTableNode(typeCalculation)
+        with NodeModify(tableNode):
+            tableNode.SetAndObserveTable(self.tableFromColumns(self.resultColumns(listToExport, typeCalculation)))
+        return tableNode
+
+    @staticmethod
+    def tableFromColumns(columns):
+        # vtkTable of the columns {name: NumPy array or list of strings}, the
+        # arrays are converted in bulk.
+        table = vtk.vtkTable()
+        for columnName, columnValues in columns.items():
+            if isinstance(columnValues, np.ndarray):
+                column = numpy_support.numpy_to_vtk(np.ascontiguousarray(columnValues, dtype=np.float64), deep=True)
+            else:
+                column = vtk.vtkStringArray()
+                column.SetNumberOfValues(len(columnValues))
+                for n, value in enumerate(columnValues):
+                    column.SetValue(n, value)
+            column.SetName(columnName)
+            table.AddColumn(column)
+        return table
+
+    def resultsFromTable(self, typeCalculation):
+        """Rebuild the list of results of typeCalculation from its result
+        table, e.g. after the scene was reloaded. Return [] if there is none."""
+        tableNode = self.getResultTableNode(typeCalculation, create=False)
+        if tableNode is None or tableNode.GetNumberOfRows() == 0:
+            return []
+        storageName, nameFields, idAttributes, valueFields = self.resultTableFields[typeCalculation]
+        table = tableNode.GetTable()
+        numberOfRows = table.GetNumberOfRows()
+        def stringColumn(columnName):
+            column = table.GetColumnByName(columnName)
+            return [column.GetVariantValue(n).ToString() for n in range(numberOfRows)]
+        def numericColumn(columnName):
+            column = table.GetColumnByName(columnName)
+            if column.IsNumeric():
+                return numpy_support.vtk_to_numpy(column).astype(np.float64)
+            # columns read back without their schema are strings
+            return np.array([float(column.GetVariantValue(n).ToString() or 'nan')
+                             for n in range(numberOfRows)])
+        names = [stringColumn(column) for _, column in nameFields]
+        ids = [stringColumn(column + ' ID') for _, column in nameFields]
+        values = np.column_stack([numericColumn(column) for _, column in valueFields])
+        resultList = []
+        for n in range(numberOfRows):
+            element = getattr(self, storageName)()
+            for (attribute, _), column in zip(nameFields, names):
+                setattr(element, attribute, column[n])
+            for attribute, column in zip(idAttributes, ids):
+                setattr(element, attribute, column[n])
+            for (attribute, _), value in zip(valueFields, values[n]):
+                setattr(element, attribute, None if np.isnan(value) else float(value))
+            resultList.append(element)
+        return resultList
+
     def exportationFunction(self, directoryExport, filenameExport, listToExport, typeCalculation):
         messageBox = ctk.ctkMessageBox()
         messageBox.setWindowTitle(' /!\ WARNING /!\ ')
@@ -1783,85 +4327,195 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             choice = messageBox.exec_()
             if choice == messageBox.No:
                 return
-        self.exportAsCSV(fileName, listToExport, typeCalculation)
-        slicer.util.delayDisplay(f'Saved to {fileName}')
+        # Only the labels and the value arrays are read on the main thread,
+        # the rows are formatted (or converted to pyarrow) by the worker.
+        numberOfRows = len(listToExport)
+        if os.path.splitext(fileName)[1].lower() in self.columnarExtensions:
+            pyarrow = self.importPyArrow()
+            if pyarrow is None:
+                return
+            columns = self.resultColumns(listToExport, typeCalculation, supplements=True)
+            def write(setProgress, cancelEvent):
+                return self.writeColumnar(fileName, pyarrow.table(columns), setProgress, cancelEvent)
+        else:
+            header, columns = self.exportColumns(listToExport, typeCalculation)
+            def write(setProgress, cancelEvent):
+                return self.writeCSV(fileName, header, self.exportRowsFromColumns(typeCalculation, columns),
+                                     setProgress, cancelEvent)
+        progressDialog = qt.QProgressDialog('Exporting to ' + fileName, 'Cancel', 0, max(numberOfRows, 1))
+        progressDialog.setWindowTitle('Export')
+        progressDialog.setMinimumDuration(500)
+
+        def onProgress(worker):
+            progressDialog.setValue(worker.rowsWritten)
+
+        def onFinished(worker):
+            progressDialog.close()
+            self.exportWorkers.discard(worker)
+            if worker.error is not None:
+                slicer.util.errorDisplay('Unable to save ' + fileName)
+                logging.info('Export to ' + fileName + ' failed.\n' + repr(worker.error))
+            elif worker.completed:
+                slicer.util.showStatusMessage(f'Saved to {fileName}', 3000)
+            else:
+                slicer.util.showStatusMessage('Export cancelled', 3000)
+
+        worker = self.exportWorker(write, numberOfRows, onFinished, onProgress)
+        progressDialog.connect('canceled()', worker.cancel)
+        self.exportWorkers.add(worker)
+        worker.start()
+        return worker
+
+    class exportWorker(object):
+        """Write an export from a background thread.
+
+        write(setProgress, cancelEvent) writes an immutable snapshot taken on
+        the main thread, so the measurements can change while it runs, and
+        returns False if it was cancelled. The thread does not touch Qt or
+        MRML objects: a timer on the main thread polls it to call
+        onProgress(worker) and, once it is done, onFinished(worker).
+        """
+        def __init__(self, write, numberOfRows, onFinished, onProgress=None):
+            self.numberOfRows = numberOfRows
+            self.rowsWritten = 0
+            self.completed = False
+            self.error = None
+            self.onFinished = onFinished
+            self.onProgress = onProgress
+            self.cancelEvent = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(write,))
+            self.thread.daemon = True
+            self.timer = qt.QTimer()
+            self.timer.setInterval(100)
+            self.timer.connect('timeout()', self.poll)
+
+        def start(self):
+            self.thread.start()
+            self.timer.start()
+
+        def run(self, write):
+            def setProgress(rowsWritten):
+                self.rowsWritten = rowsWritten
+            try:
+                self.completed = write(setProgress, self.cancelEvent)
+            except Exception as e:
+                self.error = e
+
+        def poll(self):
+            if self.onProgress is not None:
+                self.onProgress(self)
+            if self.thread.is_alive():
+                return
+            self.timer.stop()
+            self.onFinished(self)
 
+        def cancel(self):
+            self.cancelEvent.set()
 
-    def exportAsCSV(self,filename, listToExport, typeCalculation):
-        #  Export fields on different csv files
-        file = open(filename, 'w')
-        cw = csv.writer(file, delimiter=',')
-        print(typeCalculation)
+    def exportColumns(self, listToExport, typeCalculation):
+        """Return the CSV header and the columns of listToExport (see
+        resultColumns), a snapshot that can be formatted from another thread
+        by exportRowsFromColumns."""
         if typeCalculation == 'distance':
-            cw.writerow([' Landmark A - Landmark B',  ' R-L Component', ' A-P Component', ' S-I Component', ' 3D Distance '])
-            self.writeDistance(cw, listToExport)
+            header = [' Landmark A - Landmark B',  ' R-L Component', ' A-P Component', ' S-I Component', ' 3D Distance ']
         elif typeCalculation == 'linePoint':
-            cw.writerow([' Landmark A - Landmark B / Landmark X',  ' R-L Component', ' A-P Component', ' S-I Component', ' 3D Distance '])
-            self.writeLinePoint(cw, listToExport)
+            header = [' Landmark A - Landmark B / Landmark X',  ' R-L Component', ' A-P Component', ' S-I Component', ' 3D Distance ']
         else:
-            cw.writerow([' Line 1 (Landmark A - Landmark B) |  Line 2 (Landmark A - Landmark B)',  ' YAW ', ' PITCH ', ' ROLL '])
-            self.writeAngle(cw, listToExport)
-        file.close()
-        if self.decimalPoint != '.':
-            self.replaceCharac(filename, ',', ';') # change the Delimiter and put a semicolon instead of a comma
-            self.replaceCharac(filename, '.', self.decimalPoint) # change the decimal separator '.' for a comma
+            header = [' Line 1 (Landmark A - Landmark B) |  Line 2 (Landmark A - Landmark B)',  ' YAW ', ' PITCH ', ' ROLL ']
+        return tuple(header), self.resultColumns(listToExport, typeCalculation)
 
-    def writeDistance(self, fileWriter, listToExport):
-        for element in listToExport:
-            startLandName = element.startLandmarkName
-            endLandName = element.endLandmarkName
-            label = startLandName + ' - ' + endLandName
-            fileWriter.writerow([label,
-                                 element.RLComponent,
-                                 element.APComponent,
-                                 element.SIComponent,
-                                 element.ThreeDComponent])
-
-    def writeLinePoint(self, fileWriter, listToExport):
-        for element in listToExport:
-            landmarkALineName = element.landmarkALineName
-            landmarkBLineName = element.landmarkBLineName
-            landmarkPoint = element.landmarkPointName
-            label = landmarkALineName + ' - ' + landmarkBLineName + ' / ' + landmarkPoint
-            fileWriter.writerow([label,
-                                 element.RLComponent,
-                                 element.APComponent,
-                                 element.SIComponent,
-                                 element.ThreeDComponent])
-
-    def writeAngle(self, fileWriter, listToExport):
-        for element in listToExport:
-            print("element")
-            print(element)
-            landmarkALine1Name = element.landmarkALine1Name
-            landmarkBLine1Name = element.landmarkBLine1Name
-            landmarkALine2Name = element.landmarkALine2Name
-            landmarkBLine2Name = element.landmarkBLine2Name
-
-            label = landmarkALine1Name + '-' + landmarkBLine1Name + ' | ' + landmarkALine2Name + '-' + landmarkBLine2Name
-            signY = np.sign(element.Yaw)
-            signP = np.sign(element.Pitch)
-            signR = np.sign(element.Roll)
-
-            if element.Yaw:
-                YawLabel = str(element.Yaw) +' | '+str(signY*(180-abs(element.Yaw)))
+    @staticmethod
+    def exportRowsFromColumns(typeCalculation, columns):
+        """Formatted rows of the columns of exportColumns: the labels of the
+        landmarks then the values, each angle with its supplement. Only the
+        columns are read."""
+        _, nameFields, _, valueFields = Q3DCLogic.resultTableFields[typeCalculation]
+        names = [columns[columnName] for _, columnName in nameFields]
+        values = [[None if np.isnan(value) else value for value in columns[columnName].tolist()]
+                  for _, columnName in valueFields]
+        for labels, rowValues in zip(zip(*names), zip(*values)):
+            if typeCalculation == 'distance':
+                yield [' - '.join(labels)] + list(rowValues)
+            elif typeCalculation == 'linePoint':
+                yield [labels[0] + ' - ' + labels[1] + ' / ' + labels[2]] + list(rowValues)
             else:
-                YawLabel = '-'
+                yield [labels[0] + '-' + labels[1] + ' | ' + labels[2] + '-' + labels[3]] + \
+                      [Q3DCLogic.angleLabel(angle) for angle in rowValues]
+
+    def writeCSV(self, filename, header, rows, setProgress=None, cancelEvent=None):
+        """Write header and rows in filename, with the delimiter and the
+        decimal separator of the locale. Return False, without writing the
+        file, if cancelEvent is set before all the rows are formatted."""
+        buffer = io.StringIO()
+        cw = csv.writer(buffer, delimiter=',')
+        cw.writerow(header)
+        for n, row in enumerate(rows):
+            if cancelEvent is not None and cancelEvent.is_set():
+                return False
+            cw.writerow(row)
+            if setProgress is not None:
+                setProgress(n + 1)
+        text = buffer.getvalue()
+        if self.decimalPoint != '.':
+            # change the Delimiter and put a semicolon instead of a comma, and
+            # the decimal separator '.' for the one of the locale
+            text = text.replace(',', ';').replace('.', self.decimalPoint)
+        with open(filename, 'w') as file:
+            file.write(text)
+        return True
 
-            if element.Pitch:
-                PitchLabel = str(element.Pitch)+' | '+str(signP*(180-abs(element.Pitch)))
-            else:
-                PitchLabel = '-'
+    # Exports to these extensions are columnar, written with pyarrow
+    columnarExtensions = ('.parquet', '.arrow', '.feather')
 
-            if element.Roll:
-                RollLabel = str(element.Roll)+' | '+str(signR*(180-abs(element.Roll)))
-            else:
-                RollLabel = '-'
+    @staticmethod
+    def importPyArrow():
+        # pyarrow is only needed for the columnar exports, it is installed on
+        # demand.
+        try:
+            import pyarrow
+        except ModuleNotFoundError:
+            if not slicer.util.confirmOkCancelDisplay(
+                    'Exporting to Parquet or Arrow requires the pyarrow package. Install it now?'):
+                return None
+            # This requires a network connection!
+            slicer.util.pip_install('pyarrow')
+            import pyarrow
+        return pyarrow
+
+    @staticmethod
+    def writeColumnar(filename, table, setProgress=None, cancelEvent=None, chunkSize=65536):
+        """Write a pyarrow table in filename, as Parquet for a .parquet
+        extension and as an Arrow IPC (Feather) file otherwise, chunkSize rows
+        at a time. Return False, and remove the partial file, if cancelEvent
+        is set before all the rows are written."""
+        import pyarrow.ipc
+        import pyarrow.parquet
+        if os.path.splitext(filename)[1].lower() == '.parquet':
+            writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+        else:
+            writer = pyarrow.ipc.new_file(filename, table.schema)
+        cancelled = False
+        try:
+            for offset in range(0, table.num_rows, chunkSize):
+                if cancelEvent is not None and cancelEvent.is_set():
+                    cancelled = True
+                    break
+                writer.write_table(table.slice(offset, chunkSize))
+                if setProgress is not None:
+                    setProgress(min(offset + chunkSize, table.num_rows))
+        finally:
+            writer.close()
+        if cancelled:
+            os.remove(filename)
+            return False
+        return True
 
-            fileWriter.writerow([label,
-                                 YawLabel,
-                                 PitchLabel,
-                                 RollLabel])
+    @staticmethod
+    def angleLabel(angle):
+        # An angle and its supplement, '-' if it was not computed
+        if angle:
+            return str(angle) + ' | ' + str(np.sign(angle) * (180 - abs(angle)))
+        return '-'
 
     def replaceCharac(self, filename, oldCharac, newCharac):
         #  Function to replace a charactere (oldCharac) in a file (filename) by a new one (newCharac)
@@ -1926,10 +4580,61 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             displayNode.SetActiveScalarName(scalarName)
             displayNode.SetScalarVisibility(True)
 
+    def surfaceDisplacement(self, sourceModel, targetModel, chunkSize=262144):
+        """Displacement of every vertex of sourceModel to the surface of
+        targetModel, e.g. between two timepoints. Each vertex goes to the
+        closest vertex of the target (cached kd-tree of its hardened copy),
+        then to the tangent plane of the target there: the distance is the
+        one to that plane, not to the closest point on the triangles, and
+        differs from it where the target is curved at the scale of its
+        edges. Return the signed distances (N), positive outside the target
+        along its outward oriented normals, and the R-L, A-P, S-I components
+        of the displacements (N x 3). The sign is only reliable for a closed
+        target surface: on an open one it follows the normals oriented by
+        vtkPolyDataNormals. The vertices are processed in chunks of
+        chunkSize to bound the memory used. The hardened copies made only
+        for this computation are released afterwards."""
+        temporaryModelIDs = [model.GetID() for model in (sourceModel, targetModel)
+                             if self.hardenModels.get(model) is None]
+        try:
+            sourcePoints = numpy_support.vtk_to_numpy(
+                self.hardenModels.acquire(sourceModel).GetPolyData().GetPoints().GetData())
+            targetIndex = self.getSurfaceIndex(self.hardenModels.acquire(targetModel))
+            targetNormals = targetIndex.pointNormals()
+            distances = np.empty(len(sourcePoints))
+            components = np.empty((len(sourcePoints), 3))
+            for start in range(0, len(sourcePoints), chunkSize):
+                points = sourcePoints[start:start + chunkSize].astype(np.float64)
+                closest = targetIndex.closestPointIndices(points)
+                normals = targetNormals[closest]
+                signedDistances = np.einsum('ij,ij->i', points - targetIndex.points[closest], normals)
+                distances[start:start + chunkSize] = signedDistances
+                components[start:start + chunkSize] = -signedDistances[:, np.newaxis] * normals
+        finally:
+            for modelID in temporaryModelIDs:
+                self.hardenModels.releaseIfUnreferenced(modelID)
+        return distances, components
+
+    def displaySurfaceDisplacement(self, sourceModel, targetModel, arrayName="Q3DC Displacement"):
+        """Add the signed distances of surfaceDisplacement to the point data
+        of sourceModel as the scalar array arrayName, its components as the
+        arrays arrayName R-L, A-P and S-I, and show the distances."""
+        distances, components = self.surfaceDisplacement(sourceModel, targetModel)
+        pointData = sourceModel.GetPolyData().GetPointData()
+        for name, values in [(arrayName, distances)] + \
+                [(arrayName + ' ' + axisName, components[:, axis]) for axis, axisName in enumerate(('R-L', 'A-P', 'S-I'))]:
+            if pointData.HasArray(name):
+                pointData.RemoveArray(name)
+            array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=True)
+            array.SetName(name)
+            pointData.AddArray(array)
+        self.displayROI(sourceModel, arrayName)
+        return distances, components
+
     def findROI(self, fidList):
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
+        hardenModel = self.getHardenModel(fidList)
         connectedModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("connectedModelID"))
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkDescription = self.getLandmarkDescription(fidList)
         arrayName = fidList.GetAttribute("arrayName")
         ROIPointListID = vtk.vtkIdList()
         for key,activeLandmarkState in landmarkDescription.items():
@@ -1965,6 +4670,203 @@ class Q3DCLogic(ScriptedLoadableModuleLogic):
             return json.loads(input)
         return None
 
+    # Version of the compact format of the landmark descriptions: a table
+    # node referenced by the fiducial list, one row per landmark. The
+    # definedByThisMarkup lists are not stored, they follow from the Point1
+    # and Point2 of the midpoints.
+    landmarkTableVersion = 1
+    landmarkTableReference = "Q3DCLandmarkDescription"
+
+    def getLandmarkDescription(self, fidList):
+        """Return the landmarkDescription of fidList. After a scene is
+        loaded, it is parsed from the compact table of the list on first
+        access."""
+        encoded = fidList.GetAttribute("landmarkDescription")
+        if encoded is not None:
+            return self.decodeJSON(encoded)
+        tableNode = fidList.GetNodeReference(self.landmarkTableReference)
+        if tableNode is None:
+            return None
+        landmarkDescription = self.landmarkDescriptionFromTable(tableNode)
+        if landmarkDescription is not None:
+            fidList.SetAttribute("landmarkDescription", self.encodeJSON(landmarkDescription))
+        return landmarkDescription
+
+    def setLandmarkDescription(self, fidList, landmarkDescription):
+        fidList.SetAttribute("landmarkDescription", self.encodeJSON(landmarkDescription))
+        self.trackLandmarkLocks(fidList, landmarkDescription.keys())
+        # the compact table is written once the edits settle
+        self.pendingLandmarkTables.add(fidList.GetID())
+        if not self.landmarkTableTimer.isActive():
+            self.landmarkTableTimer.start()
+
+    def trackLandmarkLocks(self, fidList, markupIDs):
+        # The landmarks of fidList are markupIDs: the new ones are locked on
+        # the next UpdateThreeDView.
+        fidListID = fidList.GetID()
+        markupIDs = set(markupIDs)
+        unlockedID, knownIDs = self.lockStates.get(fidListID, (None, set()))
+        addedIDs = markupIDs - knownIDs
+        if addedIDs:
+            self.pendingLocks[fidListID].update(addedIDs)
+        self.lockStates[fidListID] = (unlockedID, markupIDs)
+
+    @staticmethod
+    def landmarkDescriptionColumns(landmarkDescription):
+        # Columns of the compact table of landmarkDescription, the missing
+        # indices are -1 and the missing weights NaN.
+        markupIDs = list(landmarkDescription.keys())
+        states = [landmarkDescription[markupID] for markupID in markupIDs]
+        projections = [state["projection"] for state in states]
+        midPoints = [state["midPoint"] for state in states]
+        def index(value):
+            return -1 if value is None else value
+        columns = OrderedDict()
+        columns['markupID'] = markupIDs
+        columns['landmarkLabel'] = [state.get("landmarkLabel") or '' for state in states]
+        columns['ROIradius'] = np.array([state["ROIradius"] for state in states], dtype=np.float64)
+        columns['isProjected'] = np.array([projection["isProjected"] for projection in projections], dtype=np.float64)
+        columns['closestPointIndex'] = np.array([index(projection["closestPointIndex"]) for projection in projections],
+                                                dtype=np.float64)
+        columns['cellID'] = np.array([index(projection.get("cellID")) for projection in projections], dtype=np.float64)
+        for k in range(3):
+            columns['cellPointID%d' % k] = np.array([projection["cellPointIDs"][k] if "cellPointIDs" in projection
+                                                     else -1 for projection in projections], dtype=np.float64)
+        for k in range(3):
+            columns['weight%d' % k] = np.array([projection["weights"][k] if "weights" in projection
+                                                else np.nan for projection in projections], dtype=np.float64)
+        columns['isMidPoint'] = np.array([midPoint["isMidPoint"] for midPoint in midPoints], dtype=np.float64)
+        columns['Point1'] = [midPoint["Point1"] or '' for midPoint in midPoints]
+        columns['Point2'] = [midPoint["Point2"] or '' for midPoint in midPoints]
+        return columns
+
+    def landmarkDescriptionFromTable(self, tableNode):
+        """Parse the landmarkDescription stored in the compact table
+        tableNode, or return None if its format version is unknown."""
+        version = tableNode.GetAttribute("Q3DCLandmarkTableVersion")
+        if version != str(self.landmarkTableVersion):
+            logging.info('Q3DC: unknown version %s of the landmark table %s' % (version, tableNode.GetName()))
+            return None
+        table = tableNode.GetTable()
+        def column(name, numeric=True):
+            array = table.GetColumnByName(name)
+            if isinstance(array, vtk.vtkDataArray):
+                return numpy_support.vtk_to_numpy(array)
+            # read from a file without schema, all the columns are strings
+            values = [array.GetValue(n) for n in range(array.GetNumberOfValues())]
+            return np.array(values, dtype=np.float64) if numeric else values
+        markupIDs = column('markupID', numeric=False)
+        labels = column('landmarkLabel', numeric=False)
+        radii = column('ROIradius')
+        isProjected = column('isProjected')
+        closestPointIndices = column('closestPointIndex')
+        cellIDs = column('cellID')
+        cellPointIDs = np.column_stack([column('cellPointID%d' % k) for k in range(3)]) if len(markupIDs) else []
+        weights = np.column_stack([column('weight%d' % k) for k in range(3)]) if len(markupIDs) else []
+        isMidPoint = column('isMidPoint')
+        points1 = column('Point1', numeric=False)
+        points2 = column('Point2', numeric=False)
+        landmarkDescription = dict()
+        for n, markupID in enumerate(markupIDs):
+            projection = {
+                "isProjected": bool(isProjected[n]),
+                "closestPointIndex": None if closestPointIndices[n] < 0 else int(closestPointIndices[n]),
+            }
+            if cellIDs[n] >= 0:
+                projection["cellID"] = int(cellIDs[n])
+                projection["cellPointIDs"] = [int(pointID) for pointID in cellPointIDs[n]]
+                projection["weights"] = [float(weight) for weight in weights[n]]
+            radius = float(radii[n])
+            landmarkDescription[markupID] = {
+                "landmarkLabel": labels[n],
+                "ROIradius": int(radius) if radius.is_integer() else radius,
+                "projection": projection,
+                "midPoint": {
+                    "definedByThisMarkup": [],
+                    "isMidPoint": bool(isMidPoint[n]),
+                    "Point1": points1[n] or None,
+                    "Point2": points2[n] or None,
+                },
+            }
+        for markupID, state in landmarkDescription.items():
+            if state["midPoint"]["isMidPoint"]:
+                for pointID in (state["midPoint"]["Point1"], state["midPoint"]["Point2"]):
+                    if pointID in landmarkDescription:
+                        landmarkDescription[pointID]["midPoint"]["definedByThisMarkup"].append(markupID)
+        return landmarkDescription
+
+    def updateLandmarkTable(self, fidList):
+        """Write the landmarkDescription of fidList to its compact table,
+        saved with the scene."""
+        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        if landmarkDescription is None:
+            return None
+        tableNode = fidList.GetNodeReference(self.landmarkTableReference)
+        if tableNode is None:
+            tableNode = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLTableNode", slicer.mrmlScene.GenerateUniqueName(fidList.GetName() + "_landmarks"))
+            tableNode.HideFromEditorsOn()
+            fidList.SetNodeReferenceID(self.landmarkTableReference, tableNode.GetID())
+        with NodeModify(tableNode):
+            tableNode.SetAttribute("Q3DCLandmarkTableVersion", str(self.landmarkTableVersion))
+            tableNode.SetAndObserveTable(self.tableFromColumns(self.landmarkDescriptionColumns(landmarkDescription)))
+        return tableNode
+
+    def updatePendingLandmarkTables(self):
+        for fidListID in self.pendingLandmarkTables:
+            fidList = slicer.mrmlScene.GetNodeByID(fidListID)
+            if fidList is not None:
+                self.updateLandmarkTable(fidList)
+        self.pendingLandmarkTables.clear()
+
+    def migrateLandmarkDescriptions(self):
+        """Write the compact tables of the lists of a loaded scene that still
+        has landmark descriptions in attributes: scenes saved before the
+        compact format, or lists whose table was not up to date when the
+        scene was saved."""
+        for fidList in slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode"):
+            if fidList.GetAttribute("landmarkDescription") is not None:
+                self.updateLandmarkTable(fidList)
+
+    @staticmethod
+    def isLandmarkTableWritten(tableNode):
+        # The data files are written before the scene: the table is on disk
+        # and up to date if it was not modified since it was written (or
+        # read) and its file exists.
+        storageNode = tableNode.GetStorageNode()
+        if storageNode is None or not storageNode.GetFileName() or tableNode.GetModifiedSinceRead():
+            return False
+        return os.path.exists(storageNode.GetFullNameFromFileName())
+
+    def onStartSaveScene(self):
+        # The lists whose compact table was already up to date and is written
+        # on disk are saved without the landmarkDescription attribute, it is
+        # put back after the save. The other ones keep their attribute, e.g.
+        # when the table is unchecked in the save dialog.
+        outdatedFidListIDs = set(self.pendingLandmarkTables)
+        self.updatePendingLandmarkTables()
+        for fidList in slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode"):
+            encoded = fidList.GetAttribute("landmarkDescription")
+            tableNode = fidList.GetNodeReference(self.landmarkTableReference)
+            if encoded is not None and tableNode is not None and fidList.GetID() not in outdatedFidListIDs \
+                    and self.isLandmarkTableWritten(tableNode):
+                self.savedLandmarkDescriptions[fidList.GetID()] = encoded
+                fidList.RemoveAttribute("landmarkDescription")
+
+    def onEndSaveScene(self):
+        for fidListID, encoded in self.savedLandmarkDescriptions.items():
+            fidList = slicer.mrmlScene.GetNodeByID(fidListID)
+            if fidList is not None and fidList.GetAttribute("landmarkDescription") is None:
+                fidList.SetAttribute("landmarkDescription", encoded)
+        self.savedLandmarkDescriptions.clear()
+
+    def removeLandmarkTable(self, fidList):
+        # fidList may already be out of the scene, only its reference IDs are valid
+        tableNode = slicer.mrmlScene.GetNodeByID(fidList.GetNodeReferenceID(self.landmarkTableReference) or "")
+        if tableNode is not None:
+            slicer.mrmlScene.RemoveNode(tableNode)
+        self.pendingLandmarkTables.discard(fidList.GetID())
+
     def UpdateLandmarkComboboxA(self, fidListCombobox, landmarkCombobox):
         self.comboboxdict[landmarkCombobox] = fidListCombobox.currentNode()
         self.updateLandmarkComboBox(fidListCombobox.currentNode(), landmarkCombobox)
@@ -1988,6 +4890,63 @@ class Q3DCTest(ScriptedLoadableModuleTest):
         self.delayDisplay(' Test Angles Components')
         self.assertTrue(self.test_CalculateDisplacement2())
 
+        self.delayDisplay(' Test Markups Snapshot')
+        self.assertTrue(self.test_MarkupsSnapshot())
+
+        self.delayDisplay(' Test Measurement Cache')
+        self.assertTrue(self.test_MeasurementCache())
+
+        self.delayDisplay(' Test Measurement Uncertainty')
+        self.assertTrue(self.test_MeasurementUncertainty())
+
+        self.delayDisplay(' Test Measurement Protocol')
+        self.assertTrue(self.test_MeasurementProtocol())
+
+        self.delayDisplay(' Test Result Tables')
+        self.assertTrue(self.test_ResultTables())
+
+        self.delayDisplay(' Test Export')
+        self.assertTrue(self.test_Export())
+
+        self.delayDisplay(' Test Planes')
+        self.assertTrue(self.test_Planes())
+
+        self.delayDisplay(' Test Bilateral Asymmetry')
+        self.assertTrue(self.test_BilateralAsymmetry())
+
+        self.delayDisplay(' Test EDMA')
+        self.assertTrue(self.test_EDMA())
+
+        self.delayDisplay(' Test Procrustes')
+        self.assertTrue(self.test_Procrustes())
+
+        self.delayDisplay(' Test Surface Displacement')
+        self.assertTrue(self.test_SurfaceDisplacement())
+
+        self.delayDisplay(' Test Model Preparation')
+        self.assertTrue(self.test_ModelPreparation())
+
+        self.delayDisplay(' Test Multi-Resolution Projection')
+        self.assertTrue(self.test_MultiResolution())
+
+        self.delayDisplay(' Test Batch Projection')
+        self.assertTrue(self.test_BatchProjection())
+
+        self.delayDisplay(' Test Sub-Vertex Projection')
+        self.assertTrue(self.test_SubVertexProjection())
+
+        self.delayDisplay(' Test Import Landmarks')
+        self.assertTrue(self.test_ImportLandmarks())
+
+        self.delayDisplay(' Test Walk On A Folded Surface')
+        self.assertTrue(self.test_WalkToClosestPoint())
+
+        self.delayDisplay(' Test Landmark Tracking')
+        self.assertTrue(self.test_LandmarkTracking())
+
+        self.delayDisplay(' Test Landmark Tables')
+        self.assertTrue(self.test_LandmarkTables())
+
         self.test_CalculateDisplacement1()
         self.test_CalculateDisplacement2()
 
@@ -2028,6 +4987,713 @@ class Q3DCTest(ScriptedLoadableModuleTest):
 
         return True
 
+    def test_MarkupsSnapshot(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        markupsNode1.AddFiducial(-5.331, 51.955, 4.831, 'A')
+        markupsNode1.AddFiducial(-8.018, 41.429, -52.621, 'B')
+        snapshot = logic.getMarkupsSnapshot(markupsNode1)
+        if list(snapshot.labels) != ['A', 'B'] or snapshot.positions.shape != (2, 3):
+            return False
+        if logic.getMarkupsSnapshot(markupsNode1) is not snapshot:
+            return False
+        markupsNode1.SetNthFiducialPosition(0, 1, 2, 3)
+        if logic.getMarkupsSnapshot(markupsNode1).positions[0].tolist() != [1, 2, 3]:
+            return False
+        logic.setLandmarkPositions(markupsNode1, [1], [[3, 4, 5]])
+        coord = [0, 0, 0]
+        markupsNode1.GetNthFiducialPosition(1, coord)
+        if coord != [3, 4, 5]:
+            return False
+        ID1, ID2 = logic.getMarkupsSnapshot(markupsNode1).ids
+        if logic.calculateMidPointCoord(markupsNode1, ID1, ID2) != [2, 3, 4]:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_MeasurementCache(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        markupsNode1.AddFiducial(0, 0, 0, 'A')
+        markupsNode1.AddFiducial(3, 4, 0, 'B')
+        markupsNode1.AddFiducial(1, 1, 1, 'C')
+        distanceList = logic.addOnDistanceList([], 'A', 'B', markupsNode1, markupsNode1)
+        if distanceList[0].ThreeDComponent != 5 or logic.measurements.misses != 1:
+            return False
+        # moving an other landmark does not invalidate the distance
+        markupsNode1.SetNthFiducialPosition(2, 2, 2, 2)
+        distanceList = logic.addOnDistanceList(distanceList, 'A', 'B', markupsNode1, markupsNode1)
+        if logic.measurements.hits != 1:
+            return False
+        markupsNode1.SetNthFiducialPosition(1, 6, 8, 0)
+        distanceList = logic.addOnDistanceList(distanceList, 'A', 'B', markupsNode1, markupsNode1)
+        if len(distanceList) != 1 or distanceList[0].ThreeDComponent != 10:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_MeasurementUncertainty(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        logic.uncertaintySigma = 0.5
+        logic.uncertaintyGenerator = np.random.default_rng(0)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        for label, coord in (('A', (0, 0, 0)), ('B', (30, 40, 0)), ('C', (0, 0, 10)), ('D', (30, 40, 10))):
+            markupsNode1.AddFiducial(coord[0], coord[1], coord[2], label)
+        distanceList = logic.addOnDistanceList([], 'A', 'B', markupsNode1, markupsNode1)
+        lower, upper = distanceList[0].confidenceIntervals['ThreeDComponent']
+        # the difference of two landmarks has a standard deviation of 0.5 * sqrt(2) along each axis
+        if not (48 < lower < 49.5 < 50 < 50.5 < upper < 52):
+            return False
+        angleList = logic.addOnAngleList([], 'A', 'B', markupsNode1, markupsNode1, 'C', 'D', markupsNode1,
+                                         markupsNode1, True, True, True)
+        lower, upper = angleList[0].confidenceIntervals['Yaw']
+        if not (lower < 0 < upper):
+            return False
+        # the protocol measurements get their intervals too, replacing the previous ones
+        protocol = logic.measurementProtocol({"distances": [["A", "B"]],
+                                              "angles": [{"line1": ["A", "B"], "line2": ["C", "D"], "pitch": False}]})
+        distanceList, angleList, _ = logic.addProtocolResults(logic.runMeasurementProtocol(protocol, markupsNode1),
+                                                              distanceList, angleList, [])
+        lower, upper = distanceList[0].confidenceIntervals['ThreeDComponent']
+        if not (48 < lower < 49.5 < 50 < 50.5 < upper < 52) or 'Pitch' in angleList[0].confidenceIntervals:
+            return False
+        logic.uncertaintySigma = 0
+        distanceList, _, _ = logic.addProtocolResults(logic.runMeasurementProtocol(protocol, markupsNode1),
+                                                      distanceList)
+        if distanceList[0].confidenceIntervals is not None:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_MeasurementProtocol(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        markupsNode1.AddFiducial(-5.331, 51.955, 4.831, 'A')
+        markupsNode1.AddFiducial(-8.018, 41.429, -52.621, 'B')
+        markupsNode1.AddFiducial(-1.091, 7.104, 7.917, 'C')
+        markupsNode1.AddFiducial(20.433, -3.236, 17.331, 'D')
+        protocol = logic.measurementProtocol({
+            "distances": [["A", "B"], ["A", "E"]],
+            "angles": [{"line1": ["A", "B"], "line2": ["C", "D"]}],
+            "linePoints": [{"line": ["A", "B"], "point": "C"}],
+        })
+        results = logic.runMeasurementProtocol(protocol, markupsNode1)
+        if results["compiledProtocol"].missingLabels != {"E"} or results["distances"].shape != (1, 4):
+            return False
+        distanceList = logic.addOnDistanceList([], 'A', 'B', markupsNode1, markupsNode1)
+        angleList = logic.addOnAngleList([], 'A', 'B', markupsNode1, markupsNode1,
+                                         'C', 'D', markupsNode1, markupsNode1, True, True, True)
+        linePointList = logic.addOnLinePointList([], 'A', 'B', markupsNode1, markupsNode1, 'C', markupsNode1)
+        distances, angles, linePoints = logic.addProtocolResults(results, [], [], [])
+        if [distances[0].RLComponent, distances[0].APComponent, distances[0].SIComponent,
+                distances[0].ThreeDComponent] != list(logic.defineDistances(markupsNode1, 0, markupsNode1, 1)):
+            return False
+        for name in ('Pitch', 'Roll', 'Yaw'):
+            if abs(getattr(angles[0], name) - getattr(angleList[0], name)) > 1e-6:
+                return False
+        if abs(linePoints[0].ThreeDComponent - linePointList[0].ThreeDComponent) > 1e-6:
+            return False
+        # empty sections, or sections without any known label, give empty results
+        protocol = logic.measurementProtocol({
+            "distances": [["A", "B"]],
+            "linePoints": [{"line": ["A", "E"], "point": "C"}],
+        })
+        results = logic.runMeasurementProtocol(protocol, markupsNode1)
+        if results["distances"].shape != (1, 4) or results["angles"].shape != (0, 3) \
+                or results["linePoints"].shape != (0, 4):
+            return False
+        distances, angles, linePoints = logic.addProtocolResults(results, [], [], [])
+        if len(distances) != 1 or angles or linePoints:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_ResultTables(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        markupsNode1.AddFiducial(0, 0, 0, 'A')
+        markupsNode1.AddFiducial(3, 4, 0, 'B')
+        markupsNode1.AddFiducial(1, 5, 2, 'C')
+        markupsNode1.AddFiducial(2, -1, 3, 'D')
+        distanceList = logic.addOnDistanceList([], 'A', 'B', markupsNode1, markupsNode1)
+        angleList = logic.addOnAngleList([], 'A', 'B', markupsNode1, markupsNode1,
+                                         'C', 'D', markupsNode1, markupsNode1, True, False, True)
+        logic.updateResultTable('distance', distanceList)
+        tableNode = logic.updateResultTable('angle', angleList)
+        if tableNode.GetNumberOfRows() != 1 or tableNode is not logic.getResultTableNode('angle'):
+            return False
+        distance, = logic.resultsFromTable('distance')
+        if (distance.startLandmarkName, distance.endLandmarkName, distance.ThreeDComponent) != ('A', 'B', 5):
+            return False
+        angle, = logic.resultsFromTable('angle')
+        if angle.Yaw is not None or angle.Pitch != angleList[0].Pitch or angle.landmarkALine2ID != angleList[0].landmarkALine2ID:
+            return False
+        # the rows formatted from the exported columns
+        _, columns = logic.exportColumns(distanceList, 'distance')
+        if list(logic.exportRowsFromColumns('distance', columns)) != [['A - B', 3, 4, 0, 5]]:
+            return False
+        _, columns = logic.exportColumns(angleList, 'angle')
+        row, = logic.exportRowsFromColumns('angle', columns)
+        if row != ['A-B | C-D', '-', logic.angleLabel(angleList[0].Pitch), logic.angleLabel(angleList[0].Roll)]:
+            return False
+        for typeCalculation in ('distance', 'angle'):
+            slicer.mrmlScene.RemoveNode(logic.getResultTableNode(typeCalculation))
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_Export(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        fileName = os.path.join(slicer.app.temporaryPath, 'Q3DCExportTest.csv')
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        header = (' Landmark A - Landmark B', ' 3D Distance ')
+        rows = [['A - B', 1.5], ['A - C', None]]
+        # cancelled before the rows are formatted, nothing is written
+        cancelEvent = threading.Event()
+        cancelEvent.set()
+        if logic.writeCSV(fileName, header, rows, cancelEvent=cancelEvent) is not False or os.path.exists(fileName):
+            return False
+        # the delimiter and the decimal separator follow the locale
+        logic.decimalPoint = ','
+        progress = []
+        if not logic.writeCSV(fileName, header, rows, progress.append) or progress != [1, 2]:
+            return False
+        with open(fileName) as file:
+            if file.read().splitlines() != [' Landmark A - Landmark B; 3D Distance ', 'A - B;1,5', 'A - C;']:
+                return False
+        os.remove(fileName)
+        # the worker reports a cancelled export without writing the file
+        finished = []
+        def write(setProgress, cancelEvent):
+            return logic.writeCSV(fileName, header, rows, setProgress, cancelEvent)
+        worker = logic.exportWorker(write, len(rows), finished.append)
+        worker.cancel()
+        worker.start()
+        worker.thread.join()
+        worker.poll()
+        if finished != [worker] or worker.completed or worker.error is not None or os.path.exists(fileName):
+            return False
+        # and the errors of the write
+        def failingWrite(setProgress, cancelEvent):
+            raise IOError('disk full')
+        worker = logic.exportWorker(failingWrite, len(rows), finished.append)
+        worker.start()
+        worker.thread.join()
+        worker.poll()
+        if finished[-1] is not worker or worker.completed or not isinstance(worker.error, IOError):
+            return False
+        # a completed export
+        worker = logic.exportWorker(write, len(rows), finished.append)
+        worker.start()
+        worker.thread.join()
+        worker.poll()
+        if not worker.completed or worker.rowsWritten != len(rows) or not os.path.exists(fileName):
+            return False
+        os.remove(fileName)
+        return True
+
+    def test_Planes(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        for label, coord in (('A', (0, 0, 0)), ('B', (10, 0, 0)), ('C', (0, 10, 0)), ('D', (10, 10, 0)),
+                             ('E', (3, 4, 5)), ('F', (3, 4, 15))):
+            markupsNode1.AddFiducial(coord[0], coord[1], coord[2], label)
+        plane = logic.definePlane(markupsNode1, 'horizontal', ['A', 'B', 'C', 'D'])
+        if not np.allclose(plane.normal, [0, 0, 1]) or not np.allclose(plane.origin, [5, 5, 0]):
+            return False
+        if logic.pointToPlaneDistances(markupsNode1, 'horizontal').tolist() != [0, 0, 0, 0, 5, 15]:
+            return False
+        E, F = logic.getMarkupsSnapshot(markupsNode1).ids[4:6]
+        if logic.lineToPlaneAngles(markupsNode1, 'horizontal', [(E, F)]).tolist() != [90]:
+            return False
+        # moving a defining landmark refits the plane
+        markupsNode1.SetNthFiducialPosition(3, 10, 10, 10)
+        markupsNode1.SetNthFiducialPosition(2, 0, 10, 10)
+        if not np.allclose(logic.getPlane(markupsNode1, 'horizontal').normal, [0, -1, 1] / np.sqrt(2)):
+            return False
+        logic.definePlane(markupsNode1, 'other', ['A', 'B', 'E'])
+        angles = logic.planeToPlaneAngles(markupsNode1, ['horizontal', 'other'])
+        if angles.shape != (2, 2) or angles[0, 0] != 0:
+            return False
+        # deleting a defining landmark removes the plane instead of failing
+        markupsNode1.RemoveMarkup(4)
+        if logic.getPlane(markupsNode1, 'other') is not None or logic.getPlane(markupsNode1, 'horizontal') is None:
+            return False
+        if logic.pointToPlaneDistances(markupsNode1, 'other') is not None \
+                or logic.planeToPlaneAngles(markupsNode1, ['horizontal', 'other']) is not None:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_BilateralAsymmetry(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        for label, coord in (('OrR', (30, 0, 0)), ('OrL', (-30, 0, 0)), ('RGo', (40, -50, -60)),
+                             ('LGo', (-40, -48, -60)), ('Ba', (0, -60, -20))):
+            markupsNode1.AddFiducial(coord[0], coord[1], coord[2], label)
+        asymmetry = logic.bilateralAsymmetry([markupsNode1])
+        if asymmetry is None or asymmetry["pairs"] != [('OrR', 'OrL'), ('RGo', 'LGo')]:
+            return False
+        if asymmetry["distances"].shape != (1, 2) or asymmetry["distances"][0, 0] > asymmetry["distances"][0, 1]:
+            return False
+        tableNode = logic.updateAsymmetryTable([markupsNode1], asymmetry)
+        if tableNode.GetNumberOfRows() != 2:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(tableNode)
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        return True
+
+    def test_EDMA(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        groups = ([], [])
+        for subject in range(6):
+            markupsNode = slicer.vtkMRMLMarkupsFiducialNode()
+            slicer.mrmlScene.AddNode(markupsNode)
+            scale = 1 + subject % 2 + 0.01 * subject
+            for label, coord in (('A', (0, 0, 0)), ('B', (10, 0, 0)), ('C', (0, 20, 0))):
+                markupsNode.AddFiducial(scale * coord[0], scale * coord[1], scale * coord[2], label)
+            groups[subject % 2].append(markupsNode)
+        edma = logic.euclideanDistanceMatrixAnalysis(*groups, numberOfBootstrap=200, seed=0)
+        if edma["labels"] != ['A', 'B', 'C'] or edma["forms1"].shape != (3, 3, 3):
+            return False
+        # the second group is about twice as large as the first one
+        if not (1.9 < edma["formDifference"][0, 1] < 2.1) or not (edma["lower"] <= edma["upper"]).all():
+            return False
+        tableNode = logic.updateEDMATable(edma)
+        if tableNode.GetNumberOfRows() != 3:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(tableNode)
+        for markupsNode in groups[0] + groups[1]:
+            slicer.mrmlScene.RemoveNode(markupsNode)
+        return True
+
+    def test_Procrustes(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        fidLists = []
+        # the same configuration translated and turned by 90 degrees around S-I
+        for transform in (lambda x, y, z: (x, y, z), lambda x, y, z: (-y + 5, x - 3, z + 7)):
+            markupsNode = slicer.vtkMRMLMarkupsFiducialNode()
+            slicer.mrmlScene.AddNode(markupsNode)
+            for label, coord in (('A', (0, 0, 0)), ('B', (10, 0, 0)), ('C', (0, 20, 0)), ('D', (0, 0, 30))):
+                markupsNode.AddFiducial(*transform(*coord), label)
+            fidLists.append(markupsNode)
+        procrustes = logic.generalizedProcrustesAnalysis(fidLists)
+        if not np.allclose(procrustes["distances"], 0) or not np.allclose(procrustes["aligned"][0],
+                                                                          procrustes["aligned"][1]):
+            return False
+        protocol = logic.measurementProtocol({"distances": [["A", "B"]]})
+        results = logic.runStackedMeasurementProtocol(protocol, procrustes["labels"], procrustes["aligned"])
+        if results["distances"].shape != (2, 1, 4) or not np.allclose(results["distances"][:, 0], [10, 0, 0, 10]):
+            return False
+        alignedFidLists = logic.createAlignedFidLists(fidLists, procrustes)
+        if alignedFidLists[1].GetNumberOfFiducials() != 4:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        for markupsNode in fidLists + alignedFidLists:
+            slicer.mrmlScene.RemoveNode(markupsNode)
+        return True
+
+    def test_SurfaceDisplacement(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        models = []
+        for radius in (10, 12):
+            sphere = vtk.vtkSphereSource()
+            sphere.SetRadius(radius)
+            sphere.SetThetaResolution(32)
+            sphere.SetPhiResolution(32)
+            sphere.Update()
+            model = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+            models.append(model)
+        distances, components = logic.displaySurfaceDisplacement(models[0], models[1])
+        # the inner sphere is 2 mm inside the outer one, the displacement is radial
+        if not np.allclose(distances, -2, atol=0.05):
+            return False
+        if not np.allclose(np.linalg.norm(components, axis=1), 2, atol=0.05):
+            return False
+        if models[0].GetModelDisplayNode().GetActiveScalarName() != "Q3DC Displacement":
+            return False
+        # the hardened copies of the models that no list references are released
+        if any(logic.hardenModels.get(model) is not None for model in models):
+            return False
+        logic.hardenModels.clear()
+        for model in models:
+            slicer.mrmlScene.RemoveNode(model)
+        return True
+
+    def test_ModelPreparation(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        sphere = vtk.vtkSphereSource()
+        sphere.Update()
+        model = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+        transform = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+        matrix = vtk.vtkMatrix4x4()
+        matrix.SetElement(0, 3, 10)
+        transform.SetMatrixTransformToParent(matrix)
+        model.SetAndObserveTransformNodeID(transform.GetID())
+        # switching models cancels the preparation
+        logic.prepareModel(model)
+        logic.cancelModelPreparation()
+        if logic.modelPreparation is not None or logic.hardenModels.get(model) is not None:
+            return False
+        logic.prepareModel(model)
+        hardenModel = logic.hardenModels.acquire(model)
+        points = numpy_support.vtk_to_numpy(hardenModel.GetPolyData().GetPoints().GetData())
+        expected = numpy_support.vtk_to_numpy(sphere.GetOutput().GetPoints().GetData()) + [10, 0, 0]
+        if not np.allclose(points, expected, atol=1e-5):
+            return False
+        surfaceIndex = logic.surfaceIndexes.get(hardenModel.GetID())
+        if surfaceIndex is None or surfaceIndex.neighbors is None or logic.getSurfaceIndex(hardenModel) is not surfaceIndex:
+            return False
+        # over budget, the unreferenced copy being returned is not evicted
+        logic.hardenModels.memoryBudget = 0
+        hardenModel = logic.hardenModels.acquire(model, update=True)
+        if not slicer.mrmlScene.IsNodePresent(hardenModel) or logic.hardenModels.get(model) is not hardenModel:
+            return False
+        logic.hardenModels.clear()
+        slicer.mrmlScene.RemoveNode(model)
+        slicer.mrmlScene.RemoveNode(transform)
+        return True
+
+    def test_MultiResolution(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        logic.multiResolutionPointThreshold = 1000
+        sphere = vtk.vtkSphereSource()
+        sphere.SetRadius(10)
+        sphere.SetThetaResolution(100)
+        sphere.SetPhiResolution(100)
+        sphere.Update()
+        model = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+        # the coarse surface is built in the background, dragging stays at
+        # full resolution until it is ready
+        hardenModel = logic.hardenModels.acquire(model)
+        worker = logic.multiResolutionWorkers.get(hardenModel.GetID())
+        if worker is None or logic.getMultiResolutionIndex(hardenModel) is not None:
+            return False
+        worker.thread.join()
+        worker.finish()
+        multiResolutionIndex = logic.getMultiResolutionIndex(hardenModel)
+        if multiResolutionIndex is None or len(multiResolutionIndex.coarse.points) >= len(multiResolutionIndex.finePoints):
+            return False
+        directions = np.random.default_rng(0).standard_normal((50, 3))
+        positions = 10.5 * directions / np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        results = logic.benchmarkMultiResolutionProjection(hardenModel, positions)
+        logging.info('Q3DC multi-resolution projection: %s' % results)
+        if results['refinedMeanError'] > results['coarseMeanError'] or results['refinedMaxError'] > 0.1:
+            return False
+        logic.hardenModels.clear()
+        slicer.mrmlScene.RemoveNode(model)
+        return True
+
+    def test_BatchProjection(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        models = []
+        for radius, center in ((10, (0, 0, 0)), (8, (1, 2, 0))):
+            sphere = vtk.vtkSphereSource()
+            sphere.SetRadius(radius)
+            sphere.SetCenter(center)
+            sphere.SetThetaResolution(40)
+            sphere.SetPhiResolution(40)
+            sphere.Update()
+            models.append(slicer.modules.models.logic().AddModel(sphere.GetOutput()))
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        markupsNode1.AddFiducial(12, 0, 1, 'A')
+        markupsNode1.AddFiducial(0, 11, 2, 'B')
+        # M is the midpoint of A and B, unselected like the midpoints of a loaded list
+        markupsNode1.AddFiducial(6, 5.5, 1.5, 'M')
+        markupsNode1.SetNthFiducialSelected(2, False)
+        A, B, M = logic.getMarkupsSnapshot(markupsNode1).ids
+
+        def expectedProjections(model):
+            # the landmarks A and B projected one at a time on a copy of the list
+            markupsNode2 = slicer.vtkMRMLMarkupsFiducialNode()
+            slicer.mrmlScene.AddNode(markupsNode2)
+            for position in logic.getMarkupsSnapshot(markupsNode1).positionsFromIDs([A, B]):
+                markupsNode2.AddFiducial(position[0], position[1], position[2])
+            hardenModel = logic.hardenModels.acquire(model)
+            indices = [logic.projectOnSurface(hardenModel, markupsNode2, markupID)
+                       for markupID in logic.getMarkupsSnapshot(markupsNode2).ids]
+            positions = logic.getMarkupsSnapshot(markupsNode2).positions.copy()
+            slicer.mrmlScene.RemoveNode(markupsNode2)
+            return indices, positions
+
+        def matches(indices, positions):
+            landmarkDescription = logic.getLandmarkDescription(markupsNode1)
+            if [landmarkDescription[markupID]["projection"]["closestPointIndex"] for markupID in (A, B)] != indices:
+                return False
+            if not landmarkDescription[M]["midPoint"]["isMidPoint"]:
+                return False
+            snapped = logic.getMarkupsSnapshot(markupsNode1).positionsFromIDs([A, B, M])
+            return np.allclose(snapped[:2], positions) and np.allclose(snapped[2], positions.mean(axis=0))
+
+        indices, positions = expectedProjections(models[0])
+        logic.createNewDataStructure(markupsNode1, models[0], True)
+        if not matches(indices, positions):
+            return False
+        indices, positions = expectedProjections(models[1])
+        logic.changementOfConnectedModel(markupsNode1, models[1], True)
+        if not matches(indices, positions):
+            return False
+        logic.hardenModels.clear()
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        for model in models:
+            slicer.mrmlScene.RemoveNode(model)
+        return True
+
+    def test_SubVertexProjection(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        logic.subVertexProjection = True
+        plane = vtk.vtkPlaneSource()
+        plane.SetOrigin(0, 0, 0)
+        plane.SetPoint1(4, 0, 0)
+        plane.SetPoint2(0, 4, 0)
+        plane.SetResolution(4, 4)
+        triangles = vtk.vtkTriangleFilter()
+        triangles.SetInputConnection(plane.GetOutputPort())
+        triangles.Update()
+        model = slicer.modules.models.logic().AddModel(triangles.GetOutput())
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        positions = np.array([[1.3, 2.6, 1.0], [0.2, 3.7, -2.0]])
+        for n, position in enumerate(positions):
+            markupsNode1.AddFiducial(position[0], position[1], position[2], 'L%d' % n)
+        markupIDs = list(logic.getMarkupsSnapshot(markupsNode1).ids)
+        landmarkDescription = dict((markupID, logic.newLandmarkState('L%d' % n, True))
+                                   for n, markupID in enumerate(markupIDs))
+        hardenModel = logic.hardenModels.acquire(model)
+        logic.projectLandmarksOnSurface(hardenModel, markupsNode1, markupIDs, landmarkDescription)
+        # the landmarks are projected inside the triangles, not on their vertices
+        projected = logic.getMarkupsSnapshot(markupsNode1).positions
+        if not np.allclose(projected, [[1.3, 2.6, 0], [0.2, 3.7, 0]], atol=1e-6):
+            return False
+        for markupID in markupIDs:
+            projection = landmarkDescription[markupID]["projection"]
+            if "cellID" not in projection or abs(sum(projection["weights"]) - 1) > 1e-9:
+                return False
+        # moving the model evaluates the stored cell projections again
+        markupsNode1.SetAttribute("connectedModelID", model.GetID())
+        logic.setLandmarkDescription(markupsNode1, landmarkDescription)
+        transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+        transform = vtk.vtkTransform()
+        transform.Translate(1, 2, 5)
+        transform.RotateZ(30)
+        transformNode.SetMatrixTransformToParent(transform.GetMatrix())
+        model.SetAndObserveTransformNodeID(transformNode.GetID())
+        logic.onModelModified(model, None)
+        moved = logic.getMarkupsSnapshot(markupsNode1).positions
+        transformedPositions = np.array([transform.TransformPoint(position) for position in positions])
+        expected = logic.getSurfaceIndex(logic.hardenModels.acquire(model)).closestSurfacePoints(transformedPositions)[0]
+        if not np.allclose(moved, expected, atol=1e-6):
+            return False
+        # a projection on the closest vertex drops the cell projection
+        logic.subVertexProjection = False
+        logic.projectLandmarksOnSurface(logic.hardenModels.acquire(model), markupsNode1, markupIDs,
+                                        landmarkDescription)
+        for markupID in markupIDs:
+            projection = landmarkDescription[markupID]["projection"]
+            if "cellID" in projection or "weights" in projection or "cellPointIDs" in projection:
+                return False
+        logic.hardenModels.clear()
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        slicer.mrmlScene.RemoveNode(model)
+        slicer.mrmlScene.RemoveNode(transformNode)
+        return True
+
+    def test_ImportLandmarks(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        sphere = vtk.vtkSphereSource()
+        sphere.SetRadius(10)
+        sphere.SetThetaResolution(40)
+        sphere.SetPhiResolution(40)
+        sphere.Update()
+        model = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        logic.createNewDataStructure(markupsNode1, model, True)
+        dispatcher = logic.markupsEventDispatcher(logic, markupsNode1)
+        logic.markupsDispatchers[markupsNode1.GetID()] = dispatcher
+
+        # count the point added handlers run and the landmarks projected
+        pointAddedRuns = []
+        dispatcherCall = dispatcher.call
+        def call(handler, caller, event):
+            if handler == logic.onPointAddedEvent and caller.GetID() not in logic.suspendedFidListIDs:
+                pointAddedRuns.append(caller.GetID())
+            dispatcherCall(handler, caller, event)
+        dispatcher.call = call
+        projectedIDs = []
+        projectLandmarksOnSurface = logic.projectLandmarksOnSurface
+        def project(modelOnProject, fidNode, markupIDs, landmarkDescription=None):
+            projectedIDs.extend(markupIDs)
+            return projectLandmarksOnSurface(modelOnProject, fidNode, markupIDs, landmarkDescription)
+        logic.projectLandmarksOnSurface = project
+
+        filePath = os.path.join(slicer.app.temporaryPath, 'Q3DCImportTest.fcsv')
+        with open(filePath, 'w', encoding='utf8') as fiducialsFile:
+            fiducialsFile.write('# Markups fiducial file version = 4.11\n'
+                                '# CoordinateSystem = RAS\n'
+                                '# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n'
+                                'vtkMRMLMarkupsFiducialNode_0,12,0,1,0,0,0,1,1,1,0,A,first,\n'
+                                'vtkMRMLMarkupsFiducialNode_1,0,11,2,0,0,0,1,1,1,0,B,second,\n'
+                                'vtkMRMLMarkupsFiducialNode_2,-9,-5,3,0,0,0,1,1,1,0,C,third,\n')
+        markupIDs = logic.importLandmarksFromFile(markupsNode1, filePath)
+        os.remove(filePath)
+        logic.projectLandmarksOnSurface = projectLandmarksOnSurface
+        dispatcher.call = dispatcherCall
+
+        if markupIDs is None or len(markupIDs) != 3 or markupsNode1.GetNumberOfControlPoints() != 3:
+            return False
+        snapshot = logic.getMarkupsSnapshot(markupsNode1)
+        if list(snapshot.labels) != ['A', 'B', 'C']:
+            return False
+        if [markupsNode1.GetNthControlPointDescription(n) for n in range(3)] != ['first', 'second', 'third']:
+            return False
+        landmarkDescription = logic.getLandmarkDescription(markupsNode1)
+        for markupID, landmarkLabel in zip(markupIDs, ['A', 'B', 'C']):
+            if markupID not in landmarkDescription:
+                return False
+            if landmarkDescription[markupID]["landmarkLabel"] != landmarkLabel:
+                return False
+            projection = landmarkDescription[markupID]["projection"]
+            if not projection["isProjected"] or projection["closestPointIndex"] is None:
+                return False
+        # each landmark is projected once, in a single batch, on the sphere
+        if sorted(projectedIDs) != sorted(markupIDs):
+            return False
+        if not np.allclose(np.linalg.norm(snapshot.positions, axis=1), 10, atol=0.1):
+            return False
+        # the point added handler did not run for the imported landmarks
+        if pointAddedRuns:
+            return False
+        logic.releaseAllMarkupsDispatchers()
+        logic.hardenModels.clear()
+        logic.releaseAllMarkupsSnapshots()
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        slicer.mrmlScene.RemoveNode(model)
+        return True
+
+    def test_WalkToClosestPoint(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        # a 10 x 10 mm plane folded on itself at x = 5, the two sheets are
+        # 0.5 mm apart
+        plane = vtk.vtkPlaneSource()
+        plane.SetOrigin(0, 0, 0)
+        plane.SetPoint1(10, 0, 0)
+        plane.SetPoint2(0, 10, 0)
+        plane.SetResolution(10, 10)
+        plane.Update()
+        polyData = vtk.vtkPolyData()
+        polyData.DeepCopy(plane.GetOutput())
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        folded = points[:, 0] > 5
+        points[folded, 0] = 10 - points[folded, 0]
+        points[folded, 2] = 0.5
+        polyData.GetPoints().Modified()
+        surfaceIndex = logic.surfaceIndex(polyData)
+        lower = surfaceIndex.closestPointIndices([2, 5, 0])[0]
+        upper = surfaceIndex.closestPointIndices([2, 5, 0.5])[0]
+        # the walk on the lower sheet stops below the landmark, the vertex of
+        # the upper sheet is closer
+        if surfaceIndex.walkToClosestPoint(np.array([2, 5, 0.6]), lower) != upper:
+            return False
+        if surfaceIndex.walkToClosestPoint(np.array([2, 5, -0.1]), upper) != lower:
+            return False
+        return True
+
+    def test_LandmarkTracking(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        timepoints = []
+        # B moves 1 mm along S-I then 2 mm along A-P
+        for coordB in ((10, 0, 0), (10, 0, 1), (10, 2, 1)):
+            markupsNode = slicer.vtkMRMLMarkupsFiducialNode()
+            slicer.mrmlScene.AddNode(markupsNode)
+            markupsNode.AddFiducial(0, 0, 0, 'A')
+            markupsNode.AddFiducial(coordB[0], coordB[1], coordB[2], 'B')
+            timepoints.append(markupsNode)
+        protocol = logic.measurementProtocol({"distances": [["A", "B"]]})
+        tracking = logic.trackLandmarks(timepoints, protocol)
+        if tracking["positions"].shape != (3, 2, 3) or tracking["cumulativeDisplacements"][:, 1].tolist() != [0, 1, 3]:
+            return False
+        if tracking["displacements"][2, 1].tolist() != [0, 2, 1] or tracking["velocities"][1, 1].tolist() != [0, 2, 0]:
+            return False
+        if tracking["measurements"]["distances"].shape != (3, 1, 4):
+            return False
+        trackingTableNode, timeSeriesTableNode = logic.updateTrackingTables(tracking)
+        if trackingTableNode.GetNumberOfRows() != 6 or timeSeriesTableNode.GetNumberOfRows() != 3:
+            return False
+        logic.releaseAllMarkupsSnapshots()
+        for node in timepoints + [trackingTableNode, timeSeriesTableNode]:
+            slicer.mrmlScene.RemoveNode(node)
+        return True
+
+    def test_LandmarkTables(self):
+        logic = Q3DCLogic(slicer.modules.Q3DCWidget)
+        markupsNode1 = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(markupsNode1)
+        landmarkDescription = {
+            'A': logic.newLandmarkState('A', True),
+            'B': logic.newLandmarkState('B', True),
+            'M': logic.newLandmarkState('M', False),
+        }
+        landmarkDescription['A']['ROIradius'] = 4
+        landmarkDescription['A']['projection']['closestPointIndex'] = 12
+        landmarkDescription['M']['midPoint'].update(isMidPoint=True, Point1='A', Point2='B')
+        landmarkDescription['A']['midPoint']['definedByThisMarkup'].append('M')
+        landmarkDescription['B']['midPoint']['definedByThisMarkup'].append('M')
+        # a scene saved with the description in an attribute only is migrated
+        markupsNode1.SetAttribute("landmarkDescription", logic.encodeJSON(landmarkDescription))
+        logic.migrateLandmarkDescriptions()
+        tableNode = markupsNode1.GetNodeReference(logic.landmarkTableReference)
+        if tableNode is None or tableNode.GetNumberOfRows() != 3 or not tableNode.GetHideFromEditors():
+            return False
+        # the attribute is kept while the table is not written
+        tableNode.AddDefaultStorageNode()
+        logic.onStartSaveScene()
+        if markupsNode1.GetAttribute("landmarkDescription") is None:
+            return False
+        logic.onEndSaveScene()
+        # the written table is saved instead of the attribute
+        storageNode = tableNode.GetStorageNode()
+        storageNode.SetFileName(os.path.join(slicer.app.temporaryPath, 'Q3DCLandmarkTableTest.csv'))
+        if not storageNode.WriteData(tableNode):
+            return False
+        logic.onStartSaveScene()
+        if markupsNode1.GetAttribute("landmarkDescription") is not None:
+            return False
+        logic.onEndSaveScene()
+        for fileName in (storageNode.GetFileName(), storageNode.GetFileName()[:-len('.csv')] + '.schema.csv'):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+        # the description is parsed from the table on first access after loading
+        markupsNode1.RemoveAttribute("landmarkDescription")
+        if logic.getLandmarkDescription(markupsNode1) != landmarkDescription:
+            return False
+        landmarkDescription['B']['ROIradius'] = 2
+        logic.setLandmarkDescription(markupsNode1, landmarkDescription)
+        logic.updatePendingLandmarkTables()
+        if logic.landmarkDescriptionFromTable(tableNode) != landmarkDescription:
+            return False
+        slicer.mrmlScene.RemoveNode(markupsNode1)
+        logic.removeLandmarkTable(markupsNode1)
+        return not slicer.mrmlScene.IsNodePresent(tableNode)
+
     def test_SimulateTutorial(self):
 
         #